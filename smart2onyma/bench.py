@@ -0,0 +1,156 @@
+'Замеры скорости выгрузки на синтетической базе (см. fixture.py).'
+import os
+import json
+import time
+import subprocess
+from datetime import datetime
+from contextlib import redirect_stdout
+
+from . import export
+from . import fixture
+
+
+COMMANDS = ('clientdata', 'tariffs', 'policy')
+# параметры, с которыми была сгенерирована база в рабочем каталоге
+FIXTURE_FILE = 'fixture.json'
+# результаты всех замеров, по одному JSON на строку
+HISTORY_FILE = 'history.jsonl'
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'describe', '--always', '--dirty'],
+            cwd=os.path.dirname(os.path.realpath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def prepare(work_dir, params, connection_uri=None, regenerate=False):
+    '''Создаёт синтетическую базу и профиль выгрузки в work_dir.
+
+    База создаётся заново, только если изменились параметры генерации или
+    задан regenerate. Без connection_uri база создаётся в SQLite.
+    '''
+    os.makedirs(work_dir, exist_ok=True)
+    fixture_file = os.path.join(work_dir, FIXTURE_FILE)
+    params = dict(params, connection_uri=connection_uri)
+    if not regenerate and os.path.exists(fixture_file):
+        with open(fixture_file) as f:
+            regenerate = json.load(f) != params
+    else:
+        regenerate = True
+
+    if connection_uri:
+        sql_dialect = 'postgres'
+    else:
+        sql_dialect = 'sqlite'
+        connection_uri = os.path.abspath(os.path.join(work_dir, 'smart.db'))
+
+    if regenerate:
+        print('generating fixture database...')
+        data = fixture.generate(**{name: value for name, value in params.items() if name != 'connection_uri'})
+        if sql_dialect == 'sqlite':
+            fixture.create_sqlite(connection_uri, data)
+        else:
+            fixture.create_postgres(connection_uri, data)
+        with open(fixture_file, 'w') as f:
+            json.dump(params, f)
+
+    return fixture.write_profile(work_dir, sql_dialect, connection_uri)
+
+
+def run_command(profile_file, command, bulk_size=None):
+    'Одна выгрузка со сбором статистики, вывод выгрузки подавляется.'
+    bde = export.BillingDataExporter(profile_file, bulk_size=bulk_size)
+    bde.clear_output_files()
+    bde.enable_stats()
+    errors_file = os.path.join(bde.exporter.data_dir, 'errors.log')
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        started = time.perf_counter()
+        if command == 'clientdata':
+            bde.export_one_by_one(errors_file=errors_file)
+        elif command == 'tariffs':
+            bde.export_tariffs()
+        elif command == 'policy':
+            bde.export_policy()
+        else:
+            raise Exception('Unknown command: {0}'.format(command))
+        elapsed = time.perf_counter() - started
+    bde.db.db.dispose()
+    return elapsed, bde.stats
+
+
+def run(profile_file, commands=COMMANDS, repeat=1, bulk_size=None):
+    'Замеры команд, для каждой берётся самый быстрый из repeat запусков.'
+    results = {}
+    for command in commands:
+        best = None
+        for _ in range(repeat):
+            elapsed, stats = run_command(profile_file, command, bulk_size)
+            if best is None or elapsed < best[0]:
+                best = elapsed, stats
+        elapsed, stats = best
+        results[command] = {
+            'elapsed': elapsed,
+            'accounts': stats.accounts,
+            'accounts_per_sec': stats.accounts / stats.elapsed if stats.elapsed else None,
+            'stats': stats.to_dict(),
+        }
+    return results
+
+
+def load_history(filename):
+    if not os.path.exists(filename):
+        return []
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def save_result(filename, params, options, results):
+    entry = {
+        'date': datetime.now().isoformat(' ', 'seconds'),
+        'commit': git_commit(),
+        'params': params,
+        'options': options,
+        'results': results,
+    }
+    with open(filename, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+    return entry
+
+
+def report(entry, history):
+    '''Сравнение с предыдущим замером на той же базе и с теми же опциями.'''
+    previous = None
+    for prev in reversed(history):
+        if prev['params'] == entry['params'] and prev['options'] == entry['options']:
+            previous = prev
+            break
+
+    row_format = '{0:<12} {1:>10} {2:>12} {3:>10} {4:>8}'
+    print('commit: {0}, previous: {1}'.format(entry['commit'], previous['commit'] if previous else '-'))
+    print(row_format.format('command', 'elapsed, s', 'accounts/sec', 'prev, s', 'change'))
+    for command, result in entry['results'].items():
+        prev_elapsed = ''
+        change = ''
+        if previous and command in previous['results']:
+            prev = previous['results'][command]['elapsed']
+            prev_elapsed = '{0:.3f}'.format(prev)
+            change = '{0:+.1f}%'.format((result['elapsed'] - prev) / prev * 100)
+        rate = result['accounts_per_sec']
+        print(row_format.format(
+            command, '{0:.3f}'.format(result['elapsed']),
+            '{0:.1f}'.format(rate) if rate else '', prev_elapsed, change))
+
+
+def bench(work_dir, params, commands=COMMANDS, connection_uri=None, regenerate=False, repeat=1,
+          bulk_size=None):
+    profile_file = prepare(work_dir, params, connection_uri, regenerate)
+    history_file = os.path.join(work_dir, HISTORY_FILE)
+    history = load_history(history_file)
+    options = {'bulk_size': bulk_size, 'postgres': bool(connection_uri)}
+    results = run(profile_file, commands, repeat, bulk_size)
+    entry = save_result(history_file, params, options, results)
+    report(entry, history)
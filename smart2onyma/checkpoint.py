@@ -0,0 +1,49 @@
+import os
+import json
+
+
+class CheckpointJournal:
+    '''Журнал выгрузки для продолжения после сбоя.
+
+    В начале выгрузки сохраняется список лицевых, затем периодически - номер
+    следующего лицевого в этом списке, счётчик USRCONNID и размеры всех файлов
+    экспорта на момент, когда все предыдущие лицевые записаны полностью.
+    '''
+    def __init__(self, data_dir, name):
+        self.filename = os.path.join(data_dir, '.checkpoint-{0}.json'.format(name))
+        self.accounts_filename = os.path.join(data_dir, '.checkpoint-{0}-accounts.txt'.format(name))
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    def start(self, accounts):
+        with open(self.accounts_filename, 'w') as f:
+            for acc_num in accounts:
+                f.write('{0}\n'.format(acc_num))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def load_accounts(self):
+        with open(self.accounts_filename) as f:
+            return [line.rstrip('\n') for line in f]
+
+    def load(self):
+        with open(self.filename) as f:
+            return json.load(f)
+
+    def commit(self, state):
+        # запись через временный файл, чтобы журнал не остался недописанным
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump(state, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, self.filename)
+
+    def truncate_files(self, state):
+        'Отрезает от файлов экспорта то, что записано после контрольной точки.'
+        for filename, size in state['files'].items():
+            if os.path.getsize(filename) < size:
+                raise Exception('{0} is shorter than its checkpoint size {1}'.format(filename, size))
+            with open(filename, 'r+b') as f:
+                f.truncate(size)
@@ -0,0 +1,191 @@
+import io
+import gzip
+import zlib
+import queue
+import locale
+import threading
+
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+SUFFIXES = {'gzip': '.gz', 'zstd': '.zst'}
+DEFAULT_LEVELS = {'gzip': 6, 'zstd': 3}
+
+# сколько текста копится перед передачей потоку сжатия
+CHUNK_SIZE = 1 << 20
+# сколько порций может ждать сжатия
+QUEUE_SIZE = 4
+
+_FLUSH = object()
+_CLOSE = object()
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise Exception('zstd output compression requires the zstandard package: pip install zstandard')
+    return zstandard
+
+
+class Compression:
+    '''Сжатие файлов выгрузки (output-compression профиля).
+
+    Файл пишется последовательностью независимых частей (gzip member или
+    zstd frame), каждая flush() закрывает текущую часть. Такие файлы
+    читаются стандартными утилитами как один поток, их можно дописывать
+    (--append) и обрезать по размеру на момент flush() (--resume).
+    '''
+    def __init__(self, method, level=None, threads=0):
+        if method not in SUFFIXES:
+            raise Exception('Unknown output compression: {0}'.format(method))
+        self.method = method
+        self.level = DEFAULT_LEVELS[method] if level is None else level
+        self.threads = threads or 0
+        self.suffix = SUFFIXES[method]
+        if method == 'zstd':
+            # пакет zstandard нужен уже при чтении профиля, а не при первой записи
+            _zstandard()
+
+    @classmethod
+    def from_profile(cls, profile):
+        method = profile.get('output-compression')
+        if not method or method == 'none':
+            return None
+        return cls(method, profile.get('output-compression-level'), profile.get('output-compression-threads'))
+
+    def compressor(self):
+        'Объект с compress() и flush(), выдающий одну часть файла.'
+        if self.method == 'gzip':
+            return zlib.compressobj(self.level, zlib.DEFLATED, 31)
+        # у каждого файла свой ZstdCompressor: compressobj() одного компрессора
+        # делят его контекст сжатия, а файлы сжимаются в разных потоках
+        return _zstandard().ZstdCompressor(level=self.level, threads=self.threads).compressobj()
+
+
+class CompressedFile:
+    '''Текстовый файл, который сжимается в отдельном потоке.
+
+    write() только копит текст, сжатие и запись на диск выполняет фоновый
+    поток. tell() возвращает объём в байтах до сжатия, записанный через этот
+    объект, flush() дожидается сжатия всего записанного и закрывает часть
+    файла, fileno() - дескриптор сжатого файла.
+    '''
+    def __init__(self, filename, mode, compression, encoding=None):
+        self.name = filename
+        self.compression = compression
+        self._raw = open(filename, mode.replace('t', '').rstrip('b') + 'b')
+        self._encoding = encoding or locale.getpreferredencoding(False)
+        self._buffer = []
+        self._buffered = 0
+        self._position = 0
+        self._error = None
+        self._queue = queue.Queue(QUEUE_SIZE)
+        self._flushed = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='compress-' + filename, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        compressor = None
+        while True:
+            item = self._queue.get()
+            try:
+                if item is _FLUSH or item is _CLOSE:
+                    # пустой файл тоже должен распаковываться, в нём пишется пустая часть
+                    if compressor is None and item is _CLOSE and self._raw.tell() == 0:
+                        compressor = self.compression.compressor()
+                    if compressor is not None and self._error is None:
+                        self._raw.write(compressor.flush())
+                        compressor = None
+                    self._raw.flush()
+                    self._flushed.set()
+                    if item is _CLOSE:
+                        return
+                elif self._error is None:
+                    if compressor is None:
+                        compressor = self.compression.compressor()
+                    self._raw.write(compressor.compress(item))
+            except Exception as exc:
+                self._error = exc
+                if item is _FLUSH or item is _CLOSE:
+                    self._flushed.set()
+                    if item is _CLOSE:
+                        return
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+
+    def _submit(self):
+        if self._buffer:
+            data = ''.join(self._buffer).encode(self._encoding)
+            self._buffer = []
+            self._buffered = 0
+            self._position += len(data)
+            self._queue.put(data)
+
+    def _wait(self, marker):
+        self._submit()
+        self._flushed.clear()
+        self._queue.put(marker)
+        self._flushed.wait()
+        self._check()
+
+    def write(self, text):
+        self._check()
+        self._buffer.append(text)
+        self._buffered += len(text)
+        if self._buffered >= CHUNK_SIZE:
+            self._submit()
+        return len(text)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def tell(self):
+        # размер известен только у закодированного текста
+        self._submit()
+        return self._position
+
+    def flush(self):
+        self._wait(_FLUSH)
+
+    def fileno(self):
+        return self._raw.fileno()
+
+    def close(self):
+        if self._raw.closed:
+            return
+        try:
+            self._wait(_CLOSE)
+            self._thread.join()
+        finally:
+            self._raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def open_write(filename, mode, compression=None, buffering=-1):
+    'Открывает файл выгрузки на запись, со сжатием или без.'
+    if compression is None:
+        return open(filename, mode, newline='', buffering=buffering)
+    return CompressedFile(filename, mode, compression)
+
+
+def open_read(filename):
+    'Открывает файл на чтение как текст, сжатие gzip или zstd определяется по содержимому.'
+    with open(filename, 'rb') as f:
+        magic = f.read(4)
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.open(filename, 'rt', newline='')
+    if magic == ZSTD_MAGIC:
+        raw = open(filename, 'rb')
+        reader = _zstandard().ZstdDecompressor().stream_reader(raw, read_across_frames=True, closefd=True)
+        return io.TextIOWrapper(io.BufferedReader(reader), newline='')
+    return open(filename, newline='')
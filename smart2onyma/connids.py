@@ -0,0 +1,152 @@
+import os
+import csv
+import sqlite3
+import threading
+
+from . import mapper
+from .compression import open_read
+
+
+# при изменении схемы индекса версию нужно увеличить, индекс будет построен заново
+INDEX_VERSION = 1
+INDEX_SUFFIX = '.sqlite'
+# сколько строк conn.csv вставляется в индекс за раз
+BUILD_BATCH = 10000
+
+
+def index_filename(filename):
+    '''Индекс хранится в каталоге кэша (mapper.cache_dir), а не рядом с conn.csv,
+    чтобы не попасть в каталог выгрузки, который копируется на сервер Онимы.
+    '''
+    index_file = mapper.cache_filename(filename, 'usrconnid')
+    os.makedirs(os.path.dirname(index_file), exist_ok=True)
+    return os.path.splitext(index_file)[0] + INDEX_SUFFIX
+
+
+class ConnIdStore:
+    '''Соответствие SITENAME -> USRCONNID из conn.csv предыдущей выгрузки.
+
+    Хранится в SQLite-индексе и строится один раз: повторные
+    запуски открывают его сразу и ищут SITENAME по запросу, не читая conn.csv.
+    Индекс перестраивается, если conn.csv изменился (размер или время).
+    Вместе с данными хранится наибольший USRCONNID (hwm).
+
+    Новые USRCONNID, выданные выгрузкой (add), сразу видны при поиске,
+    а в индекс записываются commit() - на контрольных точках выгрузки,
+    так что после сбоя индекс соответствует последней контрольной точке.
+    Поиск и commit() могут вызываться из разных потоков конвейера.
+    '''
+    def __init__(self, filename, index_file=None):
+        self.filename = filename
+        self.index_file = index_file or index_filename(filename)
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._pending_order = []
+        self._db = sqlite3.connect(self.index_file, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        if not self._valid():
+            self.build()
+        self.hwm = self._meta('hwm')
+
+    def _source_signature(self):
+        st = os.stat(self.filename)
+        return str(st.st_size), str(st.st_mtime_ns)
+
+    def _meta(self, key):
+        try:
+            row = self._db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        except sqlite3.OperationalError:
+            return None
+        if row is None or row[0] is None:
+            return None
+        return int(row[0]) if key != 'source' else row[0]
+
+    def _valid(self):
+        if self._meta('version') != INDEX_VERSION:
+            return False
+        return self._meta('source') == ':'.join(self._source_signature())
+
+    def build(self):
+        print('building USRCONNID index for {0}...'.format(self.filename))
+        fieldnames = mapper.maps['export-files']['connections-list'][1].split(';')
+        sitename_idx = fieldnames.index('SITENAME')
+        usrconnid_idx = fieldnames.index('USRCONNID')
+        db = self._db
+        db.execute('BEGIN')
+        db.execute('DROP TABLE IF EXISTS conn_ids')
+        db.execute('DROP TABLE IF EXISTS meta')
+        db.execute('CREATE TABLE conn_ids (sitename TEXT PRIMARY KEY, usrconnid INTEGER NOT NULL) WITHOUT ROWID')
+        db.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+        hwm = None
+        batch = []
+        with open_read(self.filename) as f:
+            for row in csv.reader(f, delimiter=';'):
+                conn_id = int(row[usrconnid_idx])
+                batch.append((row[sitename_idx], conn_id))
+                if hwm is None or conn_id > hwm:
+                    hwm = conn_id
+                if len(batch) >= BUILD_BATCH:
+                    db.executemany('INSERT OR REPLACE INTO conn_ids VALUES (?, ?)', batch)
+                    batch = []
+        db.executemany('INSERT OR REPLACE INTO conn_ids VALUES (?, ?)', batch)
+        db.executemany('INSERT INTO meta VALUES (?, ?)', [
+            ('version', INDEX_VERSION),
+            ('source', ':'.join(self._source_signature())),
+            ('hwm', hwm),
+        ])
+        db.execute('COMMIT')
+
+    def __getitem__(self, sitename):
+        with self._lock:
+            conn_id = self._pending.get(sitename)
+            if conn_id is not None:
+                return conn_id
+            row = self._db.execute('SELECT usrconnid FROM conn_ids WHERE sitename = ?', (sitename,)).fetchone()
+        if row is None:
+            raise KeyError(sitename)
+        return row[0]
+
+    def get(self, sitename, default=None):
+        try:
+            return self[sitename]
+        except KeyError:
+            return default
+
+    def add(self, sitename, conn_id):
+        'Новый USRCONNID, выданный выгрузкой.'
+        with self._lock:
+            self._pending[sitename] = conn_id
+            self._pending_order.append((conn_id, sitename))
+
+    def commit(self, conn_id_next=None):
+        '''Записывает в индекс новые USRCONNID меньше conn_id_next (все, если не задан).'''
+        with self._lock:
+            if conn_id_next is None:
+                ready = self._pending_order
+                self._pending_order = []
+            else:
+                split = 0
+                while split < len(self._pending_order) and self._pending_order[split][0] < conn_id_next:
+                    split += 1
+                ready = self._pending_order[:split]
+                self._pending_order = self._pending_order[split:]
+            if not ready:
+                return
+            hwm = max(self.hwm or 0, max(conn_id for conn_id, _ in ready))
+            db = self._db
+            db.execute('BEGIN')
+            db.executemany('INSERT OR REPLACE INTO conn_ids VALUES (?, ?)',
+                           [(sitename, conn_id) for conn_id, sitename in ready])
+            db.execute("UPDATE meta SET value = ? WHERE key = 'hwm'", (hwm,))
+            db.execute('COMMIT')
+            self.hwm = hwm
+            for _, sitename in ready:
+                self._pending.pop(sitename, None)
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM conn_ids').fetchone()[0] + len(self._pending)
+
+    def close(self):
+        self._db.close()
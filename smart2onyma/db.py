@@ -1,23 +1,141 @@
+import re
+import time
+import glob
+import sqlite3
+import calendar
 from os import path
+from datetime import datetime
+from decimal import Decimal
+from collections import defaultdict
 
 import jinja2
 import sqlalchemy
 
 
+# Oracle не принимает в IN (...) больше 1000 значений
+ORACLE_MAX_IN_KEYS = 1000
+
+
+def _sqlite_date_trunc(unit, value):
+    value = datetime.fromisoformat(str(value))
+    if unit == 'year':
+        value = value.replace(month=1)
+    if unit in ('year', 'month'):
+        value = value.replace(day=1)
+    return value.replace(hour=0, minute=0, second=0, microsecond=0).isoformat(' ')
+
+
+def _sqlite_add_months(value, months):
+    'Как value + months * interval \'1 month\' в PostgreSQL: день обрезается до конца месяца.'
+    value = datetime.fromisoformat(str(value))
+    month = value.month - 1 + int(months)
+    year, month = value.year + month // 12, month % 12 + 1
+    day = min(value.day, calendar.monthrange(year, month)[1])
+    return value.replace(year=year, month=month, day=day).isoformat(' ')
+
+
+# Выражения PostgreSQL из шаблонов, которых нет в SQLite. Шаблоны пишутся для
+# рабочих баз, а для SQLite отрисованный запрос переводится этими заменами.
+SQLITE_REWRITES = [
+    (re.compile(r"([\w.]+) \+ ([\w.]+) \* interval '1 month'"), r'add_months(\1, \2)'),
+]
+# Колонки-выражения не имеют объявленного типа, тип им задаётся подсказкой
+# в имени ("now [date]", см. sqlite3.PARSE_COLNAMES), как у колонок таблиц.
+SQLITE_COLUMN_TYPES = {
+    'now': 'date',
+    'start_date': 'timestamp',
+    'end_date': 'timestamp',
+}
+SQLITE_COLUMN_RE = re.compile(r'\bas ({0})\b'.format('|'.join(SQLITE_COLUMN_TYPES)), re.IGNORECASE)
+
+
+def _sqlite_sql(sql):
+    for pattern, replacement in SQLITE_REWRITES:
+        sql = pattern.sub(replacement, sql)
+    return SQLITE_COLUMN_RE.sub(lambda m: 'AS "{0} [{1}]"'.format(m.group(1), SQLITE_COLUMN_TYPES[m.group(1).lower()]),
+                                sql)
+
+
+def _sqlite_setup():
+    # типы колонок приводятся к тем же типам Python, что отдаёт PostgreSQL
+    sqlite3.register_converter('timestamp', lambda b: datetime.fromisoformat(b.decode()))
+    sqlite3.register_converter('timestamptz', lambda b: datetime.fromisoformat(b.decode()))
+    sqlite3.register_converter('date', lambda b: datetime.fromisoformat(b.decode()).date())
+    sqlite3.register_converter('decimal', lambda b: Decimal(b.decode()))
+
+
+def _sqlite_on_connect(db_file):
+    'Схемы (core, iptraf, ...) - отдельные файлы рядом с основным: smart.core.db и т.п.'
+    base = path.splitext(db_file)[0]
+
+    def on_connect(dbapi_conn, connection_record):
+        for schema_file in sorted(glob.glob(base + '.*.db')):
+            schema = schema_file[len(base) + 1:-len('.db')]
+            dbapi_conn.execute('ATTACH DATABASE ? AS "{0}"'.format(schema), (schema_file, ))
+        # функции PostgreSQL, которые встречаются в шаблонах запросов
+        dbapi_conn.create_function('date_trunc', 2, _sqlite_date_trunc, deterministic=True)
+        dbapi_conn.create_function('now', 0, lambda: datetime.now().isoformat(' '))
+        dbapi_conn.create_function('to_date', 2, lambda value, format: value)
+        dbapi_conn.create_function('add_months', 2, _sqlite_add_months, deterministic=True)
+    return on_connect
+
+
+def connection_string(sql_dialect, connection_uri):
+    'Строка подключения SQLAlchemy для sql-dialect и connection-uri из профиля.'
+    if sql_dialect == 'oracle':
+        return 'oracle+cx_oracle://' + connection_uri
+    elif sql_dialect == 'postgres':
+        return 'postgresql+psycopg2://' + connection_uri
+    elif sql_dialect == 'sqlite':
+        return 'sqlite:///' + connection_uri
+    raise Exception('Unknown SQL dialect.')
+
+
+def _freeze(value):
+    'Словари (например, фильтры профиля) и списки в ключе кэша запросов заменяются кортежами.'
+    if isinstance(value, dict):
+        return tuple(sorted((name, _freeze(item)) for name, item in value.items()))
+    if isinstance(value, list):
+        return tuple(_freeze(item) for item in value)
+    return value
+
+
 class Engine:
     'Обёртка над подключением к базе данных, формирует запросы из шаблонов.'
-    def __init__(self, sql_dialect, connection_uri, tpl_path=None, debug=False):
+    def __init__(self, sql_dialect, connection_uri, tpl_path=None, debug=False, keys_chunk_size=1000,
+                 fetch_batch_size=10000, pool_size=None):
         self._debug = debug
+        engine_args = {}
+        if pool_size and sql_dialect != 'sqlite':
+            # подключением пользуются несколько профилей одновременно, см. multiprofile.py
+            engine_args['pool_size'] = pool_size
 
+        conn_str = connection_string(sql_dialect, connection_uri)
         if sql_dialect == 'oracle':
-            conn_str = 'oracle+cx_oracle://' + connection_uri
-        elif sql_dialect == 'postgres':
-            conn_str = 'postgresql+psycopg2://' + connection_uri
-        else:
-            raise Exception('Unknown SQL dialect.')
+            # cx_Oracle забирает строки с сервера пачками по arraysize
+            engine_args['arraysize'] = fetch_batch_size
+        elif sql_dialect == 'sqlite':
+            # синтетическая база для замеров скорости, см. fixture.py;
+            # соединение передаётся между потоками конвейера выгрузки, но
+            # одновременно его использует только один поток
+            engine_args['connect_args'] = {'detect_types': sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+                                           'check_same_thread': False}
+            _sqlite_setup()
 
         self.sql_dialect = sql_dialect
-        self.db = sqlalchemy.create_engine(conn_str, echo=False)
+        # кэш SQLAlchemy для скомпилированных запросов из кэша шаблонов
+        self._compiled_cache = {}
+        engine = sqlalchemy.create_engine(conn_str, echo=False, **engine_args)
+        if sql_dialect == 'sqlite':
+            sqlalchemy.event.listen(engine, 'connect', _sqlite_on_connect(connection_uri))
+        self.db = engine.execution_options(compiled_cache=self._compiled_cache)
+        # размер пачки строк при потоковом чтении результата
+        self.fetch_batch_size = fetch_batch_size
+
+        # сколько ключей передавать в одном пакетном запросе
+        self.keys_chunk_size = keys_chunk_size
+        if sql_dialect == 'oracle':
+            self.keys_chunk_size = min(keys_chunk_size, ORACLE_MAX_IN_KEYS)
 
         if tpl_path is None:
             tpl_path = path.join(path.dirname(path.realpath(__file__)), 'sql/')
@@ -27,14 +145,67 @@ class Engine:
         )
         self.tpl_env.globals['sql_dialect'] = sql_dialect
 
-    def _execute(self, connection, template, args_dict):
+        # Кэш готовых запросов. Текст запроса зависит только от шаблона,
+        # глобальных переменных и аргументов, которые не являются параметрами
+        # запроса (:name), поэтому ключ кэша составляется из шаблона и этих
+        # аргументов, а параметры шаблона запоминаются после первой отрисовки.
+        self._statements = {}
+        self._tpl_binds = {}
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # сбор статистики запросов (stats.Stats), если включён
+        self.stats = None
+
+    def cache_info(self):
+        return {'hits': self.cache_hits, 'misses': self.cache_misses, 'size': len(self._statements)}
+
+    def _cache_key(self, template, args_dict):
+        binds = self._tpl_binds.get(template)
+        if binds is None:
+            return None
+        key = (template, tuple(sorted(
+            (name, _freeze(value)) for name, value in args_dict.items() if name not in binds)))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def _statement(self, template, args_dict):
+        key = self._cache_key(template, args_dict)
+        sql = self._statements.get(key) if key is not None else None
+        if sql is not None:
+            self.cache_hits += 1
+            return sql
+        self.cache_misses += 1
+
+        started = time.perf_counter()
         tpl = self.tpl_env.get_template(template)
-        sql = tpl.render(args_dict)
+        rendered = tpl.render(args_dict)
+        if self.sql_dialect == 'sqlite':
+            rendered = _sqlite_sql(rendered)
+        sql = sqlalchemy.sql.text(rendered)
+        if self.stats is not None:
+            self.stats.add_function('sql render', time.perf_counter() - started)
+        if 'keys' in args_dict and self.sql_dialect != 'postgres':
+            # список ключей для пакетного запроса разворачивается в IN (...),
+            # в PostgreSQL он передаётся массивом в = ANY(:keys)
+            sql = sql.bindparams(sqlalchemy.sql.bindparam('keys', expanding=True))
+
+        self._tpl_binds.setdefault(template, set()).update(sql.compile().params)
+        key = self._cache_key(template, args_dict)
+        if key is not None:
+            self._statements[key] = sql
+        return sql
+
+    def _execute(self, connection, template, args_dict):
+        sql = self._statement(template, args_dict)
 
         if self._debug:
-            print(sql)
+            print(sql.text)
 
-        sql = sqlalchemy.sql.text(sql)
+        if self.stats is not None:
+            return self.stats.execute(template, connection.execute, sql, **args_dict)
         return connection.execute(sql, **args_dict)
 
     def connect(self):
@@ -55,3 +226,37 @@ class Connection:
 
     def execute(self, template, **args):
         return self.engine._execute(self.conn, template, args)
+
+    def stream(self, template, **args):
+        '''Выполняет запрос с потоковым чтением результата.
+
+        В PostgreSQL используется именованный (серверный) курсор, строки
+        забираются пачками по fetch_batch_size, так что результат целиком
+        в памяти клиента не держится.
+        '''
+        batch_size = self.engine.fetch_batch_size
+        conn = self.conn.execution_options(stream_results=True, max_row_buffer=batch_size)
+        result = self.engine._execute(conn, template, args)
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+
+    def execute_many_keys(self, template, keys, key, chunk_size=None, **args):
+        '''Выполняет пакетный запрос для списка ключей.
+
+        Шаблон получает bulk=True и очередную пачку ключей в :keys, строки
+        результата группируются по значению колонки key.
+        '''
+        chunk_size = chunk_size or self.engine.keys_chunk_size
+        if self.engine.sql_dialect == 'oracle':
+            chunk_size = min(chunk_size, ORACLE_MAX_IN_KEYS)
+        keys = list(dict.fromkeys(keys))
+
+        rows = defaultdict(list)
+        for idx in range(0, len(keys), chunk_size):
+            chunk = keys[idx:idx + chunk_size]
+            for r in self.execute(template, bulk=True, keys=chunk, **args):
+                rows[getattr(r, key)].append(r)
+        return rows
@@ -0,0 +1,72 @@
+import os
+import csv
+import hashlib
+
+from . import mapper
+
+
+# отпечатки лицевых части параллельной выгрузки, в её временном каталоге
+FINGERPRINTS_FILE = 'fingerprints.csv'
+FINGERPRINTS_FORMAT = 'DOGCODE;PROFILE;HASH'
+# подкаталог с изменениями относительно полной выгрузки
+DELTA_DIR = 'delta'
+REMOVED_FILE = 'removed.csv'
+
+# Поля, которые меняются от запуска к запуску без изменения самих данных:
+# даты выгрузки и USRCONNID (он определяется по SITENAME).
+VOLATILE_FIELDS = frozenset(('BEGDATE', 'DATE', 'USRCONNID'))
+# Наборы записей, строки которых зависят от месяца выгрузки: история статусов
+# обрезается началом месяца, остаток поправляется на списание за дни месяца,
+# платежи выбираются с начала месяца. Их строки в отпечаток не входят, вместо
+# них выгрузка добавляет исходные значения (статусы с датами, остаток на
+# счёте, абонентскую плату), так что после смены месяца отпечаток тот же.
+MONTH_RELATIVE_FILES = frozenset(('connections-status-history', 'balances-list', 'payments-list'))
+
+
+def fingerprints_filename(data_dir):
+    '''Отпечатки выгрузки в data_dir хранятся в каталоге кэша (mapper.cache_dir),
+    а не в самом data_dir, который копируется на сервер Онимы.
+    '''
+    filename = mapper.cache_filename(data_dir, 'fingerprints')
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    return os.path.splitext(filename)[0] + '.csv'
+
+
+def load_fingerprints(filename, profile_name):
+    'Отпечатки лицевых профиля из предыдущей выгрузки.'
+    fingerprints = {}
+    if not os.path.exists(filename):
+        return fingerprints
+    with open(filename, newline='') as f:
+        for row in csv.reader(f, delimiter=';'):
+            acc_num, profile, digest = row[:3]
+            if profile == profile_name:
+                fingerprints[acc_num] = digest
+    return fingerprints
+
+
+def stable_positions(writer):
+    'Позиции значимых полей или None, если строки набора в отпечаток не входят.'
+    if writer.export_file in MONTH_RELATIVE_FILES:
+        return None
+    return [idx for idx, field in enumerate(writer.fields) if field not in VOLATILE_FIELDS]
+
+
+def fingerprint(captured, sources=()):
+    '''Отпечаток всех строк, выгруженных для одного лицевого.
+
+    captured - список пар (позиции значимых полей, записи) по файлам экспорта,
+    sources - кортежи исходных значений для наборов из MONTH_RELATIVE_FILES.
+    '''
+    h = hashlib.blake2b(digest_size=16)
+    for positions, records in captured:
+        if positions is None:
+            continue
+        for record in records:
+            h.update('\x1f'.join([str(record[idx]) for idx in positions]).encode())
+            h.update(b'\x1e')
+        h.update(b'\x1d')
+    for source in sources:
+        h.update('\x1f'.join([str(value) for value in source]).encode())
+        h.update(b'\x1e')
+    return h.hexdigest()
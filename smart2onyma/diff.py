@@ -0,0 +1,195 @@
+import os
+import csv
+import heapq
+from collections import Counter
+from itertools import groupby
+from operator import itemgetter
+
+from . import preload
+from .mapper import maps
+from .compression import open_read
+from .verify import find_file
+
+
+# память на кортеж записи с ключом и место в списке, сверх самих полей
+ENTRY_OVERHEAD = 120
+# память на строку поля сверх её длины
+FIELD_OVERHEAD = 50
+
+
+class SortedFile:
+    '''Строки файла выгрузки, отсортированные по ключу (export-keys в maps.yaml).
+
+    Файл читается один раз. Пока строки помещаются в budget байт, они
+    сортируются в памяти, иначе - внешней сортировкой: порции по budget
+    сортируются и сбрасываются во временные файлы (preload.spill), а при
+    переборе сливаются (heapq.merge). Записи - пары (ключ, строка), внутри
+    одного ключа строки тоже упорядочены.
+    '''
+    def __init__(self, filename, positions, width, budget):
+        self.rows = 0
+        self._runs = []
+        entries = []
+        size = 0
+        # ключ из одного поля - строка, из нескольких - кортеж
+        key = itemgetter(*positions)
+        row_overhead = ENTRY_OVERHEAD + FIELD_OVERHEAD * width
+        if filename is not None:
+            with open_read(filename) as f:
+                for row in csv.reader(f, delimiter=';'):
+                    # последнее пустое поле - от завершающего ";"
+                    row = tuple(row[:width])
+                    if len(row) < width:
+                        row += ('',) * (width - len(row))
+                    entries.append((key(row), row))
+                    self.rows += 1
+                    # приблизительно, preload.record_size для каждой строки слишком медленный
+                    size += sum(map(len, row)) + row_overhead
+                    if size > budget:
+                        self._runs.append(preload.spill(entries))
+                        entries = []
+                        size = 0
+        if self._runs and entries:
+            self._runs.append(preload.spill(entries))
+            entries = []
+        entries.sort()
+        self._entries = entries
+
+    def __iter__(self):
+        if not self._runs:
+            return iter(self._entries)
+        return heapq.merge(*[preload.read_run(f) for f in self._runs])
+
+    def close(self):
+        for f in self._runs:
+            f.close()
+        self._runs = []
+
+
+class FileDiff:
+    'Счётчики различий одного файла выгрузки.'
+    def __init__(self, export_file, fields):
+        self.export_file = export_file
+        self.fields = fields
+        self.old_rows = 0
+        self.new_rows = 0
+        self.added = 0
+        self.removed = 0
+        self.changed = 0
+        # сколько раз менялось каждое поле в изменённых записях
+        self.changed_fields = Counter()
+
+    def report(self):
+        return '{0:<24} {1:>10} {2:>10} {3:>9} {4:>9} {5:>9}'.format(
+            maps['export-files'][self.export_file][0], self.old_rows, self.new_rows,
+            self.added, self.removed, self.changed)
+
+
+def merge_join(old, new):
+    '''Сравнивает два отсортированных потока (ключ, строка).
+
+    Выдаёт ('+', None, строка), ('-', строка, None) и ('~', старая, новая).
+    Записи с повторяющимся ключом сравниваются как наборы: если с каждой
+    стороны по одной записи, это изменение, иначе - удалённые и добавленные.
+    '''
+    first = itemgetter(0)
+    old_groups = groupby(old, key=first)
+    new_groups = groupby(new, key=first)
+    old_key, old_group = next(old_groups, (None, None))
+    new_key, new_group = next(new_groups, (None, None))
+    while old_group is not None or new_group is not None:
+        if new_group is None or (old_group is not None and old_key < new_key):
+            for _, row in old_group:
+                yield '-', row, None
+            old_key, old_group = next(old_groups, (None, None))
+        elif old_group is None or new_key < old_key:
+            for _, row in new_group:
+                yield '+', None, row
+            new_key, new_group = next(new_groups, (None, None))
+        else:
+            old_rows = [row for _, row in old_group]
+            new_rows = [row for _, row in new_group]
+            if old_rows != new_rows:
+                if len(old_rows) == 1 and len(new_rows) == 1:
+                    yield '~', old_rows[0], new_rows[0]
+                else:
+                    old_count = Counter(old_rows)
+                    new_count = Counter(new_rows)
+                    for row in sorted((old_count - new_count).elements()):
+                        yield '-', row, None
+                    for row in sorted((new_count - old_count).elements()):
+                        yield '+', None, row
+            old_key, old_group = next(old_groups, (None, None))
+            new_key, new_group = next(new_groups, (None, None))
+
+
+def diff_file(export_file, old_dir, new_dir, budget, out=None):
+    '''Различия набора записей export_file между двумя каталогами выгрузки.
+
+    С out (csv.writer) пишет различия строками "+;запись", "-;запись",
+    изменённые - парой строк "<;старая" и ">;новая".
+    '''
+    filename, format = maps['export-files'][export_file]
+    fields = format.split(';')
+    keys = maps['export-keys'][export_file].split(';')
+    positions = [fields.index(field) for field in keys]
+    result = FileDiff(export_file, fields)
+
+    # обе стороны сортируются по очереди, но сливаются одновременно
+    old = SortedFile(find_file(old_dir, export_file), positions, len(fields), budget // 2)
+    new = SortedFile(find_file(new_dir, export_file), positions, len(fields), budget // 2)
+    result.old_rows, result.new_rows = old.rows, new.rows
+    try:
+        for mark, old_row, new_row in merge_join(old, new):
+            if mark == '+':
+                result.added += 1
+                if out is not None:
+                    out.writerow(('+',) + new_row + ('',))
+            elif mark == '-':
+                result.removed += 1
+                if out is not None:
+                    out.writerow(('-',) + old_row + ('',))
+            else:
+                result.changed += 1
+                for field, old_value, new_value in zip(fields, old_row, new_row):
+                    if old_value != new_value:
+                        result.changed_fields[field] += 1
+                if out is not None:
+                    out.writerow(('<',) + old_row + ('',))
+                    out.writerow(('>',) + new_row + ('',))
+    finally:
+        old.close()
+        new.close()
+    return result
+
+
+def diff_dirs(old_dir, new_dir, budget, output_dir=None):
+    '''Сравнивает все файлы двух выгрузок, с output_dir пишет различия
+    каждого файла в <output_dir>/<файл>.diff.
+    '''
+    results = []
+    if output_dir is not None and not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    for export_file, (filename, format) in maps['export-files'].items():
+        if find_file(old_dir, export_file) is None and find_file(new_dir, export_file) is None:
+            continue
+        print('comparing {0}...'.format(filename))
+        if output_dir is None:
+            results.append(diff_file(export_file, old_dir, new_dir, budget))
+            continue
+        with open(os.path.join(output_dir, filename + '.diff'), 'w', newline='') as f:
+            out = csv.writer(f, delimiter=';', lineterminator='\n')
+            results.append(diff_file(export_file, old_dir, new_dir, budget, out))
+    return results
+
+
+def report(results):
+    lines = ['{0:<24} {1:>10} {2:>10} {3:>9} {4:>9} {5:>9}'.format(
+        'file', 'old', 'new', 'added', 'removed', 'changed')]
+    lines.extend(result.report() for result in results)
+    for result in results:
+        if result.changed_fields:
+            lines.append('{0}: changed fields: {1}'.format(
+                maps['export-files'][result.export_file][0],
+                ', '.join('{0} {1}'.format(field, count) for field, count in result.changed_fields.most_common())))
+    return '\n'.join(lines)
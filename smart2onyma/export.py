@@ -1,45 +1,154 @@
 import os
 import re
+import glob
+import time
+import csv
+import shutil
+import tempfile
+from contextlib import redirect_stdout, nullcontext
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from datetime import timezone
 from datetime import timedelta
 import calendar
 from decimal import Decimal
-import ipaddress
 from ipaddress import ip_address, ip_network
-from math import log2
+from array import array
+from bisect import bisect_right
 from collections import defaultdict
 
 
-from .mapper import maps, load_sitename_to_usrconnid_map
+from .mapper import maps
 from . import db
+from . import fetch
 from . import mapper
+from . import delta
+from . import stats
+from . import preload
+from . import pipeline
+from .checkpoint import CheckpointJournal
+from .ippools import IpPoolResolver
+from . import compression
+from . import connids
+from . import staging
+from .compression import open_write
+
+
+class OnymaDialect(csv.Dialect):
+    'Формат файлов загрузки Онимы: поля через ";", кавычки только при необходимости.'
+    delimiter = ';'
+    quotechar = '"'
+    doublequote = True
+    skipinitialspace = False
+    lineterminator = '\n'
+    quoting = csv.QUOTE_MINIMAL
+
+
+# размер буфера вывода для файлов экспорта
+WRITE_BUFFER_SIZE = 1 << 20
+
+
+def sync_file(file):
+    file.flush()
+    os.fsync(file.fileno())
+    return os.fstat(file.fileno()).st_size
 
 
 class Writer:
-    def __init__(self, filename, format, mode):
+    '''Запись строк в файл экспорта в формате из maps.yaml.
+
+    Каждая строка заканчивается разделителем, как того ожидает загрузчик
+    Онимы. Значения None записываются строкой "None", как и раньше.
+    '''
+    # набор записей из export-files, задаёт Exporter
+    export_file = None
+
+    def __init__(self, filename, format, mode, compression=None, staging=None):
         self.filename = filename
         self.fields = format.split(';')
+        self.positions = {field: idx for idx, field in enumerate(self.fields)}
         self.mode = mode
+        self.compression = compression
+        # с staging.StagingDatabase строки пишутся в её таблицу filename
+        self.staging = staging
+        self._captured = None
 
     def __enter__(self):
-        self.file = open(self.filename, self.mode)
+        if self.staging is not None:
+            self.file = self._writer = self.staging.open_table(self.filename, self.fields, self.mode)
+        else:
+            self.file = open_write(self.filename, self.mode, self.compression, buffering=WRITE_BUFFER_SIZE)
+            self._writer = csv.writer(self.file, OnymaDialect)
+        self.rows = 0
+        self._start_size = self.file.tell()
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.file.close()
 
     def write_header(self):
-        self.file.write(';'.join(self.fields) + ';\n')
+        self._writer.writerow(self.fields + [''])
 
     def write(self, **items):
-        record = []
-        for field in self.fields:
-            value = str(items.get(field, ''))
-            if ';' in value:
-                value = '"{0}"'.format(value)
-            record.append(value)
-        self.file.write(';'.join(record) + ';\n')
+        # последнее пустое поле даёт завершающий ";"
+        record = [''] * (len(self.fields) + 1)
+        positions = self.positions
+        for field, value in items.items():
+            idx = positions.get(field)
+            if idx is not None:
+                record[idx] = 'None' if value is None else value
+        if self._captured is not None:
+            self._captured.append(record)
+        else:
+            self._writer.writerow(record)
+            self.rows += 1
+
+    def write_row(self, row):
+        'Запись строки из кортежа значений в порядке полей формата.'
+        if self._captured is not None:
+            self._captured.append(self._record(row))
+        else:
+            self._writer.writerow(self._record(row))
+            self.rows += 1
+
+    def write_rows(self, rows):
+        records = [self._record(row) for row in rows]
+        if self._captured is not None:
+            self._captured.extend(records)
+        else:
+            self.write_records(records)
+
+    def capture(self):
+        'Дальнейшие записи копятся в памяти, пока не будут забраны release().'
+        self._captured = []
+
+    def release(self):
+        records, self._captured = self._captured, None
+        return records
+
+    def write_records(self, records):
+        'Запись строк, полученных от release().'
+        self._writer.writerows(records)
+        self.rows += len(records)
+
+    def written(self):
+        'Количество строк и байт (до сжатия), записанных с открытия файла.'
+        return self.rows, self.file.tell() - self._start_size
+
+    def sync(self):
+        'Сбрасывает записанное на диск, возвращает размер файла.'
+        if self.staging is not None:
+            return self.file.sync()
+        return sync_file(self.file)
+
+    @staticmethod
+    def _record(row):
+        if None in row:
+            row = ['None' if value is None else value for value in row]
+        else:
+            row = list(row)
+        row.append('')
+        return row
 
 
 class AccountAttrsWriter(Writer):
@@ -74,31 +183,71 @@ class ConnectionPropsWriter(Writer):
 
 
 class Exporter:
-    def __init__(self, data_dir='export_data/'):
+    '''Файлы выгрузки в data_dir, со сжатием (compression.Compression) - с его суффиксом.
+
+    С staging (staging.StagingDatabase) наборы записей пишутся не в файлы,
+    а в таблицы промежуточной базы, в data_dir остаются журналы.
+    '''
+    def __init__(self, data_dir='export_data/', compression=None, staging=None):
         self.data_dir = data_dir
+        self.compression = compression
+        self.staging = staging
+        # файл отпечатков лицевых, по умолчанию - в каталоге кэша (delta.fingerprints_filename)
+        self.fingerprints_file = None
         if not os.path.isdir(data_dir):
             os.makedirs(data_dir)
 
-    def open(self, export_file, mode='a'):
+    def path(self, export_file):
+        if self.staging is not None:
+            raise Exception('{0} is written to the staging database, not to a file'.format(export_file))
         filename, format = maps['export-files'].get(export_file)
-        filename = os.path.join(self.data_dir, filename)
-        return Writer(filename, format, mode)
+        if self.compression is not None:
+            filename += self.compression.suffix
+        return os.path.join(self.data_dir, filename)
+
+    def _writer(self, cls, export_file, mode):
+        filename, format = maps['export-files'].get(export_file)
+        if self.staging is not None:
+            writer = cls(self.staging.table_name(export_file), format, mode, staging=self.staging)
+        else:
+            writer = cls(self.path(export_file), format, mode, self.compression)
+        writer.export_file = export_file
+        return writer
+
+    def open(self, export_file, mode='a'):
+        return self._writer(Writer, export_file, mode)
+
+    def open_file(self, export_file, mode='a'):
+        'Файл выгрузки как текстовый файл, без разбора на поля.'
+        return open_write(self.path(export_file), mode, self.compression)
 
     def open_account_attrs(self):
-        filename, format = maps['export-files'].get('accounts-attrs')
-        filename = os.path.join(self.data_dir, filename)
-        return AccountAttrsWriter(filename, format, 'a')
+        return self._writer(AccountAttrsWriter, 'accounts-attrs', 'a')
 
     def open_connection_props(self):
-        filename, format = maps['export-files'].get('connections-props')
-        filename = os.path.join(self.data_dir, filename)
-        return ConnectionPropsWriter(filename, format, 'a')
+        return self._writer(ConnectionPropsWriter, 'connections-props', 'a')
+
+    def remove_stale_files(self):
+        'Удаляет файлы выгрузки, записанные с другим сжатием или без него.'
+        current = self.compression.suffix if self.compression is not None else ''
+        for filename, format in maps['export-files'].values():
+            for suffix in [''] + list(compression.SUFFIXES.values()):
+                path = os.path.join(self.data_dir, filename + suffix)
+                if suffix != current and os.path.exists(path):
+                    os.remove(path)
+
+    def fingerprints_path(self):
+        if self.fingerprints_file is not None:
+            return self.fingerprints_file
+        return delta.fingerprints_filename(self.data_dir)
+
+    def open_fingerprints(self, mode='a'):
+        return Writer(self.fingerprints_path(), delta.FINGERPRINTS_FORMAT, mode)
 
 
 def two_ip_to_net(start_ip, end_ip):
-    mask = 32 - int(log2(end_ip - start_ip + 1))
-    nw = str(ip_address(start_ip)) + '/' + str(mask)
-    return ip_network(nw)
+    prefixlen = 32 - ((end_ip - start_ip + 1).bit_length() - 1)
+    return ip_network((start_ip, prefixlen))
 
 
 class PhoneNumberPool:
@@ -116,18 +265,151 @@ class PhoneNumberPool:
 
 
 class PhoneNumberPools:
+    '''Пулы телефонных номеров.
+
+    Для поиска пулы сортируются по началу диапазона, номер ищется двоичным
+    поиском по массиву начал. Если пулы пересекаются, номер относится
+    к пулу, добавленному раньше, как и при переборе по порядку.
+    '''
     def __init__(self):
         self.pools = []
+        self.overlaps = []
+        self.gaps = []
+        self._starts = None
 
     def add(self, start_ani, end_ani, zone_code, comments):
         pool = PhoneNumberPool(start_ani, end_ani, zone_code, comments)
         self.pools.append(pool)
+        self._starts = None
+
+    def build(self):
+        'Строит индекс, заодно находит пересечения пулов и промежутки между ними.'
+        order = sorted(range(len(self.pools)), key=lambda idx: (self.pools[idx].start_ani, idx))
+        self._sorted = [self.pools[idx] for idx in order]
+        self._order = array('l', order)
+        self._starts = array('q', (pool.start_ani for pool in self._sorted))
+        # наибольший конец диапазона среди пулов до текущего включительно
+        self._max_ends = array('q')
+        self.overlaps = []
+        self.gaps = []
+        widest = None
+        for pool in self._sorted:
+            if widest is not None:
+                if pool.start_ani <= widest.end_ani:
+                    self.overlaps.append((widest, pool))
+                elif pool.start_ani > widest.end_ani + 1:
+                    self.gaps.append((widest.end_ani + 1, pool.start_ani - 1))
+            if widest is None or pool.end_ani > widest.end_ani:
+                widest = pool
+            self._max_ends.append(widest.end_ani)
+
+    def _lookup(self, idx, number):
+        found = None
+        while idx >= 0 and self._max_ends[idx] >= number:
+            pool = self._sorted[idx]
+            if pool.end_ani >= number and (found is None or self._order[idx] < self._order[found]):
+                found = idx
+            if not self.overlaps:
+                break
+            idx -= 1
+        return None if found is None else self._sorted[found]
 
     def find(self, number):
-        for pool in self.pools:
-            if pool.has(number):
-                return pool
-        return None
+        if self._starts is None:
+            self.build()
+        number = int(number)
+        return self._lookup(bisect_right(self._starts, number) - 1, number)
+
+    def find_many(self, numbers):
+        'Пулы для списка номеров, в том же порядке; None, если пул не найден.'
+        if self._starts is None:
+            self.build()
+        numbers = [int(number) for number in numbers]
+        result = [None] * len(numbers)
+        lo = 0
+        # номера перебираются по возрастанию, поиск начинается с прошлой позиции
+        for pos in sorted(range(len(numbers)), key=numbers.__getitem__):
+            number = numbers[pos]
+            idx = bisect_right(self._starts, number, lo) - 1
+            lo = max(idx, 0)
+            result[pos] = self._lookup(idx, number)
+        return result
+
+
+# Метка USRCONNID, выделенного при параллельной выгрузке: настоящие значения
+# становятся известны только при слиянии частей, по порядку.
+CONN_ID_PLACEHOLDER = '\x00{0}\x00'
+CONN_ID_PLACEHOLDER_RE = re.compile('\x00([0-9]+)\x00')
+
+
+# строки вывода выгрузки, которые при выгрузке в несколько процессов
+# показываются в консоли родительского процесса
+DIAGNOSTIC_PREFIXES = ('WARNING', 'OH!')
+SHARD_LOG = 'clientdata.log'
+
+# предзагрузки дочернего процесса параллельной выгрузки, см. _init_worker
+_worker_preloads = None
+
+
+def _shard_exporter(profile_file, options):
+    bde = BillingDataExporter(profile_file,
+                              tariffs_history_from=options['tariffs_history_from'],
+                              bulk_size=options['bulk_size'])
+    bde.set_export_data_items(options['export_items'])
+    return bde
+
+
+def _init_worker(profile_file, options, log_dir):
+    '''Загружает предзагрузки один раз на дочерний процесс, их используют
+    все части, которые он выгружает.
+
+    Части достаются процессу по порядку, так что и сброшенные во временные
+    файлы предзагрузки читаются по возрастанию номеров лицевых.
+    '''
+    global _worker_preloads
+    log_file = os.path.join(log_dir, 'worker-{0}.log'.format(os.getpid()))
+    with open(log_file, 'w') as log, redirect_stdout(log):
+        bde = _shard_exporter(profile_file, options)
+        with bde.db.connect() as c:
+            _worker_preloads = bde.load_preloads(c)
+        bde.db.db.dispose()
+
+
+def diagnostics(log_file):
+    'Предупреждения из вывода выгрузки (строки прогресса разделены "\\r").'
+    with open(log_file) as f:
+        for line in f.read().replace('\r', '\n').split('\n'):
+            if line.startswith(DIAGNOSTIC_PREFIXES):
+                yield line
+
+
+def _export_shard(profile_file, options, shard_dir, accounts, prev_fingerprints):
+    '''Выгружает часть лицевых в отдельный каталог, выполняется в дочернем процессе.
+
+    Вывод выгрузки пишется в SHARD_LOG части, предупреждения из него
+    показывает родительский процесс при слиянии.
+    '''
+    with open(os.path.join(shard_dir, SHARD_LOG), 'w') as log, redirect_stdout(log):
+        bde = _shard_exporter(profile_file, options)
+        # части пишутся без сжатия, сжимаются при слиянии
+        bde.exporter = Exporter(shard_dir)
+        bde.exporter.fingerprints_file = os.path.join(shard_dir, delta.FINGERPRINTS_FILE)
+        if options['prev_conn_file']:
+            bde.load_sitename_to_usrconnid_map(options['prev_conn_file'])
+        bde._limit = 0
+        bde._conn_id_next = 0
+        bde._conn_id_placeholders = True
+        bde._checkpoint_every = 0
+        bde._prev_fingerprints = prev_fingerprints
+        if options['stats']:
+            bde.enable_stats()
+        if options['fingerprints']:
+            bde.enable_fingerprints()
+        bde.clear_output_files()
+        ok = bde.export_one_by_one(accounts, errors_file=os.path.join(shard_dir, 'errors.log'),
+                                   preloads=_worker_preloads)
+    # количество выделенных новых USRCONNID
+    return bde._conn_id_next, ok, bde.stats.to_dict() if bde.stats else None
 
 
 class ErrorsCounter:
@@ -136,10 +418,23 @@ class ErrorsCounter:
         self.count = 0
         self.accounts = set()
         self.groups = set()
+        self._captured = None
 
     def error(self, account_number, message):
         self.accounts.add(account_number)
-        self.logfile.write('{0}: {1}\n'.format(account_number, message))
+        line = '{0}: {1}\n'.format(account_number, message)
+        if self._captured is not None:
+            self._captured.append(line)
+        else:
+            self.logfile.write(line)
+
+    def capture(self):
+        'Как Writer.capture(): ошибки копятся в памяти до release().'
+        self._captured = []
+
+    def release(self):
+        lines, self._captured = self._captured, None
+        return lines
 
     def no_group(self, account_number, group_name):
         self.groups.add(group_name)
@@ -147,12 +442,19 @@ class ErrorsCounter:
 
 
 class BillingDataExporter:
-    def __init__(self, profile_file, accs_list=None, accs_skip=None, tariffs_history_from=None):
+    def __init__(self, profile_file, accs_list=None, accs_skip=None, tariffs_history_from=None,
+                 bulk_size=None):
+        self.profile_file = profile_file
+        self.profile_name = os.path.splitext(os.path.basename(profile_file))[0]
         self.profile = mapper.load_profile(profile_file)
-        self.db = db.Engine(self.profile['sql-dialect'], self.profile['connection-uri'])
-        self.exporter = Exporter(self.profile.get('export-data-dir', 'export_data/'))
-
-        self.db.tpl_env.globals['filters'] = {}
+        self.db = db.Engine(self.profile['sql-dialect'], self.profile['connection-uri'],
+                            keys_chunk_size=self.profile.get('keys-chunk-size', 1000),
+                            fetch_batch_size=self.profile.get('fetch-batch-size', 10000))
+        self.exporter = Exporter(self.profile.get('export-data-dir', 'export_data/'),
+                                 compression.Compression.from_profile(self.profile),
+                                 staging.StagingDatabase.from_profile(self.profile))
+
+        self.filters = {}
         for filter in self.profile.get('filters', []):
             self.add_filter(**filter)
 
@@ -161,9 +463,31 @@ class BillingDataExporter:
         self._accs_skip = set(accs_skip or [])
         self._tariffs_history_from = tariffs_history_from
         self._dayly_write_off_fix = self.profile.get('dayly-write-off-fix', False)
+        self.ip_pools = IpPoolResolver(self.profile.get('static-ip-pools', {}))
+        # размер пачки лицевых для пакетной выборки данных, 0 - по одному
+        self._bulk_size = bulk_size or self.profile.get('bulk-size', 0)
+        # через сколько лицевых сохранять контрольную точку, 0 - не сохранять
+        self._checkpoint_every = self.profile.get('checkpoint-every', 1000)
+        if self.exporter.staging is not None:
+            # продолжение выгрузки обрезает файлы, таблицы так не обрезать
+            self._checkpoint_every = 0
+        # ограничение памяти на предзагрузки, сверх него - временные файлы
+        self._memory_budget = preload.parse_size(self.profile.get('memory-budget'))
+        # сколько пачек лицевых выбирать заранее, 0 - выгрузка без потоков
+        self._pipeline_depth = self.profile.get('pipeline-depth', 2)
 
         self._conn_id_next = 1
+        self._conn_id_placeholders = False
+        self._prev_conn_file = None
         self.sitename_to_usrconnid_map = {}
+        # индекс USRCONNID предыдущей выгрузки, в него дописываются новые
+        self._conn_id_store = None
+        # отпечатки лицевых полной выгрузки при выгрузке изменений
+        self._prev_fingerprints = None
+        # сохранять отпечатки лицевых для последующей выгрузки изменений
+        self._save_fingerprints = False
+        self.stats = None
+        self._stats_file = None
 
         # какие данные выгружать
         self.export_items = set(['accounts', 'attributes', 'connections', 'balances', 'payments'])
@@ -172,14 +496,54 @@ class BillingDataExporter:
         self.export_items = set(items)
 
     def load_sitename_to_usrconnid_map(self, filename):
-        self.sitename_to_usrconnid_map = load_sitename_to_usrconnid_map(filename)
-        self._conn_id_next = max(self.sitename_to_usrconnid_map.values()) + 1
-
+        self._prev_conn_file = filename
+        self._conn_id_store = self.sitename_to_usrconnid_map = connids.ConnIdStore(filename)
+        if self._conn_id_store.hwm is not None:
+            self._conn_id_next = self._conn_id_store.hwm + 1
+
+    def enable_stats(self, stats_file=None):
+        '''Включает сбор статистики по запросам, функциям выгрузки и файлам.
+
+        Статистика сохраняется в stats_file, если он задан, а не в каталог
+        выгрузки: туда попадают только файлы для Онимы.
+        '''
+        self.stats = self.db.stats = stats.Stats()
+        self._stats_file = stats_file
+
+    def save_stats(self):
+        self.stats.report()
+        if self._stats_file:
+            self.stats.save(self._stats_file)
+
+    def enable_fingerprints(self):
+        self._save_fingerprints = True
+
+    def start_delta(self):
+        '''Переключает на выгрузку только изменившихся лицевых.
+
+        Отпечатки лицевых сравниваются с полной выгрузкой в export-data-dir,
+        изменившиеся лицевые пишутся в её подкаталог delta/, USRCONNID берутся
+        из conn.csv полной выгрузки.
+        '''
+        base = self.exporter
+        if base.staging is not None:
+            raise Exception('Delta export is not supported with staging output')
+        if not os.path.exists(base.fingerprints_path()):
+            raise Exception('No account fingerprints for {0}, run the full export with --fingerprints'.format(
+                base.data_dir))
+        self._prev_fingerprints = delta.load_fingerprints(base.fingerprints_path(), self.profile_name)
+        conn_file = base.path('connections-list')
+        if os.path.exists(conn_file) and os.path.getsize(conn_file):
+            self.load_sitename_to_usrconnid_map(conn_file)
+        self.exporter = Exporter(os.path.join(base.data_dir, delta.DELTA_DIR), base.compression)
+
+    # Фильтры передаются в шаблоны при каждом запросе, а не глобально
+    # в db.Engine, чтобы профили могли работать с общим подключением к БД.
     def add_filter(self, name, **filter_params):
-        self.db.tpl_env.globals['filters'][name] = filter_params
+        self.filters[name] = filter_params
 
     def reset_filters(self):
-        self.db.tpl_env.globals['filters'] = {}
+        self.filters = {}
 
     def gen_conn_id(self, conn_name):
         try:
@@ -187,6 +551,10 @@ class BillingDataExporter:
         except KeyError:
             conn_id = self._conn_id_next
             self._conn_id_next += 1
+            if self._conn_id_placeholders:
+                return CONN_ID_PLACEHOLDER.format(conn_id)
+            if self._conn_id_store is not None:
+                self._conn_id_store.add(conn_name, conn_id)
             return conn_id
 
     def get_onyma_gid(self, name):
@@ -199,13 +567,7 @@ class BillingDataExporter:
         return self.profile['domain-id']
 
     def get_onyma_static_ip_pool(self, ip):
-        for name, pool_addr in self.profile['static-ip-pools'].items():
-            pool = ip_network(pool_addr)
-            if isinstance(ip, ipaddress.IPv4Network) and ip.overlaps(pool):
-                return name
-            elif ip in pool:
-                return name
-        return None
+        return self.ip_pools.resolve(ip)
 
     def get_onyma_utid(self, name):
         return mapper.maps['onyma']['account-types'][name]
@@ -242,6 +604,27 @@ class BillingDataExporter:
             with self.exporter.open(name, mode='w') as file:
                 pass
                 # file.write_header()
+        # отпечатки относятся к удалённой выгрузке
+        if os.path.exists(self.exporter.fingerprints_path()):
+            os.remove(self.exporter.fingerprints_path())
+        self.exporter.remove_stale_files()
+        removed_file = os.path.join(self.exporter.data_dir, delta.REMOVED_FILE)
+        if os.path.exists(removed_file):
+            os.remove(removed_file)
+        # контрольные точки относятся к удалённым данным
+        for filename in os.listdir(self.exporter.data_dir):
+            if filename.startswith('.checkpoint-'):
+                os.remove(os.path.join(self.exporter.data_dir, filename))
+
+    def checkpoint_journal(self):
+        return CheckpointJournal(self.exporter.data_dir, self.profile_name)
+
+    def write_removed_accounts(self, accounts):
+        'Список лицевых полной выгрузки, которых больше нет среди выгружаемых.'
+        removed = set(self._prev_fingerprints).difference(accounts)
+        with open(os.path.join(self.exporter.data_dir, delta.REMOVED_FILE), 'a') as f:
+            for acc_num in sorted(removed):
+                f.write('{0};{1};\n'.format(acc_num, self.profile_name))
 
     def export_tariffs(self):
         with self.db.connect() as c, \
@@ -277,14 +660,54 @@ class BillingDataExporter:
                     PRICE=price
                 )
 
-            print('loading internet tariffs...')
+            # политики тарифов загружаются одним запросом и группируются по тарифу
+            policies = preload.GroupedRecords('tariff policies').build()
+            if 'tariffs-policy-map' in self.profile:
+                print('loading tariff policies...')
+                policies = preload.load_grouped(
+                    'tariff policies', c.stream('tariff-policy.sql'),
+                    lambda r: r.tariff_id, lambda r: preload.intern_str(r.value))
+                print(policies.report())
+
+            def write_policies(r):
+                for value in policies[r.id]:
+                    policy_name = value.replace('ssg-account-info=A', '')
+                    policy_id = 0
+                    try:
+                        policy_id = self.profile['tariffs-policy-map'][policy_name]
+                    except KeyError:
+                        print('WARNING: no mapping for policy: {0}'.format(policy_name))
+
+                    t_pol.write(
+                        START_DATE=r.create_date.strftime('%d.%m.%Y'),
+                        OLD_TMID=r.id,
+                        NAME=r.name,
+                        TMID='',
+                        POLID=policy_id
+                    )
+
             # регулярное выражение для определения ADSL тарифов
             adsl_re = re.compile(self.profile.get('tariffs-adsl-match-re', '.*ADSL.*'))
-            for r in c.execute('tariffs.sql'):
+            # шаблон тарифа и услуга абонентской платы для остальных видов услуг
+            family_ids = {
+                'phone': ('phone', 'fee-phone-number'),
+                'ctv': ('ctv', 'fee-ctv'),
+                'npl': ('npl', 'fee-channel'),
+            }
+
+            print('loading tariffs...')
+            counts = defaultdict(int)
+            # Все виды тарифов выбираются одним запросом (поле family)
+            # и пишутся по мере чтения результата.
+            for r in c.stream('tariffs.sql', filters=self.filters):
+                counts[r.family] += 1
+                if r.family != 'internet':
+                    tpl_name, service_name = family_ids[r.family]
+                    write_tariff(r, self.get_onyma_tpl_tarrif_id(tpl_name), self.get_onyma_service_id(service_name))
+                    continue
+
                 if r.forcompany:
                     onyma_tpl_id = self.get_onyma_tpl_tarrif_id('internet-company')
-                elif r.forperson:
-                    onyma_tpl_id = self.get_onyma_tpl_tarrif_id('internet-person')
                 else:
                     onyma_tpl_id = self.get_onyma_tpl_tarrif_id('internet-person')
 
@@ -294,46 +717,10 @@ class BillingDataExporter:
                     service_id = self.get_onyma_service_id('fee-internet')
 
                 write_tariff(r, onyma_tpl_id, service_id)
+                write_policies(r)
 
-                if 'tariffs-policy-map' in self.profile:
-                    for p in c.execute('tariff-policy.sql', tariff_id=r.id):
-                        policy_name = p.value.replace('ssg-account-info=A', '')
-                        policy_id = 0
-                        try:
-                            policy_id = self.profile['tariffs-policy-map'][policy_name]
-                        except KeyError:
-                            print('WARNING: no mapping for policy: {0}'.format(policy_name))
-
-                        t_pol.write(
-                            START_DATE=r.create_date.strftime('%d.%m.%Y'),
-                            OLD_TMID=r.id,
-                            NAME=r.name,
-                            TMID='',
-                            POLID=policy_id
-                        )
-
-            print('loading phone tariffs...')
-            for r in c.execute('tariffs.sql', phone_tariffs=True):
-                write_tariff(
-                    r,
-                    self.get_onyma_tpl_tarrif_id('phone'),
-                    self.get_onyma_service_id('fee-phone-number')
-                )
-
-            print('loading ctv tariffs...')
-            for r in c.execute('tariffs.sql', ctv_tariffs=True):
-                write_tariff(
-                    r,
-                    self.get_onyma_tpl_tarrif_id('ctv'),
-                    self.get_onyma_service_id('fee-ctv')
-                )
-            print('loading npl tariffs...')
-            for r in c.execute('tariffs.sql', npl_tariffs=True):
-                write_tariff(
-                    r,
-                    self.get_onyma_tpl_tarrif_id('npl'),
-                    self.get_onyma_service_id('fee-channel')
-                )
+            print('tariffs: {0}'.format(', '.join(
+                '{0} {1}'.format(family, counts[family]) for family in ('internet', 'phone', 'ctv', 'npl'))))
             print('done!')
 
     def export_srv_credit_tariffs(self):
@@ -382,10 +769,236 @@ class BillingDataExporter:
                     for idx, val in enumerate(values, start=1):
                         f_cp.write(conn_id, key, val, idx)
 
+    def list_accounts(self):
+        'Номера лицевых для выгрузки с учётом фильтров, пропусков и ограничения.'
+        if self._accs_list:
+            accounts = self._accs_list
+        else:
+            with self.db.connect() as c:
+                accounts = [r.account_number for r in c.stream('accounts-list.sql', filters=self.filters)]
+        accounts = [acc_num for acc_num in accounts if acc_num not in self._accs_skip]
+        if self._memory_budget:
+            # в том же порядке, что и export_one_by_one, до ограничения limit
+            accounts = sorted(accounts)
+        if self._limit:
+            accounts = accounts[:self._limit]
+        return accounts
+
+    def export_parallel(self, workers, errors_file='errors.log'):
+        '''Выгрузка в несколько процессов.
+
+        Список лицевых делится на непрерывные части, каждая выгружается
+        отдельным процессом в свой временный каталог, затем части сливаются
+        по порядку. Новые USRCONNID в частях записываются метками и при
+        слиянии заменяются на номера, которые получились бы при выгрузке
+        в один процесс, так что результат совпадает побайтно. Предзагрузки
+        каждый процесс загружает один раз, а не для каждой части.
+        '''
+        if self.exporter.staging is not None:
+            raise Exception('Parallel export is not supported with staging output')
+        print('loading accounts...')
+        accounts = self.list_accounts()
+        shards_count = max(1, min(len(accounts), workers * 4))
+        shard_size = -(-len(accounts) // shards_count)
+        options = {
+            'tariffs_history_from': self._tariffs_history_from,
+            'bulk_size': self._bulk_size,
+            'export_items': self.export_items,
+            'prev_conn_file': self._prev_conn_file,
+            'stats': self.stats is not None,
+            'fingerprints': self._save_fingerprints,
+        }
+        # подключения родительского процесса не должны достаться дочерним
+        self.db.db.dispose()
+
+        if self.stats is not None:
+            self.stats.start()
+        tmp_dir = tempfile.mkdtemp(prefix='.shards-', dir=self.exporter.data_dir)
+        try:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                     initargs=(self.profile_file, options, tmp_dir)) as pool, \
+                    open(errors_file, 'w') as errlog:
+                futures = []
+                for idx in range(shards_count):
+                    shard_dir = os.path.join(tmp_dir, str(idx))
+                    os.makedirs(shard_dir)
+                    shard = accounts[idx * shard_size:(idx + 1) * shard_size]
+                    prev_fingerprints = None
+                    if self._prev_fingerprints is not None:
+                        prev_fingerprints = {acc_num: self._prev_fingerprints[acc_num]
+                                             for acc_num in shard if acc_num in self._prev_fingerprints}
+                    futures.append((shard_dir, pool.submit(
+                        _export_shard, self.profile_file, options, shard_dir, shard, prev_fingerprints)))
+
+                ok = True
+                for idx, (shard_dir, future) in enumerate(futures):
+                    conn_id_count, ok, shard_stats = future.result()
+                    if shard_stats is not None:
+                        self.stats.merge(stats.Stats.from_dict(shard_stats))
+                    self._merge_shard(shard_dir, errlog)
+                    self._conn_id_next += conn_id_count
+                    if self._conn_id_store is not None:
+                        self._conn_id_store.commit(self._conn_id_next)
+                    shutil.rmtree(shard_dir)
+                    print('shards merged: {0}/{1}'.format(idx + 1, shards_count), end='\r')
+                    if not ok:
+                        # как и при выгрузке в один процесс, всё после ошибки отбрасывается
+                        print('\nexport failed in shard {0}'.format(idx))
+                        for _, f in futures[idx + 1:]:
+                            f.cancel()
+                        break
+            # предупреждения предзагрузок одинаковы во всех процессах
+            for line in dict.fromkeys(line for log_file in sorted(glob.glob(os.path.join(tmp_dir, 'worker-*.log')))
+                                      for line in diagnostics(log_file)):
+                print(line)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        if ok and self._prev_fingerprints is not None and not self._accs_list and not self._limit:
+            self.write_removed_accounts(accounts)
+        if self.stats is not None:
+            self.stats.stop()
+            self.save_stats()
+        print('\ndone!')
+
+    def _merge_shard(self, shard_dir, errlog):
+        conn_id_base = self._conn_id_next
+
+        def conn_id(m):
+            return str(conn_id_base + int(m.group(1)))
+
+        for name, (filename, format) in maps['export-files'].items():
+            src = os.path.join(shard_dir, filename)
+            if not os.path.exists(src):
+                continue
+            fieldnames = format.split(';')
+            # новые USRCONNID части - в индекс, как при выгрузке в один процесс
+            add_conn_ids = name == 'connections-list' and self._conn_id_store is not None
+            with open(src) as fin, self.exporter.open_file(name) as fout:
+                if 'USRCONNID' not in fieldnames:
+                    shutil.copyfileobj(fin, fout)
+                    continue
+                tail = ''
+                for block in iter(lambda: fin.read(1 << 20), ''):
+                    # метки не содержат перевода строки, режем блок по последнему
+                    block, sep, rest = (tail + block).rpartition('\n')
+                    tail = rest
+                    block = CONN_ID_PLACEHOLDER_RE.sub(conn_id, block + sep)
+                    fout.write(block)
+                    if add_conn_ids:
+                        self._add_conn_ids(block, fieldnames, conn_id_base)
+                tail = CONN_ID_PLACEHOLDER_RE.sub(conn_id, tail)
+                fout.write(tail)
+                if add_conn_ids:
+                    self._add_conn_ids(tail, fieldnames, conn_id_base)
+
+        for line in diagnostics(os.path.join(shard_dir, SHARD_LOG)):
+            print(line)
+        with open(os.path.join(shard_dir, 'errors.log')) as fin:
+            shutil.copyfileobj(fin, errlog)
+        if self._save_fingerprints:
+            with open(os.path.join(shard_dir, delta.FINGERPRINTS_FILE)) as fin, \
+                    open(self.exporter.fingerprints_path(), 'a') as fout:
+                shutil.copyfileobj(fin, fout)
+
+    def _add_conn_ids(self, text, fieldnames, conn_id_base):
+        '''Добавляет в индекс USRCONNID подключений части не меньше conn_id_base:
+        все меньшие были известны до выгрузки.'''
+        sitename_idx = fieldnames.index('SITENAME')
+        usrconnid_idx = fieldnames.index('USRCONNID')
+        for row in csv.reader(text.splitlines(), delimiter=';'):
+            conn_id = int(row[usrconnid_idx])
+            if conn_id >= conn_id_base:
+                self._conn_id_store.add(row[sitename_idx], conn_id)
+
+    def load_preloads(self, c):
+        '''Данные, которые загружаются для всей базы сразу, а не по лицевым.
+
+        От фильтров профиля не зависят, так что профили с общей базой могут
+        использовать одни и те же предзагрузки (если они не сброшены во
+        временные файлы по memory-budget).
+        '''
+        budget = None
+        if self._memory_budget:
+            budget = preload.MemoryBudget(self._memory_budget)
+
+        # у строк без номера лицевого ключ пустой, они ни с чем не сливаются
+        def account_number_key(r):
+            return r.account_number or ''
+
+        print('loading phone number pools...')
+        phone_pools = PhoneNumberPools()
+        for r in c.stream('phone-number-pools.sql'):
+            phone_pools.add(r.start_ani, r.end_ani, r.zone_code, r.comments)
+        phone_pools.build()
+        for a, b in phone_pools.overlaps:
+            print('WARNING: phone number pools overlap: {0}-{1} ({2}) and {3}-{4} ({5})'.format(
+                a.start_ani, a.end_ani, a.comments, b.start_ani, b.end_ani, b.comments))
+        print('phone number pools: {0}, overlaps: {1}, gaps: {2}'.format(
+            len(phone_pools.pools), len(phone_pools.overlaps), len(phone_pools.gaps)))
+
+        print('loading ppoe logins for iptv...')
+        iptv_ppoe_logins = preload.load_grouped(
+            'iptv ppoe logins', c.stream('iptv-ppoe-logins.sql'),
+            lambda r: r.account_id, preload.iptv_login, budget, account_number_key)
+        print(iptv_ppoe_logins.report())
+
+        print('preload promised payments...')
+        promised_payments = preload.load_grouped(
+            'promised payments', c.stream('account-active-promised-paymens.sql'),
+            lambda r: r.account_number, preload.promised_payment, budget, account_number_key)
+        print(promised_payments.report())
+
+        print('preload periodic services...')
+        internet_periodic_services = preload.load_grouped(
+            'periodic services', c.stream('service-for-internet.sql'),
+            lambda r: r.conn_id, preload.periodic_service, budget, account_number_key)
+        print(internet_periodic_services.report())
+
+        print('preload credit services...')
+        credit_services = preload.load_grouped(
+            'credit services', c.stream('service-with-credit.sql'),
+            lambda r: r.conn_id, preload.credit_service, budget, account_number_key)
+        print(credit_services.report())
+
+        return preload.Preloads(phone_pools, iptv_ppoe_logins, promised_payments,
+                                internet_periodic_services, credit_services)
+
     # Большущая страшная функция для выгрузки всего, что можно
-    def export_one_by_one(self, debug=False):
+    def export_one_by_one(self, accounts=None, errors_file='errors.log', resume=False, preloads=None,
+                          source=None):
+        '''Выгрузка лицевых профиля.
+
+        source - пачки лицевых с уже выбранными данными (см.
+        multiprofile.export_partitioned), тогда accounts - все лицевые профиля,
+        а source выдаёт их по порядку.
+        '''
+        # выгружаются все лицевые профиля, а не заданный список
+        all_accounts = (accounts is None or source is not None) and not self._accs_list and not self._limit
+        journal = None
+        state = None
+        if self._checkpoint_every:
+            journal = self.checkpoint_journal()
+        if resume and (journal is None or not journal.exists()):
+            print('no checkpoint found, starting from the beginning')
+        elif resume:
+            state = journal.load()
+            if state['finished']:
+                print('export already finished')
+                return True
+            # всё, что записано после контрольной точки, будет выгружено заново
+            journal.truncate_files(state)
+            if os.path.abspath(self.exporter.fingerprints_path()) in state['files']:
+                # отпечатки сохранялись с начала выгрузки, значит и дальше
+                self._save_fingerprints = True
+            accounts = journal.load_accounts()
+            self._conn_id_next = state['conn_id_next']
+            if self._conn_id_store is not None and self._conn_id_store.hwm is not None:
+                # индекс мог успеть сохранить номера после контрольной точки
+                self._conn_id_next = max(self._conn_id_next, self._conn_id_store.hwm + 1)
+            print('resuming after account {0}'.format(state['last_account']))
+
         with self.db.connect() as c, \
-                open('errors.log', 'w', 1) as errlog, \
+                open(errors_file, 'a' if state else 'w', 1) as errlog, \
                 self.exporter.open('accounts-list') as f_acc, \
                 self.exporter.open_account_attrs() as f_attr, \
                 self.exporter.open('connections-names') as f_cn, \
@@ -396,21 +1009,37 @@ class BillingDataExporter:
                 self.exporter.open('tariffs-history') as f_tariffs_history, \
                 self.exporter.open('promised-payments') as f_promised_payments, \
                 self.exporter.open('balances-list') as f_bl, \
-                self.exporter.open('payments-list') as f_pay:
+                self.exporter.open('payments-list') as f_pay, \
+                (self.exporter.open_fingerprints() if self._save_fingerprints else nullcontext()) as f_fp:
 
             _errors = ErrorsCounter(errlog)
+            # исходные значения лицевого для отпечатка вместо строк наборов,
+            # зависящих от месяца выгрузки (delta.MONTH_RELATIVE_FILES)
+            fingerprint_sources = []
+
+            if self._bulk_size:
+                queries = fetch.BulkAccountQueries(
+                    c, self.export_items,
+                    tariffs_history_from=self._tariffs_history_from,
+                    discounts=bool(self.profile.get('discounts-service-mapping')))
+            else:
+                queries = fetch.AccountQueries(c)
+
+            timed = self.stats.timed if self.stats is not None else lambda func: func
+            prefetch = timed(queries.prefetch)
 
             # считает предпологаемое количество выгружаемых лицевых с учётом фильтров
             def estimate_count(sql_file):
-                r = c.execute(sql_file, estimate_count=True).fetchone()
+                r = c.execute(sql_file, estimate_count=True, filters=self.filters).fetchone()
                 return r.count
 
             def norm_phone_number(number_str):
                 return re.sub('[^0-9]', '', str(number_str))
 
             # выгружает данные для одного лицевого
+            @timed
             def export_one(acc_num):
-                r = c.execute('account-base-info.sql', account_number=acc_num).fetchone()
+                r = queries.base_info(acc_num)
                 if not r:
                     _errors.error(acc_num, 'no such account')
                     return
@@ -453,10 +1082,8 @@ class BillingDataExporter:
 
                 balance_correction = 0
                 if 'connections' in self.export_items:
-                    balance_correction += export_connections(acc_num, 'lk')
-                    balance_correction += export_connections(acc_num, 'internet')
-                    balance_correction += export_connections(acc_num, 'ctv')
-                    balance_correction += export_connections(acc_num, 'npl')
+                    for c_type in fetch.CONNECTION_TYPES:
+                        balance_correction += export_connections(acc_num, c_type)
 
                 if 'balances' in self.export_items:
                     export_balance(r, balance_correction)
@@ -465,8 +1092,9 @@ class BillingDataExporter:
 
                 return True
 
+            @timed
             def export_person_info(acc_num):
-                r = c.execute('account-person-info.sql', account_number=acc_num).fetchone()
+                r = queries.person_info(acc_num)
                 if not r:
                     _errors.error(acc_num, 'export_person_info')
                     return
@@ -492,8 +1120,9 @@ class BillingDataExporter:
                 ))
                 f_attr.write(r.id, passport, 'passport')
 
+            @timed
             def export_company_info(acc_num):
-                r = c.execute('account-company-info.sql', account_number=acc_num).fetchone()
+                r = queries.company_info(acc_num)
                 if not r:
                     _errors.error(acc_num, 'export_company_info')
                     return
@@ -511,10 +1140,11 @@ class BillingDataExporter:
                 f_attr.write(r.id, r.okpo, 'okpo')
                 f_attr.write(r.id, r.eisup, 'eisup')
 
+            @timed
             def export_contacts(acc_num):
                 contacts = defaultdict(list)
                 account_id = None
-                for r in c.execute('account-contacts.sql', account_number=acc_num):
+                for r in queries.contacts(acc_num):
                     account_id = r. id
                     if r.type_name == 'extra-email':
                         contacts[r.type_name].append(r.info)
@@ -523,8 +1153,9 @@ class BillingDataExporter:
                 for attr_name, attr_values in contacts.items():
                     f_attr.write(r.id, attr_values, attr_name)
 
+            @timed
             def export_addresses(acc_num, acc_type):
-                for r in c.execute('account-addresses.sql', account_number=acc_num, acc_type=acc_type):
+                for r in queries.addresses(acc_num, acc_type):
                     f_attr.write(r.id, r.zip, 'zip', r.address_type)
                     f_attr.write(r.id, r.state, 'state', r.address_type)
                     f_attr.write(r.id, r.city, 'city', r.address_type)
@@ -537,17 +1168,15 @@ class BillingDataExporter:
                     # В ониме нет (пока?) таких атрибутов
                     #f_attr.write(r.id, r.postbox, None, r.address_type)
 
+            @timed
             def export_connections(acc_num, c_type):
                 balance_correction = 0
                 now = datetime.now()
                 days_in_month = calendar.monthrange(now.year, now.month)[1]
-                sql_to_exec = 'connections.sql'
-
-                if c_type == 'lk':
-                    # Для личного кабинета совсем другой, более простой, запрос
-                    sql_to_exec = 'connections-lk.sql'
 
-                res = c.execute(sql_to_exec, c_type=c_type, account_number=acc_num).fetchall()
+                res = queries.connections(acc_num, c_type)
+                if c_type == 'phone':
+                    pools = phone_pools.find_many([r.phone_number for r in res])
 
                 for idx in range(len(res)):
                     r = res[idx]
@@ -592,6 +1221,7 @@ class BillingDataExporter:
                     elif c_type == 'internet':
                         if self._dayly_write_off_fix and r.status == 'active':
                             balance_correction = - r.tariff_fee / days_in_month
+                            fingerprint_sources.append(('write-off', r.conn_id, r.tariff_fee))
                         if r.conn_type == 'ipoe':
                             resource_id = self.get_onyma_resource_id('internet-connection-net')
                         else:
@@ -601,7 +1231,7 @@ class BillingDataExporter:
                         export_internet_services(r, conn_name, tariff_id, usrconnid)
                     elif c_type == 'phone':
                         resource_id = self.get_onyma_resource_id('phone-number')
-                        export_connections_phone_props(r, usrconnid)
+                        export_connections_phone_props(r, usrconnid, pools[idx])
                     elif c_type == 'ctv':
                         resource_id = self.get_onyma_resource_id('ctv-connection')
                         shared = 1
@@ -642,7 +1272,7 @@ class BillingDataExporter:
                     export_service_credit(r, conn_name, tariff_id, usrconnid)
 
                     if self._tariffs_history_from and c_type != 'lk':
-                        for rr in c.execute('tariffs-history.sql', conn_id=r.conn_id, date_from=self._tariffs_history_from):
+                        for rr in queries.tariffs_history(r.conn_id, self._tariffs_history_from):
                             date_now = datetime.now().strftime('%d.%m.%Y %H:%M')
                             date_start = rr.start_date.strftime('%d.%m.%Y %H:%M')
                             tariff_id = self.get_onyma_tariff_id(rr.tariff_id)
@@ -658,7 +1288,7 @@ class BillingDataExporter:
                             )
 
                     if self.profile['discounts-service-mapping']:
-                        for rr in c.execute('discounts.sql', conn_id=r.conn_id):
+                        for rr in queries.discounts(r.conn_id):
                             onyma_srvid = self.profile['discounts-service-mapping'].get(rr.discount_id)
                             if onyma_srvid is None:
                                 _errors.error(acc_num, 'no discount map for {0}'.format(rr.discount_id))
@@ -678,6 +1308,7 @@ class BillingDataExporter:
 
                 return balance_correction
 
+            @timed
             def export_connections_status_history(conn_id, usrconnid, login=''):
                 # пришлось сюда засунуть сохранение статусов объекта авторизации
                 tz = timezone(timedelta(hours=9))  # TODO: make profile option
@@ -695,7 +1326,8 @@ class BillingDataExporter:
                         USRCONNID=usrconnid
                     )
 
-                for h in c.execute('connection-statuses.sql', conn_id=conn_id):
+                for h in queries.connection_statuses(conn_id):
+                    fingerprint_sources.append(('status', conn_id, h.start_date, h.status))
                     # Тут мы отсекаем все статусы до начала текущего месяца
                     # попутно сохраняя последний из них
                     if h.start_date < first_day:
@@ -709,10 +1341,12 @@ class BillingDataExporter:
                 if last_status is not None:
                     write_status(first_day, last_status)
 
+            @timed
             def export_connections_ctv_props(r, conn_id):
                 for login in iptv_ppoe_logins[r.account_id]:
                     f_cp.write(conn_id, 'internet-login', login)
 
+            @timed
             def export_connections_internet_props(r, conn_id):
                 if r.conn_type == 'pppoe':
                     f_cp.write(conn_id, 'internet-login', r.login)
@@ -736,7 +1370,7 @@ class BillingDataExporter:
                             f_cp.write(conn_id, 0, res_id, 10)
 
                             ip_addr = ip_address(ip)
-                            pool_name = self.get_onyma_static_ip_pool(ip_addr)
+                            pool_name = self.ip_pools.resolve_range(ip, ip)
                             if not pool_name:
                                 _errors.error(r.account_number, 'no ip pool for {0}'.format(ip_addr))
                             f_cp.write(conn_id, 'static-ip-pool-name', pool_name)
@@ -749,10 +1383,9 @@ class BillingDataExporter:
                     if r.start_ip == r.end_ip:
                         ip_addr = ip_address(r.start_ip)
                         network = str(ip_addr) + '/32'
-                        pool_name = self.get_onyma_static_ip_pool(ip_addr)
                     else:
                         network = two_ip_to_net(r.start_ip, r.end_ip)
-                        pool_name = self.get_onyma_static_ip_pool(network)
+                    pool_name = self.ip_pools.resolve_range(r.start_ip, r.end_ip)
 
                     if not pool_name:
                         _errors.error(r.account_number, 'no ip pool for {0}'.format(str(network)))
@@ -763,21 +1396,26 @@ class BillingDataExporter:
                 else:
                     print('OH! Shit! unexpected connection type for account: ' + r.account_number)
 
+            @timed
             def export_connections_lk_props(r, conn_id):
                 f_cp.write(conn_id, 'lk-login', r.login)
                 f_cp.write(conn_id, 'lk-password', r.password)
                 f_cp.write(conn_id, 'cypher', 'MD5MD5')  # два раза MD5
 
-            def export_connections_phone_props(r, conn_id):
-                p = phone_pools.find(r.phone_number)
-                series = '{0}/{1}@{2}'.format(p.start_ani, p.size, p.zone_code)
+            @timed
+            def export_connections_phone_props(r, conn_id, p):
                 ats_name = self.get_onyma_ats_name(r.ats_name)
 
                 f_cp.write(conn_id, 'phone-ats-name', ats_name)
-                f_cp.write(conn_id, 'phone-zone-code', p.zone_code)
-                f_cp.write(conn_id, 'phone-series', series)
+                if p is None:
+                    _errors.error(r.account_number, 'no phone pool for {0}'.format(r.phone_number))
+                else:
+                    series = '{0}/{1}@{2}'.format(p.start_ani, p.size, p.zone_code)
+                    f_cp.write(conn_id, 'phone-zone-code', p.zone_code)
+                    f_cp.write(conn_id, 'phone-series', series)
                 f_cp.write(conn_id, 'phone-number', r.phone_number)
 
+            @timed
             def export_internet_services(r, sitename, tmid, usrconnid):
                 "Экспорт периодических услуг на объектах авторизации интернета"
                 if r.conn_id not in internet_periodic_services:
@@ -804,6 +1442,7 @@ class BillingDataExporter:
                         SERV_ALIAS=srv.name
                     )
 
+            @timed
             def export_service_credit(r, sitename, tmid, usrconnid):
                 if r.conn_id in credit_services:
                     for item in credit_services[r.conn_id]:
@@ -831,6 +1470,7 @@ class BillingDataExporter:
                             ENDDATE=end_date
                         )
 
+            @timed
             def export_balance(r, balance_correction):
                 promised = Decimal('0.00')
                 for pp in promised_payments[r.account_number]:
@@ -843,6 +1483,7 @@ class BillingDataExporter:
                         ENDDATE=pp.expire_date.strftime('%d.%m.%Y %H:%M:%S'),
                         DATE=date_now
                     )
+                fingerprint_sources.append(('balance', r.child_balance))
                 balance = Decimal(r.child_balance) - promised + Decimal(balance_correction)
                 date = r.now.strftime('%d.%m.%Y %H:%M:%S')
                 f_bl.write(
@@ -851,8 +1492,9 @@ class BillingDataExporter:
                     BALANCE=balance
                 )
 
+            @timed
             def export_payments(acc_num):
-                for r in c.execute('account-payments.sql', account_number=acc_num):
+                for r in queries.payments(acc_num):
                     date = r.payment_date.strftime('%d.%m.%Y %H:%M:%S')
                     f_pay.write(
                         DOGCODE=r.account_number,
@@ -860,73 +1502,186 @@ class BillingDataExporter:
                         SUM=r.sum
                     )
 
-            print('loading phone number pools...')
-            phone_pools = PhoneNumberPools()
-            for r in c.execute('phone-number-pools.sql'):
-                phone_pools.add(r.start_ani, r.end_ani, r.zone_code, r.comments)
-
-            print('loading ppoe logins for iptv...')
-            iptv_ppoe_logins = defaultdict(list)
-            for r in c.execute('iptv-ppoe-logins.sql'):
-                iptv_ppoe_logins[r.account_id].append(r.login)
+            # переданные предзагрузки нужны и после выгрузки, закрывает их владелец
+            own_preloads = preloads is None
+            if own_preloads:
+                preloads = self.load_preloads(c)
+            phone_pools, iptv_ppoe_logins, promised_payments, internet_periodic_services, credit_services = preloads
 
-            if self._accs_list:
+            if accounts is not None:
+                cnt_estimate = len(accounts)
+            elif self._accs_list:
                 cnt_estimate = len(self._accs_list)
             else:
                 print('counting accounts...')
                 cnt_estimate = estimate_count('accounts-list.sql')
 
-            print('preload promised payments...')
-            promised_payments = defaultdict(list)
-            for r in c.execute('account-active-promised-paymens.sql'):
-                promised_payments[r.account_number].append(r)
-
-            if self._accs_list:
+            if accounts is None and self._accs_list:
                 accounts = self._accs_list
-            else:
+            elif accounts is None:
                 accounts = []
                 print('loading accounts...')
-                for r in c.execute('accounts-list.sql'):
+                for r in c.stream('accounts-list.sql', filters=self.filters):
                     accounts.append(r.account_number)
 
-            print('preload periodic services...')
-            internet_periodic_services = {}
-            for r in c.execute('service-for-internet.sql'):
-                try:
-                    internet_periodic_services[r.conn_id].append(r)
-                except KeyError:
-                    internet_periodic_services[r.conn_id] = [r, ]
-
-            print('preload credit services...')
-            credit_services = {}
-            for r in c.execute('service-with-credit.sql'):
-                try:
-                    credit_services[r.conn_id].append(r)
-                except KeyError:
-                    credit_services[r.conn_id] = [r, ]
-
-            cnt_processed = 0
-            for account_number in accounts:
-                if account_number in self._accs_skip:
-                    continue
-                try:
-                    export_one(account_number)
-                    cnt_processed += 1
-                except Exception:
-                    import traceback
-                    print('')
-                    traceback.print_exc()
-                    # traceback.print_tb(err.__traceback__)
-                    print('account: {0}'.format(account_number))
-                    break
+            # Предзагрузки, сброшенные во временные файлы, читаются слиянием
+            # по номеру лицевого, поэтому лицевые выгружаются по возрастанию
+            # номера. Порядок не зависит от того, пришлось ли что-то
+            # сбрасывать, так что продолжение с контрольной точки не ломается.
+            spilled = [p for p in (iptv_ppoe_logins, promised_payments, internet_periodic_services, credit_services)
+                       if isinstance(p, preload.SpilledGroups)]
+            if self._memory_budget and state is None:
+                accounts = sorted(accounts)
+
+            # Выгрузка идёт конвейером (см. pipeline.Pipeline): в отдельном
+            # потоке выбираются пачки лицевых, в текущем строки лицевого
+            # собираются в памяти, ещё один поток пишет их в файлы. Данные
+            # из БД выбираются заранее только пакетно (bulk-size), иначе
+            # запросы выполняются при разборе лицевого.
+            pipe = pipeline.Pipeline(self._pipeline_depth)
+            chunk_size = self._bulk_size or 1
+
+            def fetch_chunks(start):
+                for idx in range(start, len(accounts), chunk_size):
+                    chunk = [(position, acc_num)
+                             for position, acc_num in enumerate(accounts[idx:idx + chunk_size], idx)
+                             if acc_num not in self._accs_skip]
+                    yield chunk, prefetch([acc_num for _, acc_num in chunk])
+
+            writers = [f_acc, f_attr, f_cn, f_cl, f_chist, f_cp, f_tariffs_personal, f_tariffs_history,
+                       f_promised_payments, f_bl, f_pay]
+            fingerprint_writers = [f_fp] if f_fp is not None else []
+
+            # сохраняет контрольную точку: все лицевые до position записаны полностью
+            def checkpoint(position, conn_id_next, finished=False):
+                if self._conn_id_store is not None:
+                    self._conn_id_store.commit(conn_id_next)
+                files = {os.path.abspath(w.filename): w.sync() for w in writers + fingerprint_writers}
+                files[os.path.abspath(errors_file)] = sync_file(errlog)
+                journal.commit({
+                    'position': position,
+                    'last_account': accounts[position - 1] if position else None,
+                    'processed': cnt_processed,
+                    'conn_id_next': conn_id_next,
+                    'files': files,
+                    'finished': finished,
+                })
+
+            next_position = state['position'] if state else 0
+            cnt_processed = state['processed'] if state else 0
+            conn_id_written = self._conn_id_next
+            if journal is not None and state is None:
+                journal.start(accounts)
+                checkpoint(0, conn_id_written)
+
+            ok = True
+            # Строки лицевого сначала собираются в памяти, по ним считается
+            # отпечаток, если он нужен (--fingerprints или выгрузка изменений).
+            # При выгрузке изменений в файлы попадают только лицевые,
+            # отпечаток которых не совпал с полной выгрузкой.
+            positions = [delta.stable_positions(w) for w in writers]
+            prev_fingerprints = self._prev_fingerprints
+            fingerprints = f_fp is not None or prev_fingerprints is not None
+
+            # пишет собранные строки лицевого, выполняется в потоке записи
+            def write_account(item):
+                nonlocal cnt_processed, next_position, conn_id_written
+                position, account_number, captured, errors, digest, conn_id_next = item
+                errlog.writelines(errors)
+                if f_fp is not None:
+                    f_fp.write(DOGCODE=account_number, PROFILE=self.profile_name, HASH=digest)
+                if prev_fingerprints is None or prev_fingerprints.get(account_number) != digest:
+                    for w, records in zip(writers, captured):
+                        w.write_records(records)
+                cnt_processed += 1
+                next_position = position + 1
+                conn_id_written = conn_id_next
 
                 print('estimate/processed/errors: {0}/{1}/{2}                   '.format(
                     cnt_estimate, cnt_processed, len(_errors.accounts)), end='\r')
 
-                if self._limit and cnt_processed >= self._limit:
-                    break
-
-        print('\ndone!')
+                if journal is not None and cnt_processed % self._checkpoint_every == 0:
+                    checkpoint(next_position, conn_id_written)
+
+            if self.stats is not None:
+                self.stats.start()
+                cnt_started = cnt_processed
+
+            pipe.sink('write', write_account, self._pipeline_depth * chunk_size)
+            transform = pipe.timer('transform')
+            cnt_transformed = cnt_processed
+            account_number = None
+            try:
+                if source is None:
+                    source = fetch_chunks(next_position)
+                for chunk, data in pipe.source('fetch', source):
+                    queries.use(data)
+                    for position, account_number in chunk:
+                        started = time.perf_counter()
+                        for p in spilled:
+                            p.advance(account_number)
+                        _errors.capture()
+                        for w in writers:
+                            w.capture()
+                        del fingerprint_sources[:]
+                        export_one(account_number)
+                        captured = [w.release() for w in writers]
+                        errors = _errors.release()
+                        digest = None
+                        if fingerprints:
+                            digest = delta.fingerprint(zip(positions, captured), fingerprint_sources)
+                        transform.busy += time.perf_counter() - started
+                        transform.items += 1
+                        pipe.put((position, account_number, captured, errors, digest, self._conn_id_next))
+                        cnt_transformed += 1
+                        if self._limit and cnt_transformed >= self._limit:
+                            break
+                    if self._limit and cnt_transformed >= self._limit:
+                        break
+            except Exception:
+                import traceback
+                print('')
+                traceback.print_exc()
+                # traceback.print_tb(err.__traceback__)
+                print('account: {0}'.format(account_number))
+                ok = False
+            finally:
+                _errors.release()
+                for w in writers:
+                    w.release()
+            try:
+                pipe.close()
+            except Exception:
+                import traceback
+                print('')
+                traceback.print_exc()
+                ok = False
+            print('')
+            print(pipe.report())
+
+            if self.stats is not None:
+                self.stats.stop()
+                self.stats.accounts += cnt_processed - cnt_started
+                for w in writers + fingerprint_writers:
+                    self.stats.add_writer(os.path.basename(w.filename), *w.written())
+
+            if own_preloads:
+                for p in spilled:
+                    p.close()
+
+            if ok and prev_fingerprints is not None and all_accounts:
+                self.write_removed_accounts(accounts)
+
+            if journal is not None and ok:
+                checkpoint(next_position, conn_id_written, finished=True)
+            elif self._conn_id_store is not None:
+                self._conn_id_store.commit(conn_id_written)
+
+        print('\nsql cache hits/misses: {hits}/{misses}'.format(**self.db.cache_info()))
+        if self.stats is not None:
+            self.save_stats()
+        print('done!')
+        return ok
 
     def show_base_companies(self):
         format = '{0:<10} {2:<10} {1}'
@@ -0,0 +1,162 @@
+# виды подключений в порядке выгрузки
+CONNECTION_TYPES = ('lk', 'internet', 'ctv', 'npl', 'phone')
+
+
+def connections_template(c_type):
+    if c_type == 'lk':
+        # Для личного кабинета совсем другой, более простой, запрос
+        return 'connections-lk.sql'
+    return 'connections.sql'
+
+
+class AccountQueries:
+    'Данные лицевого счёта, каждый вызов - отдельный запрос к БД.'
+    def __init__(self, connection):
+        self.c = connection
+
+    def prefetch(self, accounts):
+        'Данные пачки лицевых для use(), здесь запросы выполняются по одному при обращении.'
+        return None
+
+    def use(self, data):
+        pass
+
+    def base_info(self, acc_num):
+        return self.c.execute('account-base-info.sql', account_number=acc_num).fetchone()
+
+    def person_info(self, acc_num):
+        return self.c.execute('account-person-info.sql', account_number=acc_num).fetchone()
+
+    def company_info(self, acc_num):
+        return self.c.execute('account-company-info.sql', account_number=acc_num).fetchone()
+
+    def contacts(self, acc_num):
+        return self.c.execute('account-contacts.sql', account_number=acc_num)
+
+    def addresses(self, acc_num, acc_type):
+        return self.c.execute('account-addresses.sql', account_number=acc_num, acc_type=acc_type)
+
+    def connections(self, acc_num, c_type):
+        return self.c.execute(connections_template(c_type), c_type=c_type, account_number=acc_num).fetchall()
+
+    def connection_statuses(self, conn_id):
+        return self.c.execute('connection-statuses.sql', conn_id=conn_id)
+
+    def tariffs_history(self, conn_id, date_from):
+        return self.c.execute('tariffs-history.sql', conn_id=conn_id, date_from=date_from)
+
+    def discounts(self, conn_id):
+        return self.c.execute('discounts.sql', conn_id=conn_id)
+
+    def payments(self, acc_num):
+        return self.c.execute('account-payments.sql', account_number=acc_num)
+
+
+class BulkAccountQueries(AccountQueries):
+    '''Данные лицевых счетов, загружаемые заранее пачками.
+
+    prefetch() выбирает каждый набор данных пакетными запросами на всю пачку
+    лицевых (см. db.Connection.execute_many_keys), результаты раскладываются
+    по ключам в памяти. Загруженная пачка становится текущей после use(),
+    так что следующую можно выбирать, пока выгружается предыдущая.
+    '''
+    def __init__(self, connection, items, tariffs_history_from=None, discounts=False):
+        super().__init__(connection)
+        self._items = items
+        self._tariffs_history_from = tariffs_history_from
+        self._discounts = discounts
+        self._data = {}
+
+    def _fetch(self, template, key, keys, **args):
+        return self.c.execute_many_keys(template, keys, key, **args)
+
+    def _get(self, name, key):
+        return self._data[name].get(key, [])
+
+    def _get_one(self, name, key):
+        rows = self._get(name, key)
+        return rows[0] if rows else None
+
+    def prefetch(self, accounts):
+        data = {}
+        accounts = list(accounts)
+
+        data['base'] = self._fetch('account-base-info.sql', 'account_number', accounts)
+        persons = []
+        companies = []
+        for acc_num in accounts:
+            rows = data['base'].get(acc_num)
+            if not rows:
+                continue
+            r = rows[0]
+            if r.acc_type == 'person':
+                persons.append(acc_num)
+            else:
+                companies.append(acc_num)
+
+        if 'attributes' in self._items:
+            data['person'] = self._fetch('account-person-info.sql', 'account_number', persons)
+            data['company'] = self._fetch('account-company-info.sql', 'account_number', companies)
+            data['contacts'] = self._fetch('account-contacts.sql', 'account_number', accounts)
+            data['addresses', 'person'] = self._fetch(
+                'account-addresses.sql', 'account_number', persons, acc_type='person')
+            data['addresses', 'company'] = self._fetch(
+                'account-addresses.sql', 'account_number', companies, acc_type='company')
+
+        if 'connections' in self._items:
+            conn_ids = set()
+            history_conn_ids = set()
+            for c_type in CONNECTION_TYPES:
+                conns = data['connections', c_type] = self._fetch(
+                    connections_template(c_type), 'account_number', accounts, c_type=c_type)
+                for rows in conns.values():
+                    for r in rows:
+                        conn_ids.add(r.conn_id)
+                        if c_type != 'lk':
+                            history_conn_ids.add(r.conn_id)
+            conn_ids = sorted(conn_ids)
+            data['statuses'] = self._fetch('connection-statuses.sql', 'conn_id', conn_ids)
+            if self._discounts:
+                data['discounts'] = self._fetch('discounts.sql', 'conn_id', conn_ids)
+            if self._tariffs_history_from:
+                data['tariffs-history'] = self._fetch(
+                    'tariffs-history.sql', 'conn_id', sorted(history_conn_ids),
+                    date_from=self._tariffs_history_from)
+
+        if 'payments' in self._items:
+            data['payments'] = self._fetch('account-payments.sql', 'account_number', accounts)
+
+        return data
+
+    def use(self, data):
+        self._data = data
+
+    def base_info(self, acc_num):
+        return self._get_one('base', acc_num)
+
+    def person_info(self, acc_num):
+        return self._get_one('person', acc_num)
+
+    def company_info(self, acc_num):
+        return self._get_one('company', acc_num)
+
+    def contacts(self, acc_num):
+        return self._get('contacts', acc_num)
+
+    def addresses(self, acc_num, acc_type):
+        return self._get(('addresses', acc_type), acc_num)
+
+    def connections(self, acc_num, c_type):
+        return self._get(('connections', c_type), acc_num)
+
+    def connection_statuses(self, conn_id):
+        return self._get('statuses', conn_id)
+
+    def tariffs_history(self, conn_id, date_from):
+        return self._get('tariffs-history', conn_id)
+
+    def discounts(self, conn_id):
+        return self._get('discounts', conn_id)
+
+    def payments(self, acc_num):
+        return self._get('payments', acc_num)
@@ -0,0 +1,467 @@
+'Синтетическая база данных в формате SmartASR для замеров скорости выгрузки.'
+from datetime import datetime, date, timedelta, timezone
+from decimal import Decimal
+import random
+import sqlite3
+import csv
+import os
+
+import sqlalchemy
+
+# схема: таблица -> список (колонка, тип)
+SCHEMA = {
+    'core.groups': [('id', 'INTEGER'), ('name', 'TEXT')],
+    'core.managers': [('id', 'INTEGER'), ('name', 'TEXT')],
+    'core.accounts': [
+        ('id', 'INTEGER'), ('parent_id', 'INTEGER'), ('account_number', 'TEXT'),
+        ('person_id', 'INTEGER'), ('company_id', 'INTEGER'), ('group_id', 'INTEGER'),
+        ('manager_id', 'INTEGER'), ('base_company_id', 'INTEGER'),
+        ('balance', 'DECIMAL'), ('child_balance', 'DECIMAL'),
+        ('notification_email', 'TEXT'), ('notification_fax', 'TEXT'),
+        ('notification_sms', 'TEXT'), ('create_date', 'TIMESTAMP')],
+    'core.companies': [('id', 'INTEGER'), ('name', 'TEXT'), ('status', 'INTEGER')],
+    'core.company_law_info_enddate': [
+        ('company_id', 'INTEGER'), ('law_name', 'TEXT'), ('inn', 'TEXT'), ('kpp', 'TEXT'),
+        ('ogrn', 'TEXT'), ('okonh', 'TEXT'), ('okpo', 'TEXT'), ('property_type', 'INTEGER'),
+        ('end_date', 'TIMESTAMP')],
+    'core.company_property_types': [('id', 'INTEGER'), ('short_name', 'TEXT'), ('full_name', 'TEXT')],
+    'eisup.contractors': [('company_id', 'INTEGER'), ('external_id', 'TEXT')],
+    'core.persons': [
+        ('id', 'INTEGER'), ('birth_day', 'DATE'), ('birth_place', 'TEXT'),
+        ('secret_word', 'TEXT'), ('status', 'INTEGER')],
+    'core.person_infos_enddate': [
+        ('person_id', 'INTEGER'), ('first_name', 'TEXT'), ('second_name', 'TEXT'),
+        ('last_name', 'TEXT'), ('inn', 'TEXT'), ('passport_type', 'INTEGER'),
+        ('passport_series', 'TEXT'), ('passport_number', 'TEXT'), ('passport_date', 'DATE'),
+        ('passport_issuer', 'TEXT'), ('end_date', 'TIMESTAMP')],
+    'core.contact_infos': [
+        ('company_id', 'INTEGER'), ('person_id', 'INTEGER'), ('info', 'TEXT'), ('type', 'INTEGER')],
+    'core.states': [('id', 'INTEGER'), ('name', 'TEXT')],
+    'core.cities': [('id', 'INTEGER'), ('name', 'TEXT'), ('state_id', 'INTEGER')],
+    'core.streets': [('id', 'INTEGER'), ('name', 'TEXT'), ('city_id', 'INTEGER')],
+    'core.addresses_enddate': [
+        ('person_id', 'INTEGER'), ('company_id', 'INTEGER'), ('address_type', 'INTEGER'),
+        ('zip', 'TEXT'), ('num', 'TEXT'), ('building', 'TEXT'), ('block', 'TEXT'),
+        ('flat', 'TEXT'), ('entrance', 'TEXT'), ('floor', 'TEXT'), ('postbox', 'TEXT'),
+        ('street_id', 'INTEGER'), ('end_date', 'TIMESTAMP')],
+    'core.account_statuses_enddate': [
+        ('account_id', 'INTEGER'), ('status', 'INTEGER'), ('start_date', 'TIMESTAMP'),
+        ('end_date', 'TIMESTAMP')],
+    'core.account_statuses': [
+        ('account_id', 'INTEGER'), ('status', 'INTEGER'), ('start_date', 'TIMESTAMPTZ')],
+    'core.service_sub_types': [('id', 'INTEGER'), ('name', 'TEXT')],
+    'core.users': [
+        ('id', 'INTEGER'), ('account_id', 'INTEGER'), ('name', 'TEXT'), ('description', 'TEXT'),
+        ('service_type', 'INTEGER'), ('max_concurent_sessions', 'INTEGER'),
+        ('user_service_sub_type_id', 'INTEGER')],
+    'core.tariffs': [
+        ('id', 'INTEGER'), ('name', 'TEXT'), ('service_type', 'INTEGER'),
+        ('prepay_fee', 'DECIMAL'), ('status', 'INTEGER'), ('create_date', 'TIMESTAMP'),
+        ('modify_date', 'TIMESTAMP'), ('forperson', 'INTEGER'), ('forcompany', 'INTEGER')],
+    'core.tariff_base_companies': [('tariff_id', 'INTEGER'), ('base_company_id', 'INTEGER')],
+    'core.tariff_time_limits': [
+        ('tariff_id', 'INTEGER'), ('period', 'INTEGER'), ('next_tariff_id', 'INTEGER')],
+    'core.tariff_history_enddate': [
+        ('account_id', 'INTEGER'), ('tariff_id', 'INTEGER'), ('start_date', 'TIMESTAMP'),
+        ('end_date', 'TIMESTAMP')],
+    'iptraf.routers': [('id', 'INTEGER'), ('name', 'TEXT')],
+    'iptraf.users': [
+        ('user_id', 'INTEGER'), ('login', 'TEXT'), ('password', 'TEXT'),
+        ('start_ip', 'BIGINT'), ('end_ip', 'BIGINT'), ('router_id', 'INTEGER'),
+        ('user_type', 'INTEGER'), ('end_date', 'TIMESTAMP')],
+    'iptraf.pricelists_enddate': [
+        ('id', 'INTEGER'), ('tariff_id', 'INTEGER'), ('fee', 'DECIMAL'), ('end_date', 'TIMESTAMP')],
+    'iptraf.policy': [('id', 'INTEGER'), ('name', 'TEXT'), ('type', 'INTEGER'), ('status', 'INTEGER')],
+    'iptraf.policy_items': [('policy_id', 'INTEGER'), ('attribute_id', 'INTEGER'), ('value', 'TEXT')],
+    'iptraf.price_list_policy_links': [('price_list_id', 'INTEGER'), ('policy_id', 'INTEGER')],
+    'phone.exchanges': [('id', 'INTEGER'), ('name', 'TEXT'), ('zone_code', 'TEXT')],
+    'phone.users': [
+        ('user_id', 'INTEGER'), ('real_start_num', 'TEXT'), ('exchange_id', 'INTEGER'),
+        ('end_date', 'TIMESTAMP')],
+    'phone.number_pools': [
+        ('start_ani', 'TEXT'), ('end_ani', 'TEXT'), ('comments', 'TEXT'),
+        ('exchange_id', 'INTEGER'), ('end_date', 'TIMESTAMP')],
+    'phone.pricelists_enddate': [('tariff_id', 'INTEGER'), ('fee', 'DECIMAL'), ('end_date', 'TIMESTAMP')],
+    'tv.pricelists_enddate': [('tariff_id', 'INTEGER'), ('fee', 'DECIMAL'), ('end_date', 'TIMESTAMP')],
+    'npl.pricelists_enddate': [('tariff_id', 'INTEGER'), ('fee', 'DECIMAL'), ('end_date', 'TIMESTAMP')],
+    'npl.platforms': [('id', 'INTEGER'), ('address', 'TEXT')],
+    'npl.users': [('user_id', 'INTEGER'), ('platform1', 'INTEGER'), ('platform2', 'INTEGER')],
+    'core.web_users': [
+        ('id', 'INTEGER'), ('person_id', 'INTEGER'), ('company_id', 'INTEGER'), ('login', 'TEXT'),
+        ('password', 'TEXT'), ('name', 'TEXT'), ('status', 'INTEGER'), ('suspend_date', 'TIMESTAMP')],
+    'core.tx_items': [
+        ('account_id', 'INTEGER'), ('type', 'INTEGER'), ('transaction_id', 'INTEGER'), ('sum', 'DECIMAL')],
+    'core.promised_payments': [
+        ('tx_id', 'INTEGER'), ('rb_tx_id', 'INTEGER'), ('expire_date', 'TIMESTAMP'), ('amount', 'DECIMAL')],
+    'core.payments': [
+        ('tx_id', 'INTEGER'), ('payment_date', 'TIMESTAMP'), ('rollback_date', 'TIMESTAMP'),
+        ('status', 'INTEGER')],
+    'core.discount_history': [
+        ('discount_id', 'INTEGER'), ('start_date', 'TIMESTAMP'), ('end_date', 'TIMESTAMP'),
+        ('description', 'TEXT'), ('user_id', 'INTEGER')],
+    'core.service_types': [('id', 'INTEGER'), ('name', 'TEXT'), ('type', 'INTEGER')],
+    'core.service_items': [
+        ('id', 'INTEGER'), ('account_id', 'INTEGER'), ('type_id', 'INTEGER'),
+        ('have_credit', 'INTEGER'), ('credit_first_payment', 'DECIMAL'),
+        ('credit_monthly_payment', 'DECIMAL')],
+    'core.service_pricelists': [('id', 'INTEGER'), ('tariff_id', 'INTEGER'), ('end_date', 'TIMESTAMP')],
+    'core.service_prices': [
+        ('pricelist_id', 'INTEGER'), ('type_id', 'INTEGER'), ('price', 'DECIMAL'),
+        ('count_price', 'DECIMAL')],
+    'core.service_item_statuses': [
+        ('service_item_id', 'INTEGER'), ('start_date', 'TIMESTAMP'), ('end_date', 'TIMESTAMP'),
+        ('status', 'INTEGER'), ('amount', 'INTEGER')],
+    'core.service_item_charges': [('item_id', 'INTEGER'), ('start_date', 'TIMESTAMP')],
+}
+
+# индексы, без которых запросы по одному лицевому становятся полным перебором
+INDEXES = [
+    ('core.accounts', 'account_number'),
+    ('core.accounts', 'parent_id'),
+    ('core.account_statuses_enddate', 'account_id'),
+    ('core.account_statuses', 'account_id'),
+    ('core.users', 'account_id'),
+    ('core.tariff_history_enddate', 'account_id'),
+    ('iptraf.users', 'user_id'),
+    ('phone.users', 'user_id'),
+    ('npl.users', 'user_id'),
+    ('core.tx_items', 'account_id'),
+    ('core.tx_items', 'transaction_id'),
+    ('core.payments', 'tx_id'),
+    ('core.promised_payments', 'tx_id'),
+    ('core.discount_history', 'user_id'),
+    ('core.service_items', 'account_id'),
+    ('core.service_item_statuses', 'service_item_id'),
+    ('core.service_item_charges', 'item_id'),
+    ('core.contact_infos', 'person_id'),
+    ('core.contact_infos', 'company_id'),
+    ('core.addresses_enddate', 'person_id'),
+    ('core.addresses_enddate', 'company_id'),
+    ('core.web_users', 'person_id'),
+    ('core.web_users', 'company_id'),
+]
+
+TZ = timezone(timedelta(hours=9))
+GROUPS = ['root', 'КЦ КТТК', 'МР Байкал', 'Группа 1']
+SERVICE_TYPES = [(3, 'internet'), (10, 'ctv'), (4, 'phone'), (2, 'npl')]
+
+
+def generate(accounts=1000, connections=2, statuses=5, payments=2, seed=1, now=None):
+    'Генерирует строки всех таблиц: словарь таблица -> список кортежей.'
+    rnd = random.Random(seed)
+    now = now or datetime.now().replace(microsecond=0)
+    today = now.replace(hour=0, minute=0, second=0)
+    month_start = today.replace(day=1)
+    data = {table: [] for table in SCHEMA}
+
+    def add(table, *row):
+        data[table].append(row)
+
+    def past(days):
+        return now - timedelta(days=rnd.randint(1, days), seconds=rnd.randint(0, 86399))
+
+    for i, name in enumerate(GROUPS, start=1):
+        add('core.groups', i, name)
+    for i in range(1, 6):
+        add('core.managers', i, 'Менеджер {0}'.format(i))
+    add('core.company_property_types', 1, 'ООО', 'Общество с ограниченной ответственностью')
+    add('core.states', 1, 'Иркутская обл.')
+    add('core.cities', 1, 'Иркутск', 1)
+    for i in range(1, 51):
+        add('core.streets', i, 'ул. Улица {0}'.format(i), 1)
+    for i in range(1, 4):
+        add('core.service_sub_types', i, 'Подтип {0}'.format(i))
+    for i in range(1, 5):
+        add('iptraf.routers', i, 'router-{0}'.format(i))
+    for i in range(1, 11):
+        add('npl.platforms', i, 'Площадка {0}'.format(i))
+
+    # базовые компании: id 1..3, остальные компании - юр.лица-абоненты
+    base_companies = [1, 2, 3]
+    for cid in base_companies:
+        add('core.companies', cid, 'Базовая компания {0}'.format(cid), 1)
+
+    # тарифы всех видов услуг
+    tariffs = {}
+    tariff_id = 0
+    for service_type, service_name in SERVICE_TYPES:
+        tariffs[service_type] = []
+        for k in range(10):
+            tariff_id += 1
+            tariffs[service_type].append(tariff_id)
+            name = '{0} {1}{2}'.format(service_name, k, ' ADSL' if k == 3 else '')
+            add('core.tariffs', tariff_id, name, service_type, Decimal('0.00'),
+                2 if k == 9 else 1, past(2000), past(100), 1, int(k % 2 == 0))
+            add('core.tariff_base_companies', tariff_id, base_companies[k % 3])
+            add('core.tariff_time_limits', tariff_id, None if k % 4 else 30, None)
+            fee = Decimal(rnd.randint(100, 1500)).quantize(Decimal('1.00'))
+            if service_type == 3:
+                add('iptraf.pricelists_enddate', tariff_id, tariff_id, fee, None)
+            elif service_type == 4:
+                add('phone.pricelists_enddate', tariff_id, fee, None)
+            elif service_type == 10:
+                add('tv.pricelists_enddate', tariff_id, fee, None)
+            else:
+                add('npl.pricelists_enddate', tariff_id, fee, None)
+
+    # политики ограничения скорости, привязанные к прайс-листам интернета
+    for pid in range(1, 6):
+        add('iptraf.policy', pid, 'POLICY_{0}'.format(pid), 2, 1)
+        add('iptraf.policy_items', pid, 1, 'ssg-account-info=AHIGH_POLICY_{0}'.format(pid))
+        add('iptraf.policy_items', pid, 10, 'QU;{0}000;D;{0}000'.format(pid))
+    for k, tid in enumerate(tariffs[3]):
+        add('iptraf.price_list_policy_links', tid, k % 5 + 1)
+
+    # периодические услуги и услуги в рассрочку
+    for sid in range(1, 6):
+        add('core.service_types', sid, 'Услуга {0}'.format(sid), 3)
+        add('core.service_pricelists', sid, tariffs[3][sid], None)
+        add('core.service_prices', sid, sid, Decimal('50.00') * sid, Decimal('0.00'))
+    for sid in range(6, 9):
+        add('core.service_types', sid, 'Оборудование {0}'.format(sid), 1)
+
+    # пулы телефонных номеров
+    for ex in range(1, 4):
+        add('phone.exchanges', ex, 'ATS-{0}'.format(ex), '395{0}'.format(ex))
+    pools = []
+    for p in range(30):
+        start = 3952000000 + p * 10000
+        pools.append(start)
+        add('phone.number_pools', str(start), str(start + 9999), 'пул {0}'.format(p), p % 3 + 1, None)
+    # пересекающийся пул, номера из него относятся к пулу, что идёт раньше
+    add('phone.number_pools', str(pools[0] + 5000), str(pools[1] + 4999), 'пересекается', 1, None)
+
+    next_id = 1000
+    ip_next = int.from_bytes(bytes((10, 0, 1, 2)), 'big')
+    tx_next = 1
+    item_next = 1
+    user_next = 1
+    web_next = 1
+    person_next = 1
+    company_next = 100
+
+    for n in range(accounts):
+        next_id += 1
+        acc_id = next_id
+        acc_num = '142{0:06d}'.format(n + 1)
+        is_person = rnd.random() < 0.8
+        person_id = company_id = None
+        if is_person:
+            person_id = person_next
+            person_next += 1
+            add('core.persons', person_id, past(20000).date(), 'г. Иркутск', 'слово', 1)
+            add('core.person_infos_enddate', person_id, 'Имя{0}'.format(n), 'Отчество',
+                'Фамилия{0}'.format(n), None, 1, '25{0:02d}'.format(n % 100),
+                '{0:06d}'.format(n), past(5000).date(), 'ОВД; г. Иркутск', None)
+        else:
+            company_id = company_next
+            company_next += 1
+            add('core.companies', company_id, 'Компания {0}'.format(n), 1)
+            add('core.company_law_info_enddate', company_id, 'ООО "Компания {0}"'.format(n),
+                '38{0:08d}'.format(n), '3801001', '10238{0:08d}'.format(n), '', '', 1, None)
+            add('eisup.contractors', company_id, 'E{0}'.format(n))
+        add('core.accounts', acc_id, None, acc_num, person_id, company_id,
+            rnd.randint(1, len(GROUPS)), rnd.choice([None, 1, 2, 3]), rnd.choice(base_companies),
+            Decimal(rnd.randint(-5000, 50000)) / 100, Decimal(rnd.randint(-5000, 50000)) / 100,
+            'user{0}@example.com'.format(n), '', '+7 (3952) {0:06d}'.format(n), past(3000))
+
+        for t in (1, 2, 6, 1001):
+            if rnd.random() < 0.5:
+                info = 'extra{0}@example.com'.format(n) if t == 1001 else '8-914-{0:07d}'.format(n)
+                add('core.contact_infos', company_id, person_id, info, t)
+        for address_type in (0, 1):
+            add('core.addresses_enddate', person_id, company_id, address_type,
+                '664000', str(rnd.randint(1, 200)), None, rnd.choice([None, 'А']),
+                str(rnd.randint(1, 300)), '1', '2', None, rnd.randint(1, 50), None)
+        if rnd.random() < 0.7:
+            add('core.web_users', web_next, person_id, company_id, acc_num,
+                'pw{0}'.format(n), 'ЛК {0}'.format(acc_num), 1, None)
+            web_next += 1
+
+        for k in range(rnd.randint(1, connections * 2 - 1)):
+            next_id += 1
+            child_id = next_id
+            service_type, service_name = rnd.choice(SERVICE_TYPES)
+            status = rnd.choice([3, 3, 3, 3, 1, 4, 5])
+            add('core.accounts', child_id, acc_id, None, None, None, None, None, None,
+                Decimal('0.00'), Decimal('0.00'), None, None, None, past(3000))
+            add('core.account_statuses_enddate', child_id, status, past(300), None)
+            for h in range(statuses):
+                add('core.account_statuses', child_id, rnd.choice([1, 3, 4, 5]),
+                    past(400 if h else 10).replace(tzinfo=TZ))
+            tid = rnd.choice(tariffs[service_type])
+            if rnd.random() < 0.05:
+                tid = 9999  # тариф без сопоставления
+            add('core.tariff_history_enddate', child_id, tid, past(200), None)
+            user_id = user_next
+            user_next += 1
+            add('core.users', user_id, child_id, 'user{0}'.format(user_id),
+                rnd.choice([None, 'подключение', 'адрес;\nкомментарий']),
+                service_type, 1, rnd.choice([None, 1, 2]))
+
+            if service_type == 3:
+                user_type = rnd.choice([8, 8, 8, 9])
+                if user_type == 8 and rnd.random() < 0.7:
+                    start_ip = end_ip = 0
+                elif user_type == 8:
+                    start_ip = end_ip = ip_next
+                    ip_next += 1
+                else:
+                    ip_next += -ip_next % 4
+                    start_ip = ip_next
+                    end_ip = ip_next + rnd.choice([0, 3])
+                    ip_next += 4
+                add('iptraf.users', user_id, 'login{0}'.format(user_id), 'pw{0}'.format(user_id),
+                    start_ip, end_ip, rnd.randint(1, 4), user_type, None)
+                if rnd.random() < 0.3:
+                    item_id = item_next
+                    item_next += 1
+                    add('core.service_items', item_id, child_id, rnd.randint(1, 5), 0, None, None)
+                    add('core.service_item_statuses', item_id, past(100), None, 2, 1)
+            elif service_type == 4:
+                number = rnd.choice(pools) + rnd.randint(0, 9999)
+                if user_id % 40 == 0:
+                    number = 3950000000 + user_id  # номер вне пулов
+                add('phone.users', user_id, str(number), 1, None)
+            elif service_type == 2:
+                add('npl.users', user_id, rnd.randint(1, 10), rnd.choice([None, 2]))
+
+            if rnd.random() < 0.1:
+                item_id = item_next
+                item_next += 1
+                add('core.service_items', item_id, child_id, rnd.randint(6, 8), 1,
+                    Decimal('1000.00'), Decimal('250.00'))
+                for m in range(1, rnd.randint(2, 6)):
+                    add('core.service_item_charges', item_id, month_start + timedelta(days=31 * m))
+            if rnd.random() < 0.1:
+                add('core.discount_history', rnd.randint(1, 3), past(100), None,
+                    rnd.choice([None, 'скидка']), user_id)
+
+        for p in range(rnd.randint(0, payments * 2)):
+            tx = tx_next
+            tx_next += 1
+            add('core.tx_items', acc_id, 1, tx, Decimal(rnd.randint(100, 2000)))
+            pay_date = month_start + timedelta(days=rnd.randint(0, max(0, today.day - 1)),
+                                               seconds=rnd.randint(60, 80000))
+            add('core.payments', tx, pay_date, None, 1)
+        if rnd.random() < 0.05:
+            tx = tx_next
+            tx_next += 1
+            add('core.tx_items', acc_id, 2, tx, Decimal('300.00'))
+            add('core.promised_payments', tx, None, today + timedelta(days=3), Decimal('300.00'))
+
+    return data
+
+
+def _sqlite_value(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat(' ')
+    if isinstance(value, date):
+        return value.isoformat()
+    return value
+
+
+def create_sqlite(filename, data):
+    'Создаёт базу SQLite; каждая схема - отдельный присоединённый файл.'
+    base, _ = os.path.splitext(filename)
+    schemas = sorted(set(table.split('.')[0] for table in SCHEMA))
+    if os.path.exists(filename):
+        os.unlink(filename)
+    conn = sqlite3.connect(filename)
+    for schema in schemas:
+        schema_file = '{0}.{1}.db'.format(base, schema)
+        if os.path.exists(schema_file):
+            os.unlink(schema_file)
+        conn.execute('ATTACH DATABASE ? AS {0}'.format(schema), (schema_file, ))
+    for table, columns in SCHEMA.items():
+        conn.execute('CREATE TABLE {0} ({1})'.format(
+            table, ', '.join('{0} {1}'.format(*c) for c in columns)))
+        conn.executemany('INSERT INTO {0} VALUES ({1})'.format(
+            table, ', '.join('?' * len(columns))),
+            ([_sqlite_value(v) for v in row] for row in data[table]))
+    for table, column in INDEXES:
+        schema, name = table.split('.')
+        conn.execute('CREATE INDEX {0}.{1}_{2} ON {1} ({2})'.format(schema, name, column))
+    conn.commit()
+    conn.close()
+    return schemas
+
+
+def create_postgres(connection_uri, data):
+    'Создаёт таблицы в PostgreSQL, существующие таблицы с теми же именами удаляются.'
+    engine = sqlalchemy.create_engine('postgresql+psycopg2://' + connection_uri)
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        for schema in sorted(set(table.split('.')[0] for table in SCHEMA)):
+            cursor.execute('CREATE SCHEMA IF NOT EXISTS {0}'.format(schema))
+        for table, columns in SCHEMA.items():
+            cursor.execute('DROP TABLE IF EXISTS {0}'.format(table))
+            cursor.execute('CREATE TABLE {0} ({1})'.format(
+                table, ', '.join('{0} {1}'.format(*c) for c in columns)))
+            cursor.executemany('INSERT INTO {0} VALUES ({1})'.format(
+                table, ', '.join(['%s'] * len(columns))), data[table])
+        for table, column in INDEXES:
+            cursor.execute('CREATE INDEX ON {0} ({1})'.format(table, column))
+        conn.commit()
+    finally:
+        conn.close()
+    engine.dispose()
+
+
+PROFILE = """\
+sql-dialect: {sql_dialect}
+connection-uri: {connection_uri}
+export-data-dir: {export_data_dir}
+tariffs-map-file: tariffs.csv
+groups-map-file: groups.csv
+tariffs-policy-map-file: policy.csv
+domain-id: 21211
+base-account-id: 1
+base-account-sitename: base
+tariff-templates:
+    internet-person: 5355
+    internet-company: 5356
+    phone: 5357
+    ctv: 5358
+    npl: 5359
+    service-credit: 10191
+static-ip-pools:
+    pool-a: 10.0.1.0/24
+    pool-b: 10.0.2.0/24
+periodic-service-mapping: {{1: 501, 2: 502, 3: 503, 4: 504}}
+credit-service-mapping: {{6: 601, 7: 602}}
+discounts-service-mapping: {{1: 701, 2: 702}}
+"""
+
+
+def _write_map(filename, header, rows):
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f, delimiter=';', quoting=csv.QUOTE_ALL)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def write_profile(work_dir, sql_dialect, connection_uri):
+    '''Профиль выгрузки для синтетической базы и файлы сопоставлений к нему.
+
+    Часть тарифов, групп и политик намеренно не сопоставлена, чтобы
+    выгрузка проходила и по веткам с ошибками.
+    '''
+    tariffs_count = len(SERVICE_TYPES) * 10
+    _write_map(os.path.join(work_dir, 'tariffs.csv'), ('Старый ТП', 'Новый ТП'),
+               ((tid, 9000 + tid) for tid in range(1, tariffs_count + 1)))
+    _write_map(os.path.join(work_dir, 'groups.csv'), ('Группа', 'Название группы'),
+               ((gid, name) for gid, name in enumerate(GROUPS[:-1], start=1)))
+    _write_map(os.path.join(work_dir, 'policy.csv'), ('Наименование', 'RESCONNID'),
+               (('HIGH_POLICY_{0}'.format(pid), 800 + pid) for pid in range(1, 5)))
+
+    filename = os.path.join(work_dir, 'profile.yaml')
+    with open(filename, 'w') as f:
+        f.write(PROFILE.format(
+            sql_dialect=sql_dialect,
+            connection_uri=connection_uri,
+            export_data_dir=os.path.join(os.path.abspath(work_dir), 'export_data/')))
+    return filename
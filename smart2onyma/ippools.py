@@ -0,0 +1,71 @@
+from ipaddress import ip_address, ip_network, IPv4Network, IPv6Network
+
+
+ADDRESS_BITS = {4: 32, 6: 128}
+
+
+class IpPoolResolver:
+    '''Поиск пула статических адресов (static-ip-pools профиля).
+
+    Пулы раскладываются по длине префикса: для каждой длины - словарь
+    "адрес сети -> имя пула". Адрес или диапазон адресов ищется от самого
+    длинного префикса к короткому, так что находится наиболее точный пул,
+    целиком содержащий диапазон. Если такого нет, берётся первый по порядку
+    в профиле пул, который с диапазоном пересекается.
+    '''
+    def __init__(self, pools):
+        self._tables = {4: [], 6: []}
+        self._ranges = []
+        tables = {4: {}, 6: {}}
+        for name, pool_addr in pools.items():
+            network = ip_network(pool_addr)
+            start = int(network.network_address)
+            table = tables[network.version].setdefault(network.prefixlen, {})
+            # при одинаковых сетях побеждает первая в профиле
+            table.setdefault(start, name)
+            self._ranges.append((network.version, start, int(network.broadcast_address), name))
+
+        for version, bits in ADDRESS_BITS.items():
+            all_ones = (1 << bits) - 1
+            for prefixlen in sorted(tables[version], reverse=True):
+                mask = all_ones ^ ((1 << (bits - prefixlen)) - 1)
+                self._tables[version].append((mask, tables[version][prefixlen]))
+
+    def resolve_range(self, start, end, version=4):
+        'Пул для диапазона адресов, заданного целыми числами, как их хранит биллинг.'
+        for mask, table in self._tables[version]:
+            network = start & mask
+            if network == end & mask:
+                name = table.get(network)
+                if name is not None:
+                    return name
+        for pool_version, pool_start, pool_end, name in self._ranges:
+            if pool_version == version and pool_start <= end and start <= pool_end:
+                return name
+        return None
+
+    def resolve(self, ip):
+        'Пул для адреса или сети: объекта ipaddress, строки или целого числа (IPv4).'
+        if isinstance(ip, (IPv4Network, IPv6Network)):
+            return self.resolve_range(int(ip.network_address), int(ip.broadcast_address), ip.version)
+        if isinstance(ip, int):
+            return self.resolve_range(ip, ip)
+        if isinstance(ip, str) and '/' in ip:
+            return self.resolve(ip_network(ip, strict=False))
+        ip = ip_address(ip)
+        return self.resolve_range(int(ip), int(ip), ip.version)
+
+    def resolve_many(self, ranges, version=4):
+        '''Пулы для списка диапазонов (start, end) за один проход.
+
+        Возвращает имена пулов в том же порядке и список диапазонов,
+        для которых пул не найден.
+        '''
+        names = []
+        unresolved = []
+        for start, end in ranges:
+            name = self.resolve_range(start, end, version)
+            names.append(name)
+            if name is None:
+                unresolved.append((start, end))
+        return names, unresolved
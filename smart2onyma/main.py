@@ -1,6 +1,10 @@
+import os
+import sys
+
 import click
 
-from . import export
+# export и bench тянут за собой sqlalchemy, jinja2 и драйверы БД, поэтому
+# импортируются внутри команд: --help и разбор аргументов от них не зависят.
 
 
 @click.group()
@@ -15,8 +19,39 @@ def main():
 @click.option('--accs-skip-file')  # список лицевых, которые нужно пропустить
 @click.option('--tariffs-history-from')  # дата, с которой выгружать историю тарифов yyyy-mm-dd
 @click.option('--data-items', help='accounts, attributes, connections, balances, payments')
+@click.option('--bulk-size', type=int, help='Fetch account data in bulk, N accounts per query')
+@click.option('--workers', type=int, default=1, help='Export account shards in N processes')
+@click.option('--resume', default=False, is_flag=True, help='Continue interrupted export from the last checkpoint')
+@click.option('--delta', default=False, is_flag=True, help='Export only accounts changed since the full export')
+@click.option('--stats', metavar='FILE', help='Collect query and export timings, save them to FILE')
+@click.option('--fingerprints', default=False, is_flag=True,
+              help='Save account fingerprints for a later --delta export')
+@click.option('--concurrent', default=False, is_flag=True,
+              help='Export profiles at the same time, each to its own export-data-dir')
+@click.option('--partitioned', default=False, is_flag=True,
+              help='Export profiles that differ only in filters in a single pass over the database')
 @click.argument('profiles', nargs=-1)
-def clientdata(append, profiles, accs_list_file, prev_conn_file, accs_skip_file, tariffs_history_from, data_items):
+def clientdata(append, profiles, accs_list_file, prev_conn_file, accs_skip_file, tariffs_history_from, data_items,
+               bulk_size, workers, resume, delta, stats, fingerprints, concurrent, partitioned):
+    from . import export
+
+    if resume and workers > 1:
+        raise click.UsageError('--resume is not supported with --workers')
+    if partitioned and resume:
+        raise click.UsageError('--resume is not supported with --partitioned')
+    if partitioned and accs_list_file:
+        raise click.UsageError('--partitioned is not supported with --accs-list-file')
+    # общий проход выгружает профили так же одновременно, каждый в своём потоке
+    mode = '--partitioned' if partitioned else '--concurrent'
+    concurrent = concurrent or partitioned
+    if concurrent and workers > 1:
+        raise click.UsageError('{0} is not supported with --workers'.format(mode))
+    if concurrent and stats:
+        raise click.UsageError('{0} is not supported with --stats'.format(mode))
+    if concurrent and prev_conn_file:
+        # профили выдавали бы одни и те же новые USRCONNID
+        raise click.UsageError('{0} is not supported with --prev-conn-file'.format(mode))
+
     accs_list = None
     if accs_list_file:
         accs_list = []
@@ -29,25 +64,61 @@ def clientdata(append, profiles, accs_list_file, prev_conn_file, accs_skip_file,
         with open(accs_skip_file) as f:
             accs_skip = [line.strip() for line in f]
 
+    bdes = []
     for profile in profiles:
         bde = export.BillingDataExporter(profile, accs_list,
-                accs_skip=accs_skip,
-                tariffs_history_from=tariffs_history_from
-                )
-        if not append:
+                                         accs_skip=accs_skip,
+                                         tariffs_history_from=tariffs_history_from,
+                                         bulk_size=bulk_size)
+        if resume and bde.exporter.staging is not None:
+            # контрольные точки для staging не сохраняются: таблицы не обрезать до точки
+            raise click.UsageError('{0}: --resume is not supported with staging output'.format(profile))
+        if delta:
+            bde.start_delta()
+        if fingerprints:
+            bde.enable_fingerprints()
+        if stats:
+            bde.enable_stats(stats)
+        if concurrent:
+            bdes.append(bde)
+            continue
+        if not append and not resume:
             bde.clear_output_files()
         if data_items:
             bde.set_export_data_items(data_items.split(','))
         if prev_conn_file:
             bde.load_sitename_to_usrconnid_map(prev_conn_file)
-        bde.export_one_by_one()
+        if workers > 1:
+            bde.export_parallel(workers)
+        else:
+            bde.export_one_by_one(resume=resume)
         append = True
 
+    if concurrent:
+        from . import multiprofile
+
+        data_dirs = [os.path.realpath(bde.exporter.data_dir) for bde in bdes]
+        if len(set(data_dirs)) != len(data_dirs):
+            raise click.UsageError('{0} requires a separate export-data-dir for every profile'.format(mode))
+        for bde in bdes:
+            if not append and not resume:
+                bde.clear_output_files()
+            if data_items:
+                bde.set_export_data_items(data_items.split(','))
+        if partitioned:
+            ok = multiprofile.export_partitioned(bdes, bulk_size or multiprofile.PARTITION_CHUNK_SIZE)
+        else:
+            ok = multiprofile.export_concurrent(bdes, resume=resume)
+        if not ok:
+            sys.exit(1)
+
 
 @main.command()
 @click.option('--append', default=False, is_flag=True, help='Append new data to existed export')
 @click.argument('profiles', nargs=-1)
 def tariffs(append, profiles):
+    from . import export
+
     for profile in profiles:
         bde = export.BillingDataExporter(profile)
         if not append:
@@ -60,6 +131,8 @@ def tariffs(append, profiles):
 @click.option('--append', default=False, is_flag=True, help='Append new data to existed export')
 @click.argument('profiles', nargs=-1)
 def tariffs_srv_credit(append, profiles):
+    from . import export
+
     for profile in profiles:
         bde = export.BillingDataExporter(profile)
         if not append:
@@ -71,6 +144,8 @@ def tariffs_srv_credit(append, profiles):
 @main.command()
 @click.argument('profiles', nargs=-1)
 def show_base_companies(profiles):
+    from . import export
+
     for profile in profiles:
         bde = export.BillingDataExporter(profile)
         bde.show_base_companies()
@@ -80,8 +155,89 @@ def show_base_companies(profiles):
 @click.option('--append', default=False, is_flag=True, help='Append new data to existed export')
 @click.argument('profiles', nargs=-1)
 def policy(append, profiles):
+    from . import export
+
     for profile in profiles:
         bde = export.BillingDataExporter(profile)
         if not append:
             bde.clear_output_files()
         bde.export_policy()
+
+
+@main.command()
+@click.argument('profiles', nargs=-1)
+def verify(profiles):
+    """Check that export files reference existing accounts and connections."""
+    from . import mapper
+    from .verify import Verifier
+
+    ok = True
+    for profile in profiles:
+        profile_data = mapper.load_profile(profile)
+        if profile_data.get('output', 'files') != 'files':
+            raise click.UsageError('{0}: verify checks export files, not the staging database'.format(profile))
+        verifier = Verifier(profile_data.get('export-data-dir', 'export_data/'))
+        ok = verifier.run() and ok
+        print(verifier.report())
+    if not ok:
+        sys.exit(1)
+
+
+@main.command()
+@click.option('--tariffs-history-from', help='Also check tariffs in history since yyyy-mm-dd')
+@click.argument('profiles', nargs=-1)
+def preflight(profiles, tariffs_history_from):
+    """Find missing mappings and static IP pools before running clientdata."""
+    from . import export
+    from .preflight import Preflight
+
+    ok = True
+    for profile in profiles:
+        checker = Preflight(export.BillingDataExporter(profile), tariffs_history_from)
+        ok = checker.run() and ok
+        print(checker.report())
+    if not ok:
+        sys.exit(1)
+
+
+@main.command()
+@click.option('--output', help='Write differences of each file to OUTPUT/<file>.diff')
+@click.option('--memory-budget', default='512M', help='Memory for sorting, e.g. 512M or 2G')
+@click.argument('old_dir')
+@click.argument('new_dir')
+def diff(old_dir, new_dir, output, memory_budget):
+    """Compare export files of two runs record by record."""
+    from . import preload
+    from . import diff as export_diff
+
+    results = export_diff.diff_dirs(old_dir, new_dir, preload.parse_size(memory_budget), output)
+    print('')
+    print(export_diff.report(results))
+
+
+@main.command()
+@click.option('--work-dir', default='bench_data/', help='Directory for fixture database, profile and results')
+@click.option('--accounts', type=int, default=1000, help='Number of accounts in fixture database')
+@click.option('--connections', type=int, default=2, help='Average connections per account')
+@click.option('--statuses', type=int, default=5, help='Status history records per connection')
+@click.option('--payments', type=int, default=2, help='Average payments per account')
+@click.option('--seed', type=int, default=1)
+@click.option('--connection-uri', help='Load fixture into PostgreSQL (user:password@host/db) instead of SQLite')
+@click.option('--regenerate', default=False, is_flag=True, help='Recreate fixture database')
+@click.option('--repeat', type=int, default=1, help='Run each command N times, keep the fastest')
+@click.option('--bulk-size', type=int)
+@click.argument('commands', nargs=-1)
+def bench(work_dir, accounts, connections, statuses, payments, seed, connection_uri, regenerate, repeat,
+          bulk_size, commands):
+    """Time clientdata, tariffs and policy on a synthetic database."""
+    from . import bench as benchmark
+
+    params = {
+        'accounts': accounts,
+        'connections': connections,
+        'statuses': statuses,
+        'payments': payments,
+        'seed': seed,
+    }
+    benchmark.bench(work_dir, params, commands or benchmark.COMMANDS,
+                    connection_uri=connection_uri, regenerate=regenerate, repeat=repeat, bulk_size=bulk_size)
@@ -1,19 +1,145 @@
+import os
 from os import path
 import csv
+import pickle
+import hashlib
+from collections.abc import Mapping
 
 import yaml
 
 
+# C-реализация загрузчика заметно быстрее, если PyYAML собран с libyaml
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+# При изменении формата кэша или разбора профиля версию нужно увеличить,
+# чтобы старые снимки не использовались.
+PROFILE_CACHE_VERSION = 1
+
+
 def in_module_path(filename):
     return path.join(path.dirname(path.realpath(__file__)), filename)
 
 
 def load_yaml(filename):
     with open(filename, 'r') as f:
-        return yaml.load(f.read())
+        return yaml.load(f, Loader=YamlLoader)
+
+
+def cache_dir():
+    'Каталог для снимков профилей, переопределяется SMART2ONYMA_CACHE_DIR.'
+    directory = os.environ.get('SMART2ONYMA_CACHE_DIR')
+    if not directory:
+        base = os.environ.get('XDG_CACHE_HOME') or path.join(path.expanduser('~'), '.cache')
+        directory = path.join(base, 'smart2onyma')
+    return directory
+
+
+def file_digest(filename):
+    with open(filename, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def file_signature(filename):
+    st = os.stat(filename)
+    return [path.realpath(filename), st.st_mtime_ns, st.st_size, file_digest(filename)]
+
+
+def signatures_valid(signatures):
+    '''Проверка, что файлы не изменились с момента снимка.
+
+    Совпадение времени изменения и размера считается достаточным. Если
+    изменилось только время (файл перезаписан тем же содержимым, например
+    при checkout), сравнивается хэш содержимого.
+    '''
+    for filename, mtime_ns, size, digest in signatures:
+        try:
+            st = os.stat(filename)
+        except OSError:
+            return False
+        if st.st_size != size:
+            return False
+        if st.st_mtime_ns != mtime_ns and file_digest(filename) != digest:
+            return False
+    return True
+
+
+def cache_filename(filename, kind):
+    key = hashlib.sha1(path.realpath(filename).encode()).hexdigest()
+    return path.join(cache_dir(), '{0}-{1}.pickle'.format(kind, key))
+
+
+def load_cached(filename, kind):
+    'Данные из снимка или None, если снимка нет или он устарел.'
+    try:
+        with open(cache_filename(filename, kind), 'rb') as f:
+            snapshot = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+        return None
+    if snapshot.get('version') != PROFILE_CACHE_VERSION:
+        return None
+    if not signatures_valid(snapshot['files']):
+        return None
+    return snapshot['data']
+
+
+def save_cached(filename, kind, data, files):
+    '''Сохраняет снимок данных, разобранных из files.
+
+    Ошибки записи не мешают работе: без кэша всё просто разбирается заново.
+    '''
+    snapshot = {
+        'version': PROFILE_CACHE_VERSION,
+        'files': [file_signature(f) for f in files],
+        'data': data,
+    }
+    cache_file = cache_filename(filename, kind)
+    tmp_file = '{0}.{1}.tmp'.format(cache_file, os.getpid())
+    try:
+        os.makedirs(path.dirname(cache_file), exist_ok=True)
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        try:
+            os.remove(tmp_file)
+        except OSError:
+            pass
+
+
+def load_yaml_cached(filename):
+    data = load_cached(filename, 'yaml')
+    if data is None:
+        data = load_yaml(filename)
+        save_cached(filename, 'yaml', data, [filename])
+    return data
+
+
+class LazyMaps(Mapping):
+    '''maps.yaml, который читается при первом обращении.
+
+    Команды, которым таблицы соответствия не нужны (--help и т.п.), не тратят
+    время на разбор YAML.
+    '''
+    def __init__(self, filename):
+        self._filename = filename
+        self._data = None
 
+    def _load(self):
+        if self._data is None:
+            self._data = load_yaml_cached(self._filename)
+        return self._data
+
+    def __getitem__(self, key):
+        return self._load()[key]
 
-maps = load_yaml(in_module_path('maps.yaml'))
+    def __iter__(self):
+        return iter(self._load())
+
+    def __len__(self):
+        return len(self._load())
+
+
+maps = LazyMaps(in_module_path('maps.yaml'))
 
 
 def load_tariffs_map(filename):
@@ -45,34 +171,45 @@ def load_groups_map(filename):
         return data
 
 
-def load_sitename_to_usrconnid_map(filename):
-    fieldnames = maps['export-files']['connections-list'][1].split(';')
-    with open(filename) as csvfile:
-        data = {}
-        for row in csv.DictReader(csvfile, fieldnames=fieldnames, delimiter=';'):
-            data[row['SITENAME']] = int(row['USRCONNID'])
-        return data
-
-
 def load_profile(filename):
+    '''Профиль со всей цепочкой include и загруженными файлами соответствий.
+
+    Результат сохраняется в снимок (см. cache_dir) вместе с подписями всех
+    прочитанных файлов, повторный запуск берёт профиль из снимка, пока ни
+    один из файлов не изменился.
+    '''
+    profile = load_cached(filename, 'profile')
+    if profile is None:
+        files = []
+        profile = parse_profile(filename, files)
+        save_cached(filename, 'profile', profile, files)
+    return profile
+
+
+def parse_profile(filename, files):
+    '''Разбор профиля без кэша, в files добавляются все прочитанные файлы.'''
     profile_dir = path.dirname(path.realpath(filename))
     profile = load_yaml(filename)
+    files.append(filename)
 
     parent = {}
     if 'include' in profile:
         parent_filename = path.join(profile_dir, profile['include'])
-        parent = load_profile(parent_filename)
+        parent = parse_profile(parent_filename, files)
 
     if 'tariffs-map-file' in profile:
         map_filename = path.join(profile_dir, profile['tariffs-map-file'])
+        files.append(map_filename)
         profile['tariffs-map'] = load_tariffs_map(map_filename)
 
     if 'tariffs-policy-map-file' in profile:
         map_filename = path.join(profile_dir, profile['tariffs-policy-map-file'])
+        files.append(map_filename)
         profile['tariffs-policy-map'] = load_tariffs_policy_map(map_filename)
 
     if 'groups-map-file' in profile:
         map_filename = path.join(profile_dir, profile['groups-map-file'])
+        files.append(map_filename)
         profile['groups-map'] = load_groups_map(map_filename)
 
     parent.update(profile)
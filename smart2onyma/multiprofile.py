@@ -0,0 +1,309 @@
+import os
+import sys
+import time
+import traceback
+import queue
+import threading
+import contextvars
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from . import db
+from . import fetch
+from . import pipeline
+
+
+# файл, в который пишет сообщения профиль, выгружаемый в текущем потоке
+_output = contextvars.ContextVar('output', default=None)
+
+LOG_FILE = 'clientdata.log'
+# размер пачки лицевых общего прохода, если не задан --bulk-size
+PARTITION_CHUNK_SIZE = 500
+
+
+class RoutedOutput:
+    '''Замена sys.stdout/sys.stderr на время одновременной выгрузки профилей.
+
+    Сообщения профиля (прогресс, отчёты, ошибки) пишутся в его LOG_FILE,
+    а не перемешиваются в консоли. Всё остальное выводится как обычно.
+    '''
+    def __init__(self, default):
+        self.default = default
+
+    def _target(self):
+        return _output.get() or self.default
+
+    def write(self, text):
+        return self._target().write(text)
+
+    def flush(self):
+        self._target().flush()
+
+    def __getattr__(self, name):
+        return getattr(self._target(), name)
+
+
+def share_engines(bdes):
+    '''Профили с одной базой получают общий db.Engine и пул подключений.
+
+    Возвращает профили, сгруппированные по базе.
+    '''
+    groups = {}
+    for bde in bdes:
+        profile = bde.profile
+        key = (profile['sql-dialect'], profile['connection-uri'],
+               profile.get('keys-chunk-size', 1000), profile.get('fetch-batch-size', 10000))
+        groups.setdefault(key, []).append(bde)
+
+    for (sql_dialect, connection_uri, keys_chunk_size, fetch_batch_size), group in groups.items():
+        if len(group) < 2:
+            continue
+        engine = db.Engine(sql_dialect, connection_uri,
+                           keys_chunk_size=keys_chunk_size,
+                           fetch_batch_size=fetch_batch_size,
+                           # по подключению на выгрузку и одно на общую загрузку
+                           pool_size=len(group) + 1)
+        for bde in group:
+            bde.db.db.dispose()
+            bde.db = engine
+    return list(groups.values())
+
+
+def _export_profile(bde, resume, options, finished=None):
+    log_file = os.path.join(bde.exporter.data_dir, LOG_FILE)
+    started = time.perf_counter()
+    with open(log_file, 'a' if resume else 'w', 1) as log:
+        token = _output.set(log)
+        try:
+            ok = bde.export_one_by_one(errors_file=os.path.join(bde.exporter.data_dir, 'errors.log'),
+                                       resume=resume, **options)
+        except Exception:
+            traceback.print_exc()
+            ok = False
+        finally:
+            _output.reset(token)
+            if finished is not None:
+                finished()
+    return ok, time.perf_counter() - started
+
+
+def shared_preloads(group):
+    '''Предзагрузки, общие для профилей с одной базой, или None.
+
+    Не делятся, если у профиля задан memory-budget: сброшенные во временные
+    файлы предзагрузки читаются по ходу выгрузки.
+    '''
+    if len(group) < 2 or any(bde._memory_budget for bde in group):
+        return None
+    print('loading preloads shared by {0}...'.format(', '.join(bde.profile_name for bde in group)))
+    with group[0].db.connect() as c:
+        return group[0].load_preloads(c)
+
+
+def run_profiles(jobs, resume=False):
+    '''Выгружает профили одновременно, по потоку на профиль.
+
+    jobs - кортежи (bde, аргументы export_one_by_one, функция, вызываемая
+    по окончании выгрузки профиля, или None). Сообщения профиля пишутся
+    в LOG_FILE в его export-data-dir, в консоль - только итоги.
+    '''
+    started = time.perf_counter()
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = RoutedOutput(stdout), RoutedOutput(stderr)
+    results = {}
+    try:
+        with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+            futures = {pool.submit(_export_profile, bde, resume, options, finished): idx
+                       for idx, (bde, options, finished) in enumerate(jobs)}
+            print('exporting {0} profiles, logs in <export-data-dir>/{1}'.format(len(jobs), LOG_FILE))
+            for future in as_completed(futures):
+                idx = futures[future]
+                bde = jobs[idx][0]
+                results[idx] = ok, elapsed = future.result()
+                print('{0}: {1} in {2:.1f}s ({3}/{4})'.format(
+                    bde.profile_name, 'done' if ok else 'FAILED', elapsed, len(results), len(jobs)))
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+
+    print('')
+    print('{0:<30} {1:<7} {2:>10}'.format('profile', 'result', 'elapsed, s'))
+    for idx, (bde, _, _) in enumerate(jobs):
+        ok, elapsed = results[idx]
+        print('{0:<30} {1:<7} {2:>10.1f}'.format(bde.profile_name, 'ok' if ok else 'FAILED', elapsed))
+    print('total: {0:.1f}s'.format(time.perf_counter() - started))
+    return all(ok for ok, _ in results.values())
+
+
+def export_concurrent(bdes, resume=False):
+    '''Выгружает лицевые нескольких профилей одновременно, по потоку на профиль.
+
+    Профили с одной базой пользуются общим пулом подключений и общими
+    предзагрузками (см. BillingDataExporter.load_preloads), которые
+    загружаются один раз. Каждый профиль пишет в свой export-data-dir,
+    туда же - errors.log и сообщения выгрузки в LOG_FILE.
+
+    Выгрузка ждёт в основном ответов БД, поэтому потоки работают почти
+    параллельно, и общее время близко ко времени самого большого профиля.
+    '''
+    jobs = []
+    for group in share_engines(bdes):
+        preloads = shared_preloads(group)
+        jobs.extend((bde, {'preloads': preloads}, None) for bde in group)
+    return run_profiles(jobs, resume)
+
+
+def account_matches(filters, r):
+    '''Подходит ли лицевой фильтрам профиля, те же условия, что в accounts-list.sql.'''
+    if 'person' in filters and r.person_id is None:
+        return False
+    if 'company' in filters and r.company_id is None:
+        return False
+    if 'account' in filters and r.account_number != str(filters['account']['number']):
+        return False
+    if 'prefix' in filters and not r.account_number.startswith(str(filters['prefix']['value'])):
+        return False
+    if 'base_company' in filters and str(r.base_company_id) != str(filters['base_company']['id']):
+        return False
+    return True
+
+
+_DONE = object()
+
+
+class AccountRouter:
+    '''Общий проход по лицевым нескольких профилей с одной базой.
+
+    Данные лицевых выбираются пачками один раз (fetch.BulkAccountQueries)
+    в отдельном потоке, пачка передаётся в очереди профилей, которым
+    принадлежат её лицевые. Профиль забирает свои пачки через source() и
+    выгружает их как обычно, со своими соответствиями и в свой каталог.
+    '''
+    def __init__(self, bdes, accounts, routes, chunk_size, depth=2):
+        self.bdes = bdes
+        self.accounts = accounts
+        # для каждого лицевого - (номер профиля, позиция в списке лицевых профиля)
+        self.routes = routes
+        self.chunk_size = chunk_size
+        self.chunks = 0
+        self._queues = [queue.Queue(max(depth, 1)) for _ in bdes]
+        self._finished = [threading.Event() for _ in bdes]
+        self._thread = None
+
+    def _put(self, idx, item):
+        # профиль, который уже закончил (ошибка или limit), пачки не ждёт
+        while not self._finished[idx].is_set():
+            try:
+                self._queues[idx].put(item, timeout=pipeline.POLL_INTERVAL)
+                return
+            except queue.Full:
+                pass
+
+    def _run(self):
+        bdes = self.bdes
+        items = set().union(*(bde.export_items for bde in bdes))
+        discounts = any(bde.profile.get('discounts-service-mapping') for bde in bdes)
+        try:
+            with bdes[0].db.connect() as c:
+                queries = fetch.BulkAccountQueries(
+                    c, items,
+                    tariffs_history_from=bdes[0]._tariffs_history_from,
+                    discounts=discounts)
+                for start in range(0, len(self.accounts), self.chunk_size):
+                    parts = defaultdict(list)
+                    wanted = []
+                    for acc_num, targets in zip(self.accounts[start:start + self.chunk_size],
+                                                self.routes[start:start + self.chunk_size]):
+                        targets = [(idx, position) for idx, position in targets
+                                   if acc_num not in bdes[idx]._accs_skip and not self._finished[idx].is_set()]
+                        for idx, position in targets:
+                            parts[idx].append((position, acc_num))
+                        if targets:
+                            wanted.append(acc_num)
+                    if not wanted:
+                        continue
+                    # данные пачки только читаются, так что профили пользуются ими совместно
+                    data = queries.prefetch(wanted)
+                    self.chunks += 1
+                    for idx, part in parts.items():
+                        self._put(idx, (part, data))
+            for idx in range(len(bdes)):
+                self._put(idx, _DONE)
+        except BaseException as exc:
+            for idx in range(len(bdes)):
+                self._put(idx, exc)
+
+    def start(self):
+        context = contextvars.copy_context()
+        self._thread = threading.Thread(target=context.run, args=(self._run,), name='router', daemon=True)
+        self._thread.start()
+
+    def source(self, idx):
+        'Пачки лицевых профиля idx вместе с данными, для export_one_by_one(source=...).'
+        while True:
+            item = self._queues[idx].get()
+            if item is _DONE:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+    def finished(self, idx):
+        self._finished[idx].set()
+
+    def join(self):
+        self._thread.join()
+
+
+def export_partitioned(bdes, chunk_size):
+    '''Выгрузка профилей, которые отличаются только фильтрами, за один проход.
+
+    Список лицевых выбирается одним запросом по объединению фильтров всех
+    профилей, каждый лицевой направляется профилям, фильтрам которых он
+    подходит. Данные лицевых выбираются пачками по chunk_size один раз на
+    все профили (см. AccountRouter), а выгружаются в потоке профиля - с его
+    group-map, tariffs-map, domain-id и каталогом выгрузки.
+    '''
+    groups = share_engines(bdes)
+    if len(groups) > 1:
+        raise Exception('Partitioned export requires all profiles to use the same database')
+
+    memory_budget = any(bde._memory_budget for bde in bdes)
+    print('loading accounts of {0} profiles...'.format(len(bdes)))
+    accounts = []
+    routes = []
+    profile_accounts = [[] for _ in bdes]
+    with bdes[0].db.connect() as c:
+        rows = c.stream('accounts-list.sql', filter_sets=[bde.filters for bde in bdes])
+        if memory_budget:
+            # при сбросе предзагрузок во временные файлы лицевые идут по возрастанию номера
+            rows = sorted(rows, key=lambda r: r.account_number)
+        for r in rows:
+            targets = []
+            for idx, bde in enumerate(bdes):
+                if account_matches(bde.filters, r):
+                    targets.append((idx, len(profile_accounts[idx])))
+                    profile_accounts[idx].append(r.account_number)
+            if targets:
+                accounts.append(r.account_number)
+                routes.append(targets)
+    print('accounts: {0}, {1}'.format(len(accounts), ', '.join(
+        '{0}: {1}'.format(bde.profile_name, len(accs)) for bde, accs in zip(bdes, profile_accounts))))
+
+    preloads = shared_preloads(bdes)
+    router = AccountRouter(bdes, accounts, routes, chunk_size,
+                           max(bde._pipeline_depth for bde in bdes))
+    jobs = []
+    for idx, bde in enumerate(bdes):
+        # пачки приходят уже с данными, профилю остаётся разобрать их через use()
+        bde._bulk_size = chunk_size
+        options = {'accounts': profile_accounts[idx], 'preloads': preloads, 'source': router.source(idx)}
+        jobs.append((bde, options, lambda idx=idx: router.finished(idx)))
+    router.start()
+    try:
+        ok = run_profiles(jobs)
+    finally:
+        for idx in range(len(bdes)):
+            router.finished(idx)
+        router.join()
+    print('shared chunks fetched: {0}'.format(router.chunks))
+    return ok
@@ -0,0 +1,255 @@
+import time
+import queue
+import threading
+import contextvars
+
+
+# пока очередь пуста или заполнена, потоки проверяют остановку с этим интервалом
+POLL_INTERVAL = 0.1
+
+_DONE = object()
+
+
+class Stopped(Exception):
+    pass
+
+
+class Stage:
+    '''Счётчики стадии конвейера: обработанные элементы, время работы и
+    глубина входной очереди (замеряется при каждой постановке в очередь).
+    '''
+    def __init__(self, name, maxsize=0):
+        self.name = name
+        self.maxsize = maxsize
+        self.queue = queue.Queue(maxsize) if maxsize else None
+        self.items = 0
+        self.busy = 0.0
+        self.depth_total = 0
+        self.depth_max = 0
+        self.puts = 0
+        self.started = None
+        self.finished = None
+
+    def sample_depth(self):
+        depth = self.queue.qsize()
+        self.depth_total += depth
+        self.depth_max = max(self.depth_max, depth)
+        self.puts += 1
+
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.perf_counter()) - self.started
+
+    def to_dict(self):
+        elapsed = self.elapsed()
+        return {
+            'items': self.items,
+            'busy': self.busy,
+            'elapsed': elapsed,
+            'items_per_sec': self.items / elapsed if elapsed else 0.0,
+            'queue_size': self.maxsize,
+            'queue_avg': self.depth_total / self.puts if self.puts else 0.0,
+            'queue_max': self.depth_max,
+        }
+
+    def report(self):
+        data = self.to_dict()
+        return '{0:<10} {1:>9} {2:>10.1f} {3:>9.1f} {4:>9.1f} {5:>5}/{6}'.format(
+            self.name, data['items'], data['items_per_sec'], data['busy'],
+            data['queue_avg'], data['queue_max'], data['queue_size'])
+
+
+class Pipeline:
+    '''Конвейер из потоков, связанных ограниченными очередями.
+
+    source() запускает поток, который перебирает итератор (например, выборку
+    данных из БД) и складывает элементы в очередь, откуда их забирает
+    вызывающий поток. sink() запускает поток, который обрабатывает элементы,
+    переданные через put() (например, запись в файлы). Очереди ограничены,
+    так что быстрая стадия ждёт медленную, а память не растёт.
+
+    С depth=0 потоки не создаются и всё выполняется в вызывающем потоке.
+    Исключение в любой стадии останавливает конвейер и пробрасывается
+    в вызывающий поток из итерации, put() или close().
+    '''
+    def __init__(self, depth=2):
+        self.depth = depth
+        self.stages = []
+        self._threads = []
+        self._stop = threading.Event()
+        self._error = None
+        self._sink = None
+        self._sink_thread = None
+
+    def _fail(self, exc):
+        if self._error is None:
+            self._error = exc
+        self._stop.set()
+
+    def _check(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _put(self, stage, item):
+        stage.sample_depth()
+        while True:
+            try:
+                stage.queue.put(item, timeout=POLL_INTERVAL)
+                return
+            except queue.Full:
+                if self._stop.is_set():
+                    raise Stopped()
+
+    def _get(self, stage):
+        while True:
+            try:
+                return stage.queue.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                # sink дорабатывает очередь до конца, даже если остальные стадии остановлены
+                if self._stop.is_set() and stage is not self._sink:
+                    raise Stopped()
+
+    def _start(self, target, stage):
+        stage.started = time.perf_counter()
+        # поток наследует контекст (например, куда выводить сообщения профиля)
+        context = contextvars.copy_context()
+        thread = threading.Thread(target=context.run, args=(target,), name='pipeline-' + stage.name, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+        return thread
+
+    def source(self, name, items, size=None):
+        'Стадия, выполняющая итератор items в отдельном потоке.'
+        stage = Stage(name, size or self.depth)
+        self.stages.append(stage)
+
+        if not self.depth:
+            return self._iter_inline(stage, items)
+
+        def run():
+            try:
+                it = iter(items)
+                while True:
+                    started = time.perf_counter()
+                    try:
+                        item = next(it)
+                    except StopIteration:
+                        break
+                    finally:
+                        stage.busy += time.perf_counter() - started
+                    stage.items += 1
+                    self._put(stage, item)
+                self._put(stage, _DONE)
+            except Stopped:
+                pass
+            except BaseException as exc:
+                self._fail(exc)
+            finally:
+                stage.finished = time.perf_counter()
+
+        self._start(run, stage)
+        return self._iter_queue(stage)
+
+    def _iter_inline(self, stage, items):
+        stage.started = time.perf_counter()
+        it = iter(items)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(it)
+            except StopIteration:
+                break
+            finally:
+                stage.busy += time.perf_counter() - started
+            stage.items += 1
+            yield item
+        stage.finished = time.perf_counter()
+
+    def _iter_queue(self, stage):
+        while True:
+            try:
+                item = self._get(stage)
+            except Stopped:
+                self._check()
+                return
+            if item is _DONE:
+                return
+            yield item
+
+    def sink(self, name, func, size=None):
+        'Стадия, вызывающая func для каждого элемента из put() в отдельном потоке.'
+        stage = self._sink = Stage(name, size or self.depth)
+        stage.func = func
+        self.stages.append(stage)
+        if not self.depth:
+            stage.started = time.perf_counter()
+            return
+
+        def run():
+            try:
+                while True:
+                    item = self._get(stage)
+                    if item is _DONE:
+                        break
+                    started = time.perf_counter()
+                    func(item)
+                    stage.busy += time.perf_counter() - started
+                    stage.items += 1
+            except BaseException as exc:
+                self._fail(exc)
+            finally:
+                stage.finished = time.perf_counter()
+
+        self._sink_thread = self._start(run, stage)
+
+    def put(self, item):
+        stage = self._sink
+        if not self.depth:
+            started = time.perf_counter()
+            stage.func(item)
+            stage.busy += time.perf_counter() - started
+            stage.items += 1
+            return
+        self._check()
+        try:
+            self._put(stage, item)
+        except Stopped:
+            self._check()
+            raise
+
+    def timer(self, name):
+        'Счётчики стадии, которая работает в вызывающем потоке.'
+        stage = Stage(name)
+        stage.started = time.perf_counter()
+        self.stages.append(stage)
+        return stage
+
+    def close(self):
+        '''Дожидается, пока sink обработает всё поставленное, и останавливает
+        остальные стадии. Ошибка, случившаяся в стадии, пробрасывается.
+        '''
+        sink_thread = self._sink_thread
+        while sink_thread is not None and sink_thread.is_alive():
+            try:
+                self._sink.queue.put(_DONE, timeout=POLL_INTERVAL)
+                break
+            except queue.Full:
+                pass
+        if sink_thread is not None:
+            sink_thread.join()
+        self._stop.set()
+        for thread in self._threads:
+            thread.join()
+        now = time.perf_counter()
+        for stage in self.stages:
+            if stage.finished is None:
+                stage.finished = now
+        self._check()
+
+    def report(self):
+        lines = ['{0:<10} {1:>9} {2:>10} {3:>9} {4:>9} {5:>7}'.format(
+            'stage', 'items', 'items/sec', 'busy, s', 'queue avg', 'max')]
+        lines.extend(stage.report() for stage in self.stages)
+        return '\n'.join(lines)
@@ -0,0 +1,132 @@
+import time
+from ipaddress import ip_address
+
+
+# Проверки соответствий: (проверка в preflight.sql, соответствие в профиле,
+# как ключ записан в соответствии).
+MAPPING_CHECKS = [
+    ('groups', 'groups-map', str),
+    ('tariffs', 'tariffs-map', int),
+    ('tariffs-history', 'tariffs-map', int),
+    ('periodic-services', 'periodic-service-mapping', int),
+    ('credit-services', 'credit-service-mapping', int),
+    ('discounts', 'discounts-service-mapping', int),
+]
+
+# iptraf.users.user_type, для которых выгрузка ищет пул статических адресов
+PPPOE_USER_TYPES = {8}
+IPOE_USER_TYPES = {1, 6, 9}
+
+
+def format_range(start, end):
+    if start == end:
+        return str(ip_address(start))
+    return '{0}-{1}'.format(ip_address(start), ip_address(end))
+
+
+class Preflight:
+    '''Быстрая проверка соответствий профиля до выгрузки.
+
+    Вместо того чтобы выгружать лицевые и узнавать о пропусках из errors.log,
+    для всех лицевых профиля (по его фильтрам, без limit) выбираются сводные
+    значения: группы, тарифы, услуги, скидки и адреса, каждое с количеством
+    лицевых (preflight.sql). Каждое значение проверяется по groups-map,
+    tariffs-map, *-service-mapping и static-ip-pools один раз.
+
+    Находится всё, о чём выгрузка написала бы "no ... map" или "no ip pool",
+    и ещё ошибки подключений, которые выгрузка пропустила бы из-за
+    отсутствующего тарифа.
+    '''
+    def __init__(self, bde, tariffs_history_from=None):
+        self.bde = bde
+        self.tariffs_history_from = tariffs_history_from or bde._tariffs_history_from
+        self.accounts = 0
+        # проверка -> количество проверенных значений
+        self.checked = {}
+        # проверка -> [(значение, название, лицевых)], по убыванию лицевых
+        self.gaps = {}
+        # [(диапазон, подключений, лицевых)] без пула
+        self.ip_gaps = []
+        self.skipped = []
+        self.elapsed = 0
+
+    def _query(self, c, check, **args):
+        return c.execute('preflight.sql', check=check, filters=self.bde.filters, **args).fetchall()
+
+    def check_mapping(self, c, check, mapping_name, key_type):
+        mapping = self.bde.profile.get(mapping_name) or {}
+        args = {}
+        if check == 'tariffs-history':
+            if not self.tariffs_history_from:
+                self.skipped.append((check, 'no --tariffs-history-from'))
+                return
+            args['date_from'] = self.tariffs_history_from
+        if check == 'discounts' and not mapping:
+            # без соответствия скидки не выгружаются
+            self.skipped.append((check, 'no {0} in profile'.format(mapping_name)))
+            return
+        rows = self._query(c, check, **args)
+        gaps = [(r.item_id, r.item_name, r.accounts) for r in rows
+                if r.item_id is None or key_type(r.item_id) not in mapping]
+        self.checked[check] = len(rows)
+        self.gaps[check] = sorted(gaps, key=lambda gap: -gap[2])
+
+    def check_static_ips(self, c):
+        ranges = []
+        counts = []
+        for r in self._query(c, 'static-ips'):
+            if r.user_type in PPPOE_USER_TYPES:
+                # у PPPoE пул нужен только статическому адресу
+                if r.start_ip != r.end_ip or not r.start_ip:
+                    continue
+            elif r.user_type not in IPOE_USER_TYPES or r.start_ip is None:
+                continue
+            ranges.append((r.start_ip, r.end_ip))
+            counts.append((r.connections, r.accounts))
+        names, _ = self.bde.ip_pools.resolve_many(ranges)
+        gaps = [(format_range(*ip_range), connections, accounts)
+                for ip_range, name, (connections, accounts) in zip(ranges, names, counts) if name is None]
+        self.checked['static-ips'] = len(ranges)
+        self.ip_gaps = sorted(gaps, key=lambda gap: -gap[2])
+
+    def run(self):
+        started = time.perf_counter()
+        with self.bde.db.connect() as c:
+            r = c.execute('accounts-list.sql', estimate_count=True, filters=self.bde.filters).fetchone()
+            self.accounts = r.count
+            for check, mapping_name, key_type in MAPPING_CHECKS:
+                self.check_mapping(c, check, mapping_name, key_type)
+            self.check_static_ips(c)
+        self.elapsed = time.perf_counter() - started
+        return self.ok()
+
+    def ok(self):
+        return not any(self.gaps.values()) and not self.ip_gaps
+
+    def report(self):
+        lines = ['{0}: {1} accounts, checked in {2:.1f}s'.format(
+            self.bde.profile_name, self.accounts, self.elapsed)]
+        lines.append('{0:<20} {1:>8} {2:>8}'.format('check', 'values', 'missing'))
+        for check, mapping_name, _ in MAPPING_CHECKS:
+            if check in self.checked:
+                lines.append('{0:<20} {1:>8} {2:>8}'.format(check, self.checked[check], len(self.gaps[check])))
+        lines.append('{0:<20} {1:>8} {2:>8}'.format('static-ips', self.checked['static-ips'], len(self.ip_gaps)))
+        for check, reason in self.skipped:
+            lines.append('{0}: not checked, {1}'.format(check, reason))
+
+        for check, mapping_name, _ in MAPPING_CHECKS:
+            if not self.gaps.get(check):
+                continue
+            lines.append('')
+            lines.append('{0}: not in {1}:'.format(check, mapping_name))
+            for item_id, item_name, accounts in self.gaps[check]:
+                name = ' ("{0}")'.format(item_name) if item_name is not None and item_name != item_id else ''
+                lines.append('    {0}{1}: {2} accounts'.format(item_id, name, accounts))
+        if self.ip_gaps:
+            lines.append('')
+            lines.append('static-ips: not in static-ip-pools:')
+            for ip_range, connections, accounts in self.ip_gaps:
+                lines.append('    {0}: {1} connections, {2} accounts'.format(ip_range, connections, accounts))
+        lines.append('')
+        lines.append('OK' if self.ok() else 'GAPS FOUND')
+        return '\n'.join(lines)
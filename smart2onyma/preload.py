@@ -0,0 +1,302 @@
+import re
+import sys
+import heapq
+import pickle
+import tempfile
+from array import array
+from bisect import bisect_left
+from collections import namedtuple
+
+
+# Из строк предзагружаемых запросов оставляются только поля, которые
+# использует выгрузка: строка SQLAlchemy со всеми колонками весит в разы больше.
+PeriodicService = namedtuple('PeriodicService', 'id name price count_price amount status_date')
+CreditService = namedtuple('CreditService', 'type_id name credit_monthly_payment start_date end_date')
+PromisedPayment = namedtuple('PromisedPayment', 'amount expire_date')
+
+# все предзагрузки выгрузки лицевых, см. BillingDataExporter.load_preloads
+Preloads = namedtuple('Preloads', 'phone_pools iptv_ppoe_logins promised_payments '
+                                  'internet_periodic_services credit_services')
+
+
+# сколько записей пишется во временный файл одним pickle
+SPILL_BATCH = 1000
+# минимальный объём порции, сбрасываемой во временный файл
+MIN_SPILL_RUN = 2 ** 20
+
+
+def intern_str(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def parse_size(value):
+    '''Размер из профиля в байтах: число - мегабайты, или строка вида 512M, 2G.'''
+    if value is None:
+        return None
+    if isinstance(value, int):
+        return value * 2 ** 20
+    m = re.match(r'^\s*(\d+)\s*([KMG]?)B?\s*$', str(value), re.I)
+    if not m:
+        raise Exception('Invalid size: {0}'.format(value))
+    power = {'': 20, 'K': 10, 'M': 20, 'G': 30}[m.group(2).upper()]
+    return int(m.group(1)) * 2 ** power
+
+
+def record_size(record):
+    'Приблизительный объём записи в памяти вместе с полями.'
+    size = sys.getsizeof(record)
+    if isinstance(record, tuple):
+        size += sum(sys.getsizeof(value) for value in record)
+    return size
+
+
+class MemoryBudget:
+    '''Ограничение памяти на все предзагрузки выгрузки (memory-budget профиля).'''
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+
+    def remaining(self):
+        return self.limit - self.used
+
+
+class GroupedRecords:
+    '''Записи, сгруппированные по ключу (conn_id, номер лицевого и т.п.).
+
+    Пока идёт загрузка, ключи и записи копятся в двух списках. После build()
+    ключи сортируются, записи раскладываются одним плоским списком подряд по
+    ключам, а для поиска остаются отсортированные уникальные ключи и смещения
+    групп в array. Поиск группы - двоичный по ключам, без словаря на каждый
+    ключ. Для отсутствующего ключа возвращается пустой кортеж, как у
+    defaultdict(list).
+    '''
+    def __init__(self, name):
+        self.name = name
+        self._pending_keys = []
+        self._records = []
+        self._keys = []
+        self._offsets = array('q', [0])
+        self._footprint = None
+
+    def add(self, key, record):
+        self._pending_keys.append(key)
+        self._records.append(record)
+
+    def build(self):
+        keys = self._pending_keys
+        # сортировка устойчивая, порядок записей внутри группы сохраняется
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        self._records = [self._records[idx] for idx in order]
+
+        unique = []
+        offsets = array('q')
+        prev = None
+        for position, idx in enumerate(order):
+            key = keys[idx]
+            if not unique or key != prev:
+                unique.append(key)
+                offsets.append(position)
+                prev = key
+        offsets.append(len(order))
+
+        if all(isinstance(key, int) for key in unique):
+            self._keys = array('q', unique)
+        else:
+            self._keys = unique
+        self._offsets = offsets
+        self._pending_keys = []
+        return self
+
+    def _find(self, key):
+        idx = bisect_left(self._keys, key)
+        if idx < len(self._keys) and self._keys[idx] == key:
+            return idx
+        return None
+
+    def __contains__(self, key):
+        try:
+            return self._find(key) is not None
+        except TypeError:
+            return False
+
+    def __getitem__(self, key):
+        try:
+            idx = self._find(key)
+        except TypeError:
+            idx = None
+        if idx is None:
+            return ()
+        return self._records[self._offsets[idx]:self._offsets[idx + 1]]
+
+    def __len__(self):
+        return len(self._keys)
+
+    @property
+    def rows(self):
+        return len(self._records)
+
+    def footprint(self):
+        '''Приблизительный объём в байтах: контейнеры, записи и их поля.
+
+        Интернированные строки считаются один раз.
+        '''
+        if self._footprint is not None:
+            return self._footprint
+        seen = set()
+
+        def size(obj):
+            if isinstance(obj, str):
+                if id(obj) in seen:
+                    return 0
+                seen.add(id(obj))
+            return sys.getsizeof(obj)
+
+        total = size(self._keys) + size(self._offsets) + size(self._records)
+        if isinstance(self._keys, list):
+            total += sum(size(key) for key in self._keys)
+        for record in self._records:
+            total += size(record)
+            if isinstance(record, tuple):
+                total += sum(size(value) for value in record)
+        self._footprint = total
+        return total
+
+    def report(self):
+        return '{0}: {1} rows, {2} keys, {3:.1f} MiB'.format(
+            self.name, self.rows, len(self), self.footprint() / 2 ** 20)
+
+
+class SpilledGroups:
+    '''Предзагрузка, не поместившаяся в память и сброшенная во временные файлы.
+
+    Каждый файл - отсортированная по (номер лицевого, ключ) порция записей.
+    Порции сливаются при проходе по лицевым в том же порядке (sort-merge
+    join): advance(account_number) читает записи очередного лицевого и
+    строит по ним небольшой GroupedRecords, через который работают
+    __getitem__ и __contains__. Лицевые должны идти по возрастанию номера.
+    '''
+    def __init__(self, name, runs):
+        self.name = name
+        self.rows = 0
+        self._runs = runs
+        self._merged = None
+        self._pending = None
+        self._account = None
+        self._current = GroupedRecords(name).build()
+
+    def advance(self, account_number):
+        if self._account is not None and account_number <= self._account:
+            if account_number == self._account:
+                return
+            raise Exception('{0}: accounts must be exported in sorted order, got {1} after {2}'.format(
+                self.name, account_number, self._account))
+        if self._merged is None:
+            self._merged = heapq.merge(*[read_run(f) for f in self._runs], key=lambda e: e[:3])
+            self._pending = next(self._merged, None)
+        self._account = account_number
+
+        group = GroupedRecords(self.name)
+        while self._pending is not None and self._pending[0] <= account_number:
+            acc_num, key, _, record = self._pending
+            if acc_num == account_number:
+                group.add(key, record)
+            self._pending = next(self._merged, None)
+        self._current = group.build()
+
+    def __contains__(self, key):
+        return key in self._current
+
+    def __getitem__(self, key):
+        return self._current[key]
+
+    def close(self):
+        for f in self._runs:
+            f.close()
+        self._runs = []
+
+    def report(self):
+        return '{0}: {1} rows, spilled to {2} temporary files'.format(self.name, self.rows, len(self._runs))
+
+
+def spill(entries):
+    'Сортирует записи и пишет их во временный файл порциями по SPILL_BATCH.'
+    entries.sort(key=lambda e: e[:3])
+    f = tempfile.TemporaryFile()
+    for idx in range(0, len(entries), SPILL_BATCH):
+        pickle.dump(entries[idx:idx + SPILL_BATCH], f, protocol=pickle.HIGHEST_PROTOCOL)
+    f.flush()
+    return f
+
+
+def read_run(f):
+    'Записи временного файла, записанного spill(), по порядку.'
+    f.seek(0)
+    while True:
+        try:
+            batch = pickle.load(f)
+        except EOFError:
+            return
+        yield from batch
+
+
+def load_grouped(name, rows, key, make_record, budget=None, account_key=None):
+    '''Загрузка строк запроса в GroupedRecords, make_record проецирует строку в запись.
+
+    С budget (MemoryBudget) записи, которые в остаток бюджета не помещаются,
+    сбрасываются отсортированными по account_key (номер лицевого) порциями
+    во временные файлы, и вместо GroupedRecords возвращается SpilledGroups.
+    '''
+    if budget is None:
+        grouped = GroupedRecords(name)
+        for r in rows:
+            grouped.add(key(r), make_record(r))
+        return grouped.build()
+
+    limit = budget.remaining()
+    entries = []
+    size = 0
+    runs = []
+    count = 0
+    for r in rows:
+        record = make_record(r)
+        entries.append((account_key(r), key(r), count, record))
+        count += 1
+        # запись, кортеж и место в списке
+        size += record_size(record) + 120
+        if size > limit:
+            runs.append(spill(entries))
+            entries = []
+            size = 0
+            # Порции после первой не должны быть слишком мелкими, даже если
+            # бюджет уже исчерпан, иначе временных файлов будет слишком много.
+            limit = max(budget.limit // 8, MIN_SPILL_RUN)
+
+    if not runs:
+        grouped = GroupedRecords(name)
+        for _, group_key, _, record in entries:
+            grouped.add(group_key, record)
+        grouped.build()
+        budget.used += grouped.footprint()
+        return grouped
+
+    if entries:
+        runs.append(spill(entries))
+    spilled = SpilledGroups(name, runs)
+    spilled.rows = count
+    return spilled
+
+
+def periodic_service(r):
+    return PeriodicService(r.id, intern_str(r.name), r.price, r.count_price, r.amount, r.status_date)
+
+
+def credit_service(r):
+    return CreditService(r.type_id, intern_str(r.name), r.credit_monthly_payment, r.start_date, r.end_date)
+
+
+def promised_payment(r):
+    return PromisedPayment(r.amount, r.expire_date)
+
+
+def iptv_login(r):
+    return intern_str(r.login)
@@ -1,5 +1,7 @@
+{% from 'macros.sql' import match_key %}
 SELECT DISTINCT
 	 ac.id
+	,ac.account_number
 {% if acc_type == 'person' %}
 	,CASE addr.address_type
 		WHEN 0 THEN 'address-actual'
@@ -40,4 +42,4 @@ JOIN core.states state ON city.state_id = state.id
 
 WHERE
 	ac.parent_id IS NULL
-	AND ac.account_number = :account_number
+	AND {{ match_key('ac.account_number', 'account_number', bulk) }}
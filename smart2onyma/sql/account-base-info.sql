@@ -1,3 +1,4 @@
+{% from 'macros.sql' import match_key %}
 SELECT DISTINCT
 	 ac.id
 	,ac.balance
@@ -21,4 +22,4 @@ LEFT JOIN core.managers mn ON ac.manager_id = mn.id
 
 WHERE
 	ac.parent_id IS NULL
-	AND ac.account_number = :account_number
+	AND {{ match_key('ac.account_number', 'account_number', bulk) }}
@@ -1,6 +1,8 @@
 -- в процессе
+{% from 'macros.sql' import match_key %}
 SELECT DISTINCT
 	 ac.id
+	,ac.account_number
 	,co.name as co_name
 	,ei.external_id as eisup
 	,c_info.law_name
@@ -20,4 +22,4 @@ JOIN core.company_property_types cpt ON cpt.id = c_info.property_type
 JOIN eisup.contractors ei ON ei.company_id = co.id
 
 WHERE
-	ac.account_number = :account_number
+	{{ match_key('ac.account_number', 'account_number', bulk) }}
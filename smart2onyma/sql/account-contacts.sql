@@ -1,5 +1,7 @@
+{% from 'macros.sql' import match_key %}
 SELECT DISTINCT
 	 ac.id
+	,ac.account_number
 	,i.info
 	,CASE i.type
 		WHEN 1 THEN 'phone-payment'  -- обычный
@@ -15,4 +17,4 @@ FROM core.accounts ac
 JOIN core.contact_infos i ON (i.company_id = ac.company_id AND ac.company_id IS NOT NULL) OR (i.person_id = ac.person_id AND ac.person_id IS NOT NULL)
 
 WHERE
-	ac.account_number = :account_number
+	{{ match_key('ac.account_number', 'account_number', bulk) }}
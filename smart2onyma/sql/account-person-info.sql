@@ -1,5 +1,7 @@
+{% from 'macros.sql' import match_key %}
 SELECT DISTINCT
 	 ac.id
+	,ac.account_number
 	,person.birth_day
 	,person.birth_place
 	,person.secret_word
@@ -19,4 +21,4 @@ JOIN core.person_infos_enddate p_info ON ac.person_id = p_info.person_id AND p_i
 
 WHERE
 	ac.parent_id IS NULL
-	AND ac.account_number = :account_number
+	AND {{ match_key('ac.account_number', 'account_number', bulk) }}
@@ -1,12 +1,19 @@
+{% from 'macros.sql' import account_filters %}
 SELECT
 	{% if estimate_count %}
 	COUNT(*) as count
 	{% else %}
 	account_number
+	{% if filter_sets %}
+	, person_id, company_id, base_company_id
+	{% endif %}
 	{% endif %}
 FROM (
 	SELECT DISTINCT
 		ac.account_number
+		{% if filter_sets %}
+		, ac.person_id, ac.company_id, ac.base_company_id
+		{% endif %}
 
 	FROM core.accounts ac
 	JOIN core.accounts child ON child.parent_id = ac.id AND ac.parent_id IS NULL
@@ -15,19 +22,12 @@ FROM (
 	WHERE
 		(status.status IN (1, 3, 4)
 			OR (status.status = 5 AND status.start_date > (CURRENT_DATE - 360)))
-		{% if 'person' in filters %}
-		AND ac.person_id IS NOT NULL
-		{% endif %}
-		{% if 'company' in filters %}
-		AND ac.company_id IS NOT NULL
-		{% endif %}
-		{% if 'account' in filters %}
-		AND ac.account_number = '{{filters.account.number}}'
-		{% endif %}
-		{% if 'prefix' in filters %}
-		AND ac.account_number LIKE '{{filters.prefix.value}}%'
-		{% endif %}
-		{% if 'base_company' in filters %}
-		AND ac.base_company_id = {{filters.base_company.id}}
+		{% if filter_sets %}
+		-- общий проход для нескольких профилей: лицевые, подходящие хотя бы одному
+		AND ({% for filter_set in filter_sets %}{% if not loop.first %} OR {% endif %}(1 = 1
+		{{ account_filters(filter_set) }}
+		){% endfor %})
+		{% else %}
+		{{ account_filters(filters) }}
 		{% endif %}
 ) lst
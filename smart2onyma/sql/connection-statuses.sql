@@ -1,5 +1,7 @@
+{% from 'macros.sql' import match_key %}
 SELECT
-   status.start_date
+	 status.account_id as conn_id
+	,status.start_date
 	,case status.status
 		when 1 then 'paused-by-system'  -- новый
 		when 3 then 'active'  -- активный
@@ -7,5 +9,5 @@ SELECT
 		when 5 then 'paused-by-operator' -- заблокированый
 	 end as status
 FROM core.account_statuses status
-WHERE status.account_id = :conn_id
+WHERE {{ match_key('status.account_id', 'conn_id', bulk) }}
 ORDER BY status.start_date
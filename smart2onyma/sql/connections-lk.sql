@@ -1,3 +1,4 @@
+{% from 'macros.sql' import match_key %}
 SELECT DISTINCT
 	 ac.id as account_id
 	,ac.account_number
@@ -12,4 +13,5 @@ JOIN core.web_users wu ON (wu.person_id = ac.person_id AND ac.person_id IS NOT N
 WHERE
 	wu.status <= 2
 	AND wu.suspend_date IS NULL
-	AND ac.account_number = :account_number
+	AND {{ match_key('ac.account_number', 'account_number', bulk) }}
+ORDER BY conn_id
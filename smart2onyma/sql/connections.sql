@@ -1,3 +1,4 @@
+{% from 'macros.sql' import match_key %}
 SELECT DISTINCT
 	 ac.id as account_id
 	,ac.account_number
@@ -79,10 +80,13 @@ WHERE
 	AND u.service_type = 3
 {% elif c_type == 'phone' %}
 	AND u.service_type = 4
-	AND t.name != '---БЕЗ ТАРИФА---'  -- игнорируем ОА с МТС
+	-- игнорируем ОА с МТС; строка выводится через {{ }}, иначе "--" в ней
+	-- считается началом комментария шаблона
+	AND t.name != {{ "'---БЕЗ ТАРИФА---'" }}
 {% elif c_type == 'ctv' %}
 	AND u.service_type = 10
 {% elif c_type == 'npl' %}
   AND u.service_type = 2
 {% endif %}
-	AND ac.account_number = :account_number
+	AND {{ match_key('ac.account_number', 'account_number', bulk) }}
+ORDER BY conn_id
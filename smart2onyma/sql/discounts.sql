@@ -1,4 +1,6 @@
+{% from 'macros.sql' import match_key %}
 SELECT 
+       u.account_id as conn_id,
        dh.discount_id,
        dh.start_date,
        dh.end_date,
@@ -6,4 +8,4 @@ SELECT
 FROM core.discount_history dh, core.users u
 WHERE (end_date IS NULL OR end_date > now())
 AND u.id = dh.user_id
-AND u.account_id = :conn_id
+AND {{ match_key('u.account_id', 'conn_id', bulk) }}
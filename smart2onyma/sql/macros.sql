@@ -0,0 +1,26 @@
+{#- Условие отбора по ключу: по одному значению :name или, в пакетном режиме
+    (bulk), по списку значений :keys. -#}
+{% macro match_key(column, name, bulk) -%}
+{% if not bulk %}{{ column }} = :{{ name }}
+{%- elif sql_dialect == 'postgres' %}{{ column }} = ANY(:keys)
+{%- else %}{{ column }} IN :keys{% endif %}
+{%- endmacro %}
+
+{#- Фильтры профиля для лицевого ac, каждый - условие, начинающееся с AND. -#}
+{% macro account_filters(filters) -%}
+		{% if 'person' in filters %}
+		AND ac.person_id IS NOT NULL
+		{% endif %}
+		{% if 'company' in filters %}
+		AND ac.company_id IS NOT NULL
+		{% endif %}
+		{% if 'account' in filters %}
+		AND ac.account_number = '{{filters.account.number}}'
+		{% endif %}
+		{% if 'prefix' in filters %}
+		AND ac.account_number LIKE '{{filters.prefix.value}}%'
+		{% endif %}
+		{% if 'base_company' in filters %}
+		AND ac.base_company_id = {{filters.base_company.id}}
+		{% endif %}
+{%- endmacro %}
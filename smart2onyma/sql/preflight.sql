@@ -0,0 +1,99 @@
+{% from 'macros.sql' import account_filters %}
+{#- Сводные запросы preflight: значения, которые выгрузка ищет в соответствиях
+    профиля, с количеством лицевых. Лицевые и подключения - те же, что
+    выбирают accounts-list.sql и connections.sql. -#}
+{% if check == 'groups' %}
+{% set item_id, item_name = 'grp.name', 'grp.name' %}
+{% elif check == 'tariffs' %}
+{% set item_id, item_name = 'th.tariff_id', 't.name' %}
+{% elif check == 'tariffs-history' %}
+{% set item_id, item_name = 'hist_th.tariff_id', 'hist_t.name' %}
+{% elif check in ('periodic-services', 'credit-services') %}
+{% set item_id, item_name = 'st.id', 'st.name' %}
+{% elif check == 'discounts' %}
+{% set item_id, item_name = 'dh.discount_id', None %}
+{% endif %}
+SELECT
+{% if check == 'static-ips' %}
+	 ip_u.start_ip
+	,ip_u.end_ip
+	,ip_u.user_type
+	,COUNT(DISTINCT child.id) AS connections
+{% else %}
+	 {{ item_id }} AS item_id
+	,{{ item_name or 'NULL' }} AS item_name
+{% endif %}
+	,COUNT(DISTINCT ac.account_number) AS accounts
+
+FROM core.accounts ac
+JOIN core.accounts child ON child.parent_id = ac.id AND ac.parent_id IS NULL
+JOIN core.account_statuses_enddate status ON child.id = status.account_id AND status.end_date IS NULL
+
+{% if check == 'groups' %}
+JOIN core.groups grp ON ac.group_id = grp.id
+{% else %}
+JOIN core.users u ON child.id = u.account_id
+{% endif %}
+{% if check in ('tariffs', 'tariffs-history', 'discounts', 'periodic-services', 'static-ips') %}
+JOIN core.tariff_history_enddate th ON (
+    status.account_id = th.account_id AND th.start_date <= CURRENT_DATE
+    AND (th.end_date > CURRENT_DATE OR th.end_date IS NULL)
+    )
+JOIN core.tariffs t ON t.id = th.tariff_id
+{% endif %}
+{% if check == 'tariffs-history' %}
+JOIN core.tariff_history_enddate hist_th ON (
+    child.id = hist_th.account_id AND hist_th.start_date >= to_date(:date_from, 'yyyy-mm-dd')
+    AND (hist_th.end_date > CURRENT_DATE OR hist_th.end_date IS NULL)
+    )
+JOIN core.tariffs hist_t ON hist_t.id = hist_th.tariff_id
+{% elif check == 'periodic-services' %}
+JOIN core.service_items si ON si.account_id = child.id
+JOIN core.service_types st ON si.type_id = st.id AND st.type = 3
+JOIN core.service_pricelists spl ON spl.tariff_id = t.id AND spl.end_date IS NULL
+JOIN core.service_prices spr ON spr.pricelist_id = spl.id AND spr.type_id = si.type_id
+JOIN core.service_item_statuses sist ON sist.service_item_id = si.id AND sist.end_date IS NULL AND sist.status = 2
+{% elif check == 'credit-services' %}
+JOIN core.service_items si ON si.account_id = child.id
+	AND CAST(si.have_credit AS INT) = 1
+JOIN core.service_types st ON st.id = si.type_id
+{% elif check == 'discounts' %}
+JOIN core.discount_history dh ON dh.user_id = u.id AND (dh.end_date IS NULL OR dh.end_date > now())
+{% elif check == 'static-ips' %}
+JOIN iptraf.users ip_u ON ip_u.user_id = u.id AND ip_u.end_date IS NULL
+{% endif %}
+
+WHERE
+	(status.status IN (1, 3, 4)
+		OR (status.status = 5 AND status.start_date > (CURRENT_DATE - 360)))
+{% if check in ('tariffs', 'tariffs-history', 'discounts') %}
+	-- подключения, которые выгружает connections.sql (кроме личного кабинета)
+	AND (u.service_type IN (2, 10)
+		OR (u.service_type = 3 AND EXISTS (
+			SELECT 1 FROM iptraf.users ip_u WHERE ip_u.user_id = u.id AND ip_u.end_date IS NULL))
+		OR (u.service_type = 4 AND t.name != {{ "'---БЕЗ ТАРИФА---'" }} AND EXISTS (
+			SELECT 1 FROM phone.users ph_u JOIN phone.exchanges ats ON ats.id = ph_u.exchange_id
+			WHERE ph_u.user_id = u.id AND ph_u.end_date IS NULL)))
+{% elif check == 'periodic-services' %}
+	-- условия service-for-internet.sql
+	AND (status.status IN (1, 3)
+		OR (status.status IN (4, 5) AND status.start_date > (CURRENT_DATE - 90)))
+	AND u.service_type = 3
+{% elif check == 'credit-services' %}
+	-- условия service-with-credit.sql: есть списания после начала месяца
+	AND EXISTS (
+		SELECT 1 FROM core.service_item_charges ch
+		WHERE ch.item_id = si.id AND ch.start_date > date_trunc('month', CURRENT_DATE))
+{% elif check == 'static-ips' %}
+	AND u.service_type = 3
+{% endif %}
+	{{ account_filters(filters) }}
+
+GROUP BY
+{% if check == 'static-ips' %}
+	ip_u.start_ip, ip_u.end_ip, ip_u.user_type
+{% elif item_name and item_name != item_id %}
+	{{ item_id }}, {{ item_name }}
+{% else %}
+	{{ item_id }}
+{% endif %}
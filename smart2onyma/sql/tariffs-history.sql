@@ -1,3 +1,4 @@
+{% from 'macros.sql' import match_key %}
 SELECT DISTINCT
 	 ac.id as account_id
 	,ac.account_number
@@ -17,4 +18,4 @@ JOIN core.tariff_history_enddate th ON (
 JOIN core.tariffs t ON t.id = th.tariff_id
 
 WHERE
-	child.id = :conn_id
+	{{ match_key('child.id', 'conn_id', bulk) }}
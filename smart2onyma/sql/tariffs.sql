@@ -1,32 +1,12 @@
-SELECT t.id,
-       t.name,
-       t.service_type,
-       t.prepay_fee,
-       t.status,
-       t.create_date,
-       t.modify_date,
-       ttl.period,
-       ttl.next_tariff_id,
-       pr.fee,
-       tc.cnt,
-       t.forperson,
-       t.forcompany
-FROM core.tariffs t
-JOIN core.tariff_base_companies tbc ON tbc.tariff_id = t.id
-LEFT JOIN core.tariff_time_limits ttl ON (t.id = ttl.tariff_id)
-
-{% if phone_tariffs %}
-LEFT JOIN phone.pricelists_enddate pr
-{% elif ctv_tariffs %}
-LEFT JOIN tv.pricelists_enddate pr
-{% elif npl_tariffs %}
-LEFT JOIN npl.pricelists_enddate pr
-{% else %}
-LEFT JOIN iptraf.pricelists_enddate pr
-{% endif %}
-    ON (t.id = pr.tariff_id AND pr.end_date IS NULL)
-
-JOIN (
+{#- Тарифы всех видов услуг одним запросом: подзапрос на каждый вид (family),
+    каждый со своим прейскурантом, число лицевых на тарифах считается один раз. -#}
+{% set families = [
+  ('internet', 'iptraf', 't.service_type = 3'),
+  ('phone', 'phone', 't.service_type in (4, 6)'),
+  ('ctv', 'tv', 't.service_type = 10'),
+  ('npl', 'npl', 't.service_type = 2'),
+] %}
+WITH tc AS (
   SELECT
     th.tariff_id,
     COUNT(status.account_id) cnt
@@ -39,25 +19,44 @@ JOIN (
     status.end_date IS NULL AND
     {% include 'where-recent-90days.sql' %}
   GROUP BY th.tariff_id
-) tc ON (tc.tariff_id = t.id)
-
-WHERE
-{% if phone_tariffs %}
-  t.service_type in (4, 6)
-{% elif ctv_tariffs %}
-	t.service_type = 10
-{% elif npl_tariffs %}
-  t.service_type = 2
-{% else %}
--- интернет
-  t.service_type = 3
-{% endif %}
-
-{% if company %}
-  AND t.forcompany = 1
-{% elif person %}
-  AND t.forperson = 1
-{% endif %}
-{% if 'base_company' in filters %}
-  AND tbc.base_company_id = {{filters.base_company.id}}
+)
+SELECT *
+FROM (
+{% for family, schema, condition in families %}
+{% if not loop.first %}
+  UNION ALL
 {% endif %}
+  SELECT '{{family}}' AS family,
+         {{loop.index}} AS family_order,
+         t.id,
+         t.name,
+         t.service_type,
+         t.prepay_fee,
+         t.status,
+         t.create_date,
+         t.modify_date,
+         ttl.period,
+         ttl.next_tariff_id,
+         pr.fee,
+         tc.cnt,
+         t.forperson,
+         t.forcompany
+  FROM core.tariffs t
+  JOIN core.tariff_base_companies tbc ON tbc.tariff_id = t.id
+  LEFT JOIN core.tariff_time_limits ttl ON (t.id = ttl.tariff_id)
+  LEFT JOIN {{schema}}.pricelists_enddate pr ON (t.id = pr.tariff_id AND pr.end_date IS NULL)
+  JOIN tc ON (tc.tariff_id = t.id)
+  WHERE
+    {{condition}}
+  {% if company %}
+    AND t.forcompany = 1
+  {% elif person %}
+    AND t.forperson = 1
+  {% endif %}
+  {% if 'base_company' in filters %}
+    AND tbc.base_company_id = {{filters.base_company.id}}
+  {% endif %}
+{% endfor %}
+) tariffs
+-- виды услуг выгружаются по порядку, как раньше отдельными запросами
+ORDER BY family_order, id
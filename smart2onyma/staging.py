@@ -0,0 +1,185 @@
+import io
+import csv
+import threading
+
+import sqlalchemy
+
+from . import db
+
+
+# сколько строк загружается в таблицу за раз
+DEFAULT_BATCH_SIZE = 10000
+
+# тип колонок промежуточных таблиц: все значения пишутся текстом, как в файлах
+COLUMN_TYPES = {
+    'postgres': 'text',
+    'oracle': 'VARCHAR2(4000)',
+    'sqlite': 'TEXT',
+}
+
+
+class CopyDialect(csv.Dialect):
+    'Формат данных для COPY ... FROM STDIN (FORMAT csv).'
+    delimiter = ';'
+    quotechar = '"'
+    doublequote = True
+    skipinitialspace = False
+    lineterminator = '\n'
+    quoting = csv.QUOTE_MINIMAL
+
+
+class StagingDatabase:
+    '''Промежуточная база Онимы (output: staging в профиле).
+
+    Вместо файлов выгрузки строки пишутся в таблицы с теми же полями, что
+    и форматы export-files в maps.yaml: таблица <prefix><имя набора>, все
+    колонки текстовые. Таблицы создаются при первом открытии. Загрузка идёт
+    пачками по batch_size: в PostgreSQL через COPY FROM STDIN, в остальных
+    базах через executemany (в Oracle - с привязкой массивов).
+
+    Все таблицы пишутся через одно подключение, каждая пачка загружается
+    под блокировкой, фиксируется транзакция при sync() и закрытии таблицы.
+    '''
+    def __init__(self, sql_dialect, connection_uri, table_prefix='', batch_size=None):
+        if sql_dialect not in COLUMN_TYPES:
+            raise Exception('Unknown staging SQL dialect: {0}'.format(sql_dialect))
+        self.sql_dialect = sql_dialect
+        self.table_prefix = table_prefix
+        self.batch_size = batch_size or DEFAULT_BATCH_SIZE
+        engine_args = {}
+        if sql_dialect == 'sqlite':
+            # таблицы открываются в одном потоке, а пишутся в потоке записи конвейера
+            engine_args['connect_args'] = {'check_same_thread': False}
+        self.engine = sqlalchemy.create_engine(db.connection_string(sql_dialect, connection_uri), **engine_args)
+        self._conn = None
+        self._lock = threading.Lock()
+        self._tables = set()
+
+    @classmethod
+    def from_profile(cls, profile):
+        if profile.get('output', 'files') == 'files':
+            return None
+        if profile['output'] != 'staging':
+            raise Exception('Unknown output: {0}'.format(profile['output']))
+        return cls(profile['staging-sql-dialect'], profile['staging-connection-uri'],
+                   profile.get('staging-table-prefix', ''), profile.get('staging-batch-size'))
+
+    @property
+    def connection(self):
+        if self._conn is None:
+            self._conn = self.engine.raw_connection()
+        return self._conn
+
+    def table_name(self, export_file):
+        return self.table_prefix + export_file.replace('-', '_')
+
+    def create_table_sql(self, table, fields):
+        column_type = COLUMN_TYPES[self.sql_dialect]
+        return 'CREATE TABLE {0} ({1})'.format(
+            table, ', '.join('"{0}" {1}'.format(field, column_type) for field in fields))
+
+    def _execute(self, sql):
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(sql)
+        finally:
+            cursor.close()
+
+    def prepare(self, table, fields, clear=False):
+        'Создаёт таблицу, если её нет, с clear - очищает.'
+        with self._lock:
+            if table not in self._tables:
+                if not self.engine.has_table(table):
+                    self._execute(self.create_table_sql(table, fields))
+                self._tables.add(table)
+            elif not clear:
+                return
+            if clear:
+                if self.sql_dialect == 'sqlite':
+                    self._execute('DELETE FROM {0}'.format(table))
+                else:
+                    self._execute('TRUNCATE TABLE {0}'.format(table))
+            self.connection.commit()
+
+    def open_table(self, table, fields, mode='a'):
+        self.prepare(table, fields, clear='w' in mode)
+        return StagingTable(self, table, fields)
+
+    def load(self, table, fields, rows):
+        'Загружает пачку строк (списков текстовых значений) в таблицу.'
+        columns = ', '.join('"{0}"'.format(field) for field in fields)
+        with self._lock:
+            cursor = self.connection.cursor()
+            try:
+                if self.sql_dialect == 'postgres':
+                    buf = io.StringIO()
+                    csv.writer(buf, CopyDialect).writerows(rows)
+                    buf.seek(0)
+                    # пустые поля остаются пустыми строками, а не NULL, как в файлах
+                    cursor.copy_expert(
+                        'COPY {0} ({1}) FROM STDIN WITH (FORMAT csv, DELIMITER \';\', FORCE_NOT_NULL ({1}))'.format(
+                            table, columns), buf)
+                elif self.sql_dialect == 'oracle':
+                    placeholders = ', '.join(':{0}'.format(idx) for idx in range(1, len(fields) + 1))
+                    cursor.executemany('INSERT INTO {0} ({1}) VALUES ({2})'.format(table, columns, placeholders), rows)
+                else:
+                    placeholders = ', '.join('?' for _ in fields)
+                    cursor.executemany('INSERT INTO {0} ({1}) VALUES ({2})'.format(table, columns, placeholders), rows)
+            finally:
+                cursor.close()
+
+    def commit(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+class StagingTable:
+    '''Таблица промежуточной базы с интерфейсом csv.writer для export.Writer.
+
+    Строки копятся в памяти и загружаются пачками, tell() возвращает объём
+    загруженных значений в байтах (UTF-8), как размер файла без сжатия.
+    '''
+    def __init__(self, staging, table, fields):
+        self.staging = staging
+        self.name = table
+        self.fields = fields
+        self._rows = []
+        self._size = 0
+
+    def _flush_rows(self):
+        if self._rows:
+            self.staging.load(self.name, self.fields, self._rows)
+            self._rows = []
+
+    def writerow(self, record):
+        # последнее пустое поле записи нужно только для завершающего ";" в файлах
+        row = [value if isinstance(value, str) else str(value) for value in record[:len(self.fields)]]
+        self._size += sum(len(value.encode()) for value in row)
+        self._rows.append(row)
+        if len(self._rows) >= self.staging.batch_size:
+            self._flush_rows()
+
+    def writerows(self, records):
+        for record in records:
+            self.writerow(record)
+
+    def tell(self):
+        return self._size
+
+    def flush(self):
+        self._flush_rows()
+        self.staging.commit()
+
+    def sync(self):
+        self.flush()
+        return self._size
+
+    def close(self):
+        self.flush()
@@ -0,0 +1,235 @@
+import sys
+import json
+import math
+import time
+from functools import wraps
+from collections import Counter
+
+
+# шаг корзин гистограммы длительностей - четверть октавы
+HISTOGRAM_BASE = 2 ** 0.25
+
+
+class Timing:
+    '''Количество, суммарная длительность и гистограмма длительностей.
+
+    Длительности раскладываются по логарифмическим корзинам, так что
+    перцентили считаются приблизительно, зато память не растёт с числом
+    замеров и данные из нескольких процессов можно сложить.
+    '''
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.rows = 0
+        self.histogram = Counter()
+
+    def add(self, seconds, rows=0):
+        self.count += 1
+        self.total += seconds
+        self.rows += rows
+        if seconds > 0:
+            self.histogram[math.ceil(math.log(seconds, HISTOGRAM_BASE))] += 1
+        else:
+            self.histogram[None] += 1
+
+    def percentile(self, p):
+        rank = self.count * p / 100
+        seen = 0
+        buckets = sorted(self.histogram.items(), key=lambda item: -math.inf if item[0] is None else item[0])
+        for bucket, count in buckets:
+            seen += count
+            if seen >= rank:
+                return 0.0 if bucket is None else HISTOGRAM_BASE ** bucket
+        return 0.0
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.rows += other.rows
+        self.histogram.update(other.histogram)
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'avg': self.total / self.count if self.count else 0.0,
+            'p95': self.percentile(95),
+            'rows': self.rows,
+            'histogram': [[bucket, count] for bucket, count in self.histogram.items()],
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        timing = cls()
+        timing.count = data['count']
+        timing.total = data['total']
+        timing.rows = data['rows']
+        timing.histogram = Counter({bucket: count for bucket, count in data['histogram']})
+        return timing
+
+
+class ProfiledResult:
+    'Результат запроса, который считает строки и время их получения.'
+    def __init__(self, result, timing, elapsed):
+        self._result = result
+        self._timing = timing
+        self._elapsed = elapsed
+        self._rows = 0
+        self._done = False
+
+    def __getattr__(self, name):
+        return getattr(self._result, name)
+
+    def _finish(self):
+        if not self._done:
+            self._done = True
+            self._timing.add(self._elapsed, self._rows)
+
+    def __del__(self):
+        self._finish()
+
+    def __iter__(self):
+        rows = iter(self._result)
+        while True:
+            started = time.perf_counter()
+            try:
+                row = next(rows)
+            except StopIteration:
+                self._elapsed += time.perf_counter() - started
+                self._finish()
+                return
+            self._elapsed += time.perf_counter() - started
+            self._rows += 1
+            yield row
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = self._result.fetchone()
+        self._elapsed += time.perf_counter() - started
+        if row is not None:
+            self._rows += 1
+        self._finish()
+        return row
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = self._result.fetchall()
+        self._elapsed += time.perf_counter() - started
+        self._rows += len(rows)
+        self._finish()
+        return rows
+
+    def fetchmany(self, size=None):
+        started = time.perf_counter()
+        rows = self._result.fetchmany(size)
+        self._elapsed += time.perf_counter() - started
+        self._rows += len(rows)
+        if not rows:
+            self._finish()
+        return rows
+
+
+class Stats:
+    '''Статистика выгрузки: запросы по шаблонам, функции выгрузки, файлы.
+
+    Время запроса - выполнение и получение всех строк результата.
+    '''
+    def __init__(self):
+        self.queries = {}
+        self.functions = {}
+        self.writers = {}
+        self.accounts = 0
+        self.elapsed = 0.0
+        self._started = None
+
+    def _timing(self, group, name):
+        timing = group.get(name)
+        if timing is None:
+            timing = group[name] = Timing()
+        return timing
+
+    def start(self):
+        self._started = time.perf_counter()
+
+    def stop(self):
+        self.elapsed += time.perf_counter() - self._started
+
+    def execute(self, template, execute, *args, **kwargs):
+        started = time.perf_counter()
+        result = execute(*args, **kwargs)
+        return ProfiledResult(result, self._timing(self.queries, template), time.perf_counter() - started)
+
+    def add_function(self, name, seconds):
+        self._timing(self.functions, name).add(seconds)
+
+    def timed(self, func):
+        'Декоратор, замеряющий время вызовов функции.'
+        timing = self._timing(self.functions, func.__name__)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timing.add(time.perf_counter() - started)
+        return wrapper
+
+    def add_writer(self, filename, rows, size):
+        counts = self.writers.setdefault(filename, {'rows': 0, 'bytes': 0})
+        counts['rows'] += rows
+        counts['bytes'] += size
+
+    def merge(self, other):
+        for group, other_group in ((self.queries, other.queries), (self.functions, other.functions)):
+            for name, timing in other_group.items():
+                self._timing(group, name).merge(timing)
+        for filename, counts in other.writers.items():
+            self.add_writer(filename, counts['rows'], counts['bytes'])
+        self.accounts += other.accounts
+
+    def to_dict(self):
+        return {
+            'accounts': self.accounts,
+            'elapsed': self.elapsed,
+            'accounts_per_sec': self.accounts / self.elapsed if self.elapsed else 0.0,
+            'queries': {name: timing.to_dict() for name, timing in self.queries.items()},
+            'functions': {name: timing.to_dict() for name, timing in self.functions.items()},
+            'writers': self.writers,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        stats = cls()
+        stats.accounts = data['accounts']
+        stats.elapsed = data['elapsed']
+        stats.queries = {name: Timing.from_dict(t) for name, t in data['queries'].items()}
+        stats.functions = {name: Timing.from_dict(t) for name, t in data['functions'].items()}
+        stats.writers = data['writers']
+        return stats
+
+    def save(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1)
+
+    def report(self, file=None):
+        file = file or sys.stdout
+        row_format = '{0:<40} {1:>9} {2:>10} {3:>9} {4:>9} {5:>10}'
+        for title, group in (('query', self.queries), ('function', self.functions)):
+            print(row_format.format(title, 'count', 'total, s', 'avg, ms', 'p95, ms', 'rows'), file=file)
+            items = sorted((item for item in group.items() if item[1].count), key=lambda item: -item[1].total)
+            for name, t in items:
+                print(row_format.format(
+                    name, t.count, '{0:.3f}'.format(t.total),
+                    '{0:.3f}'.format(t.total / t.count * 1000 if t.count else 0),
+                    '{0:.3f}'.format(t.percentile(95) * 1000), t.rows), file=file)
+            print(file=file)
+
+        print('{0:<40} {1:>9} {2:>12}'.format('file', 'rows', 'bytes'), file=file)
+        for filename, counts in sorted(self.writers.items()):
+            print('{0:<40} {1:>9} {2:>12}'.format(filename, counts['rows'], counts['bytes']), file=file)
+        print(file=file)
+
+        rate = self.accounts / self.elapsed if self.elapsed else 0.0
+        print('accounts: {0}, elapsed: {1:.1f} s, {2:.1f} accounts/sec'.format(
+            self.accounts, self.elapsed, rate), file=file)
@@ -0,0 +1,282 @@
+import os
+import csv
+import hashlib
+from array import array
+from bisect import bisect_left
+
+from . import compression
+from .mapper import maps
+from .compression import open_read
+
+
+# Ссылки между файлами выгрузки: (набор записей, поле) должно найтись в
+# (родительский набор, поле).
+REFERENCES = [
+    ('connections-props', 'USRCONNID', 'connections-list', 'USRCONNID'),
+    ('connections-status-history', 'USRCONNID', 'connections-list', 'USRCONNID'),
+    ('tariffs-personal', 'USRCONNID', 'connections-list', 'USRCONNID'),
+    ('accounts-attrs', 'ABONID', 'accounts-list', 'ABONID'),
+    ('connections-names', 'ABONID', 'accounts-list', 'ABONID'),
+    ('promised-payments', 'ABONID', 'accounts-list', 'ABONID'),
+    ('balances-list', 'DOGCODE', 'accounts-list', 'DOGCODE'),
+    ('payments-list', 'DOGCODE', 'accounts-list', 'DOGCODE'),
+    ('promised-payments', 'DOGCODE', 'accounts-list', 'DOGCODE'),
+]
+# поля, значения которых не должны повторяться
+UNIQUE = [
+    ('connections-list', 'USRCONNID'),
+    ('connections-list', 'SITENAME'),
+]
+# поля с целыми значениями, остальные ключи - строки
+INTEGER_FIELDS = {'USRCONNID', 'ABONID'}
+
+# сколько примеров ошибок показывать для каждой проверки
+MAX_EXAMPLES = 10
+# битовая карта вместо отсортированного массива, если диапазон ключей
+# не больше стольких значений на ключ (т.е. не больше 8 байт на ключ)
+BITMAP_MAX_SPARSITY = 64
+
+
+def string_key(value):
+    '''64-битный хэш строкового ключа: в наборе хранятся 8 байт вместо строки.
+
+    Вероятность совпадения хэшей разных ключей для миллионов строк -
+    порядка 1e-7, так что пропуск ошибки из-за неё можно не учитывать.
+    '''
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'little', signed=True)
+
+
+class KeySet:
+    '''Компактное множество целых ключей родительского файла.
+
+    Пока идёт чтение, ключи копятся в array. build() превращает их в
+    битовую карту по диапазону ключей, если ключи плотные (USRCONNID,
+    ABONID обычно идут подряд), иначе в отсортированный array для двоичного
+    поиска. Заодно находятся повторяющиеся ключи.
+    '''
+    def __init__(self):
+        self._values = array('q')
+        self._bitmap = None
+        self._sorted = None
+        self._min = 0
+        self.duplicates = array('q')
+        self.duplicates_count = 0
+
+    def add(self, value):
+        self._values.append(value)
+
+    def _duplicate(self, value):
+        self.duplicates_count += 1
+        if len(self.duplicates) < MAX_EXAMPLES:
+            self.duplicates.append(value)
+
+    def build(self):
+        values = self._values
+        self._values = None
+        if not values:
+            self._sorted = values
+            return self
+        lo, hi = min(values), max(values)
+        span = hi - lo + 1
+        if span <= BITMAP_MAX_SPARSITY * len(values):
+            bitmap = bytearray((span + 7) // 8)
+            for value in values:
+                idx = value - lo
+                bit = 1 << (idx & 7)
+                if bitmap[idx >> 3] & bit:
+                    self._duplicate(value)
+                bitmap[idx >> 3] |= bit
+            self._bitmap = bitmap
+            self._min = lo
+            self._span = span
+        else:
+            values = array('q', sorted(values))
+            for idx in range(1, len(values)):
+                if values[idx] == values[idx - 1]:
+                    self._duplicate(values[idx])
+            self._sorted = values
+        return self
+
+    def __contains__(self, value):
+        if self._bitmap is not None:
+            idx = value - self._min
+            return 0 <= idx < self._span and bool(self._bitmap[idx >> 3] & (1 << (idx & 7)))
+        idx = bisect_left(self._sorted, value)
+        return idx < len(self._sorted) and self._sorted[idx] == value
+
+
+def find_file(data_dir, export_file):
+    'Файл набора записей в data_dir, с любым сжатием, или None.'
+    filename, format = maps['export-files'][export_file]
+    for suffix in [''] + list(compression.SUFFIXES.values()):
+        path = os.path.join(data_dir, filename + suffix)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+class Verifier:
+    '''Проверка ссылочной целостности файлов выгрузки в data_dir.
+
+    Каждый файл читается один раз потоком. Из родительских файлов (dog.csv,
+    conn.csv) строятся KeySet по полям, на которые есть ссылки, строковые
+    ключи хранятся хэшами (string_key). Строки остальных файлов проверяются
+    по ним на лету, так что память зависит только от размера родительских
+    файлов. Повторяющиеся строковые ключи восстанавливаются повторным
+    проходом по родительскому файлу, только если они есть.
+    '''
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.rows = {}
+        self.files = {}
+        # (набор, поле) -> KeySet
+        self.keys = {}
+        # (набор, поле, родитель) -> [количество, пустых, примеры (номер строки, значение)]
+        self.orphans = {}
+        # (набор, поле) -> [количество, примеры значений]
+        self.duplicates = {}
+        # ссылки, которые не проверялись из-за отсутствия родительского файла
+        self.unchecked = []
+
+    def _rows(self, export_file):
+        with open_read(self.files[export_file]) as f:
+            yield from csv.reader(f, delimiter=';')
+
+    def _positions(self, export_file, fields):
+        format = maps['export-files'][export_file][1].split(';')
+        return [format.index(field) for field in fields]
+
+    def _key(self, field, value):
+        if field in INTEGER_FIELDS:
+            return int(value)
+        return string_key(value)
+
+    def load_parent(self, export_file, fields):
+        sets = [KeySet() for _ in fields]
+        positions = self._positions(export_file, fields)
+        count = 0
+        for row in self._rows(export_file):
+            count += 1
+            for keys, pos, field in zip(sets, positions, fields):
+                try:
+                    keys.add(self._key(field, row[pos]))
+                except (ValueError, IndexError):
+                    # неверные значения в родительском файле ни на что не ссылаются
+                    pass
+        self.rows[export_file] = count
+        for keys, field in zip(sets, fields):
+            self.keys[export_file, field] = keys.build()
+
+    def check_duplicates(self, export_file, field):
+        keys = self.keys[export_file, field]
+        examples = list(keys.duplicates)
+        if keys.duplicates_count and field not in INTEGER_FIELDS:
+            # по хэшам находятся сами строки
+            wanted = set(examples)
+            pos = self._positions(export_file, [field])[0]
+            found = []
+            for row in self._rows(export_file):
+                value = row[pos] if pos < len(row) else ''
+                if value not in found and string_key(value) in wanted:
+                    found.append(value)
+            examples = found
+        self.duplicates[export_file, field] = [keys.duplicates_count, examples]
+
+    def check_references(self, export_file, references):
+        checks = []
+        for field, parent, parent_field in references:
+            keys = self.keys.get((parent, parent_field))
+            if keys is None:
+                # родительского файла нет, проверять не с чем
+                self.unchecked.append((export_file, field, parent))
+                continue
+            pos = self._positions(export_file, [field])[0]
+            result = self.orphans[export_file, field, parent] = [0, 0, []]
+            checks.append((pos, field, keys, result))
+        count = 0
+        for row in self._rows(export_file):
+            count += 1
+            for pos, field, keys, result in checks:
+                value = row[pos] if pos < len(row) else ''
+                if not value:
+                    result[1] += 1
+                    continue
+                try:
+                    found = self._key(field, value) in keys
+                except ValueError:
+                    found = False
+                if not found:
+                    result[0] += 1
+                    if len(result[2]) < MAX_EXAMPLES:
+                        result[2].append((count, value))
+        self.rows[export_file] = count
+
+    def count_rows(self, export_file):
+        count = 0
+        with open_read(self.files[export_file]) as f:
+            for _ in csv.reader(f, delimiter=';'):
+                count += 1
+        self.rows[export_file] = count
+
+    def run(self):
+        for export_file in maps['export-files']:
+            path = find_file(self.data_dir, export_file)
+            if path is not None:
+                self.files[export_file] = path
+
+        parents = {}
+        for _, _, parent, parent_field in REFERENCES:
+            parents.setdefault(parent, []).append(parent_field)
+        for parent, field in UNIQUE:
+            parents.setdefault(parent, []).append(field)
+        for parent, fields in parents.items():
+            if parent in self.files:
+                self.load_parent(parent, list(dict.fromkeys(fields)))
+        for export_file, field in UNIQUE:
+            if (export_file, field) in self.keys:
+                self.check_duplicates(export_file, field)
+
+        children = {}
+        for export_file, field, parent, parent_field in REFERENCES:
+            children.setdefault(export_file, []).append((field, parent, parent_field))
+        for export_file in self.files:
+            if export_file in parents:
+                continue
+            if export_file in children:
+                self.check_references(export_file, children[export_file])
+            else:
+                self.count_rows(export_file)
+        return self.ok()
+
+    def ok(self):
+        return not any(result[0] for result in self.orphans.values()) and \
+            not any(result[0] for result in self.duplicates.values())
+
+    def report(self):
+        def filename(export_file):
+            return maps['export-files'][export_file][0]
+
+        lines = ['{0:<24} {1:>12}'.format('file', 'rows')]
+        for export_file in maps['export-files']:
+            if export_file in self.files:
+                lines.append('{0:<24} {1:>12}'.format(os.path.basename(self.files[export_file]),
+                                                      self.rows.get(export_file, 0)))
+            else:
+                lines.append('{0:<24} {1:>12}'.format(filename(export_file), 'missing'))
+        lines.append('')
+        for (export_file, field), (count, examples) in self.duplicates.items():
+            lines.append('{0}: duplicate {1}: {2}'.format(filename(export_file), field, count))
+            for value in examples:
+                lines.append('    {0}'.format(value))
+        for export_file, field, parent in self.unchecked:
+            lines.append('{0}: {1} not checked, {2} is missing'.format(
+                filename(export_file), field, filename(parent)))
+        for (export_file, field, parent), (count, empty, examples) in self.orphans.items():
+            lines.append('{0}: {1} not in {2}: {3}{4}'.format(
+                filename(export_file), field, filename(parent), count,
+                ', empty: {0}'.format(empty) if empty else ''))
+            for line, value in examples:
+                lines.append('    line {0}: {1}'.format(line, value))
+        lines.append('')
+        lines.append('OK' if self.ok() else 'ERRORS FOUND')
+        return '\n'.join(lines)
@@ -0,0 +1,73 @@
+import os
+import locale
+import random
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from smart2onyma import compression
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def rows(seed, count):
+    rnd = random.Random(seed)
+    for idx in range(count):
+        yield '{0};лицевой {1};{2};\n'.format(idx, rnd.randrange(10 ** 9), 'x' * rnd.randrange(200))
+
+
+class CompressedFileTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_interleaved(self, method, files=4, count=100000):
+        'Пишет несколько файлов одновременно, строки вперемешку, как выгрузка.'
+        comp = compression.Compression(method)
+        names = [os.path.join(self.tmp_dir, 'f{0}{1}'.format(idx, comp.suffix)) for idx in range(files)]
+        expected = [[] for _ in names]
+        outs = [compression.open_write(name, 'w', comp) for name in names]
+        try:
+            sources = [rows(idx, count) for idx in range(files)]
+            for _ in range(count):
+                for idx, (out, source) in enumerate(zip(outs, sources)):
+                    line = next(source)
+                    out.write(line)
+                    expected[idx].append(line)
+        finally:
+            for out in outs:
+                out.close()
+        for name, lines in zip(names, expected):
+            with compression.open_read(name) as f:
+                self.assertEqual(f.read(), ''.join(lines))
+
+    @unittest.skipIf(zstandard is None, 'zstandard is not installed')
+    def test_zstd_files_written_at_once(self):
+        # небольшие порции - много частей сжатия в каждом потоке
+        with mock.patch.object(compression, 'CHUNK_SIZE', 4096):
+            self.write_interleaved('zstd')
+
+    @unittest.skipIf(zstandard is None, 'zstandard is not installed')
+    def test_large_zstd_files_written_at_once(self):
+        self.write_interleaved('zstd', count=150000)
+
+    def test_gzip_files_written_at_once(self):
+        with mock.patch.object(compression, 'CHUNK_SIZE', 4096):
+            self.write_interleaved('gzip', count=20000)
+
+    def test_tell_counts_bytes(self):
+        text = 'лицевой;42;\n'
+        plain = os.path.join(self.tmp_dir, 'plain.csv')
+        with compression.open_write(plain, 'w') as f:
+            f.write(text)
+            plain_size = f.tell()
+        with compression.open_write(plain + '.gz', 'w', compression.Compression('gzip')) as f:
+            f.write(text)
+            self.assertEqual(f.tell(), plain_size)
+        self.assertEqual(plain_size, len(text.encode(locale.getpreferredencoding(False))))